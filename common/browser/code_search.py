@@ -81,7 +81,7 @@ def make_code_search(item, check_cache=True) -> SourceCode:
             continue
     print(f"Modules: {len(modules)}")
     print(f"Raw files: {len(raw_files)}")
-    TEXT_SEARCH.cleanup(instance_id)
+    TEXT_SEARCH.reset_partition(instance_id)
     for filename, content in raw_files.items():
         filename = filename.replace(repo_target, "")
         if filename.endswith(".py"):
@@ -5,6 +5,9 @@ from common.browser.module import CodeDisplayLevel, LineNumberMode
 import tomllib
 import json
 
+# Token budget for the module overview when narrowing down a result.
+NARROWING_MODULE_MAX_TOKENS = 8000
+
 
 class DirSelection:
     def __init__(self):
@@ -95,7 +98,7 @@ Here are the candidates for relevant files:
         for display_level in display_levels:
             matching_module_content = matching_module.display(display_level, LineNumberMode.ENABLED)
             final_display_level = display_level
-            if len(matching_module_content) < 32000:
+            if LANGUAGE_MODEL.count_tokens(matching_module_content) < NARROWING_MODULE_MAX_TOKENS:
                 break
         prompt = f"""
 Repo: {repo}
@@ -1,18 +1,85 @@
 import sqlite3
+from collections import OrderedDict
 from threading import Lock
+from common.sqlite_store import connect, GroupCommitter
+from common.vector_codec import encode_vector, decode_vector
+import numpy as np
 import tomllib
 import typing as t
 import os
 import json
 import pickle
+import hashlib
 import zlib
 
+# Max number of bound variables per statement (SQLite's default limit is 999).
+MAX_SQL_VARIABLES = 900
+# Number of rows copied at a time when migrating the old prompt cache.
+MIGRATION_BATCH_SIZE = 1000
+
+
+def prompt_digest(prompt: str) -> bytes:
+    """Fixed-size digest identifying a prompt."""
+    return hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+
+class MemoryCache:
+    """
+    LRU of deserialized values, bounded by number of entries and by (serialized) bytes.
+    Values are shared between callers, so they should not be mutated.
+    """
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[t.Hashable, t.Tuple[t.Any, int]] = OrderedDict()
+        self.num_bytes = 0
+        self.lock = Lock()
+        # Metrics.
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: t.Hashable) -> t.Tuple[t.Any, bool]:
+        """Returns the value and whether it was found."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], True
+
+    def set(self, key: t.Hashable, value: t.Any, num_bytes: int):
+        with self.lock:
+            if key in self.entries:
+                self.num_bytes -= self.entries.pop(key)[1]
+            if num_bytes > self.max_bytes:
+                return
+            self.entries[key] = (value, num_bytes)
+            self.num_bytes += num_bytes
+            while len(self.entries) > self.max_entries or self.num_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.num_bytes -= evicted_bytes
+
+    def metrics(self) -> t.Dict[str, t.Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.num_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            }
+
 
 class Cache:
     def __init__(self):
         config = tomllib.load(open("configs/main.toml", "rb"))
         working_stage = config["working_stage"]
         llm = config["llm"]
+        self.keep_prompts = config.get("cache_keep_prompts", False)
+        self.embedding_dtype = config.get("embedding_dtype", "float32")
+        self.memory = MemoryCache(config.get("memory_cache_entries", 100_000), config.get("memory_cache_bytes", 1 << 30))
         cache_dir = f"{working_stage}/prompt_cache_{llm}"
         os.makedirs(cache_dir, exist_ok=True)
         parallelism = 8
@@ -23,51 +90,230 @@ class Cache:
         self.dbs = []
         for db_file in db_files:
             print(f"Opening {db_file}")
-            db = sqlite3.connect(db_file, check_same_thread=False)
+            db = connect(db_file)
             cur = db.cursor()
             cur.executescript(schema)
             db.commit()
+            self._migrate_prompt_cache(db)
             self.dbs.append(db)
+        commit_config = config["group_commit"]
+        self.committer = GroupCommitter(self.dbs, self.db_locks, commit_config["max_pending"], commit_config["max_delay"])
+
+    def _migrate_prompt_cache(self, db: sqlite3.Connection):
+        """Move rows of the old prompt_cache table, which stored full prompts, to prompt_digest_cache."""
+        cur = db.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'prompt_cache'")
+        if cur.fetchone() is None:
+            return
+        print("Migrating prompt cache to prompt digests")
+        read_cur = db.cursor()
+        read_cur.execute("SELECT key, prompt, value FROM prompt_cache")
+        while True:
+            rows = read_cur.fetchmany(MIGRATION_BATCH_SIZE)
+            if len(rows) == 0:
+                break
+            rows = [(key, prompt_digest(prompt), self._stored_prompt(prompt), value) for key, prompt, value in rows]
+            cur.executemany("REPLACE INTO prompt_digest_cache (key, prompt_digest, prompt, value) VALUES (?, ?, ?, ?)", rows)
+        cur.execute("DROP TABLE prompt_cache")
+        db.commit()
+        # Give the space of the full prompts back.
+        db.execute("VACUUM")
+
+    def _stored_prompt(self, prompt: str) -> t.Optional[bytes]:
+        if not self.keep_prompts:
+            return None
+        return zlib.compress(prompt.encode())
+
+    def _db_idx(self, key: str) -> int:
+        return zlib.adler32(key.encode()) % len(self.dbs)
 
     def _get_db(self, key: str) -> t.Tuple[sqlite3.Connection, Lock]:
-        idx = zlib.adler32(key.encode()) % len(self.dbs)
+        idx = self._db_idx(key)
         return self.dbs[idx], self.db_locks[idx]
+
+    def _group_by_db(self, keys: t.List[str]) -> t.Dict[int, t.List[int]]:
+        """Group the positions of the keys by the db they belong to."""
+        by_db = {}
+        for i, key in enumerate(keys):
+            by_db.setdefault(self._db_idx(key), []).append(i)
+        return by_db
     
     def get_prompt(self, key: str, prompt: str) -> t.Optional[t.Any]:
+        digest = prompt_digest(prompt)
+        value, found = self.memory.get(("prompt", key, digest))
+        if found:
+            return value
         db, db_lock = self._get_db(key)
         with db_lock:
             cur = db.cursor()
-            cur.execute("SELECT value FROM prompt_cache WHERE key = ? AND prompt = ?", (key, prompt))
+            cur.execute("SELECT value FROM prompt_digest_cache WHERE key = ? AND prompt_digest = ?", (key, digest))
             result = cur.fetchone()
-            if result is not None:
-                return json.loads(result[0])
+        if result is None:
             return None
+        value = json.loads(result[0])
+        self.memory.set(("prompt", key, digest), value, len(result[0]))
+        return value
         
     def set_prompt(self, key: str, prompt: str, value: t.Any):
-        value = json.dumps(value)
-        db, db_lock = self._get_db(key)
-        with db_lock:
-            cur = db.cursor()
-            cur.execute("REPLACE INTO prompt_cache (key, prompt, value) VALUES (?, ?, ?)", (key, prompt, value))
-            db.commit()
+        digest = prompt_digest(prompt)
+        serialized = json.dumps(value)
+        idx = self._db_idx(key)
+        with self.db_locks[idx]:
+            cur = self.dbs[idx].cursor()
+            cur.execute(
+                "REPLACE INTO prompt_digest_cache (key, prompt_digest, prompt, value) VALUES (?, ?, ?, ?)",
+                (key, digest, self._stored_prompt(prompt), serialized),
+            )
+            self.committer.written(idx)
+        self.memory.set(("prompt", key, digest), value, len(serialized))
+
+    def get_prompts(self, items: t.List[t.Tuple[str, str]]) -> t.List[t.Optional[t.Any]]:
+        """Lookup multiple (key, prompt) pairs. Issues one query per db (and per chunk of keys)."""
+        return self._get_many("prompt", "prompt_digest_cache", "prompt_digest", items, json.loads)
+
+    def _get_many(
+            self, tag: str, table: str, digest_column: str,
+            items: t.List[t.Tuple[str, str]], decode: t.Callable[[t.Any], t.Any],
+        ) -> t.List[t.Optional[t.Any]]:
+        """Lookup multiple (key, text) pairs in a table of (key, digest, value) rows."""
+        results = [None] * len(items)
+        digests = [prompt_digest(text) for _, text in items]
+        missing = []
+        for i, (key, _) in enumerate(items):
+            value, found = self.memory.get((tag, key, digests[i]))
+            if found:
+                results[i] = value
+            else:
+                missing.append(i)
+        by_db = self._group_by_db([items[i][0] for i in missing])
+        for idx, positions in by_db.items():
+            positions = [missing[i] for i in positions]
+            db, db_lock = self.dbs[idx], self.db_locks[idx]
+            with db_lock:
+                cur = db.cursor()
+                for start in range(0, len(positions), MAX_SQL_VARIABLES):
+                    chunk = positions[start:start+MAX_SQL_VARIABLES]
+                    keys = [items[i][0] for i in chunk]
+                    placeholders = ", ".join(["?"] * len(keys))
+                    cur.execute(f"SELECT key, {digest_column}, value FROM {table} WHERE key IN ({placeholders})", keys)
+                    rows = {key: (digest, value) for key, digest, value in cur.fetchall()}
+                    for i in chunk:
+                        key = items[i][0]
+                        if key in rows and rows[key][0] == digests[i]:
+                            results[i] = decode(rows[key][1])
+                            self.memory.set((tag, key, digests[i]), results[i], len(rows[key][1]))
+        return results
+
+    def set_prompts(self, items: t.List[t.Tuple[str, str, t.Any]]):
+        """Set multiple (key, prompt, value) triples. Commits once per db."""
+        by_db = self._group_by_db([key for key, _, _ in items])
+        for idx, positions in by_db.items():
+            rows = []
+            for i in positions:
+                key, prompt, value = items[i]
+                rows.append((key, prompt_digest(prompt), self._stored_prompt(prompt), json.dumps(value)))
+            db, db_lock = self.dbs[idx], self.db_locks[idx]
+            with db_lock:
+                cur = db.cursor()
+                cur.executemany("REPLACE INTO prompt_digest_cache (key, prompt_digest, prompt, value) VALUES (?, ?, ?, ?)", rows)
+                self.committer.written(idx, len(rows))
+            for i, (key, digest, _, serialized) in zip(positions, rows):
+                self.memory.set(("prompt", key, digest), items[i][2], len(serialized))
+
+    def get_embedding(self, key: str, text: str) -> t.Optional[np.ndarray]:
+        return self.get_embeddings([(key, text)])[0]
+
+    def set_embedding(self, key: str, text: str, embedding: t.Union[t.List[float], np.ndarray]):
+        self.set_embeddings([(key, text, embedding)])
+
+    def get_embeddings(self, items: t.List[t.Tuple[str, str]]) -> t.List[t.Optional[np.ndarray]]:
+        """Lookup the embeddings of multiple (key, text) pairs."""
+        # Embeddings cached in older formats are moved over once, by scripts/migrate_embedding_cache.py.
+        return self._get_many("embedding", "embedding_cache", "text_digest", items, decode_vector)
+
+    def set_embeddings(self, items: t.List[t.Tuple[str, str, t.Union[t.List[float], np.ndarray]]]):
+        """Set the embeddings of multiple (key, text, embedding) triples, as binary vectors."""
+        by_db = self._group_by_db([key for key, _, _ in items])
+        for idx, positions in by_db.items():
+            rows = [(items[i][0], prompt_digest(items[i][1]), encode_vector(items[i][2], self.embedding_dtype)) for i in positions]
+            db, db_lock = self.dbs[idx], self.db_locks[idx]
+            with db_lock:
+                cur = db.cursor()
+                cur.executemany("REPLACE INTO embedding_cache (key, text_digest, value) VALUES (?, ?, ?)", rows)
+                self.committer.written(idx, len(rows))
+            for key, digest, blob in rows:
+                self.memory.set(("embedding", key, digest), decode_vector(blob), len(blob))
 
     def get_object(self, key: str) -> t.Any:
+        value, found = self.memory.get(("object", key))
+        if found:
+            return value
         db, db_lock = self._get_db(key)
         with db_lock:
             cur = db.cursor()
             cur.execute("SELECT value FROM object_cache WHERE key = ?", (key,))
             result = cur.fetchone()
-            if result is not None:
-                return pickle.loads(result[0])
+        if result is None:
             return None
+        value = pickle.loads(result[0])
+        self.memory.set(("object", key), value, len(result[0]))
+        return value
 
     def set_object(self, key: str, value: t.Any):
-        value = pickle.dumps(value)
-        db, db_lock = self._get_db(key)
-        with db_lock:
-            cur = db.cursor()
-            cur.execute("REPLACE INTO object_cache (key, value) VALUES (?, ?)", (key, value))
-            db.commit()
+        serialized = pickle.dumps(value)
+        idx = self._db_idx(key)
+        with self.db_locks[idx]:
+            cur = self.dbs[idx].cursor()
+            cur.execute("REPLACE INTO object_cache (key, value) VALUES (?, ?)", (key, serialized))
+            self.committer.written(idx)
+        self.memory.set(("object", key), value, len(serialized))
+
+    def get_objects(self, keys: t.List[str]) -> t.List[t.Any]:
+        """Lookup multiple objects. Issues one query per db (and per chunk of keys)."""
+        results = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            value, found = self.memory.get(("object", key))
+            if found:
+                results[i] = value
+            else:
+                missing.append(i)
+        by_db = self._group_by_db([keys[i] for i in missing])
+        for idx, positions in by_db.items():
+            positions = [missing[i] for i in positions]
+            db, db_lock = self.dbs[idx], self.db_locks[idx]
+            with db_lock:
+                cur = db.cursor()
+                for start in range(0, len(positions), MAX_SQL_VARIABLES):
+                    chunk = positions[start:start+MAX_SQL_VARIABLES]
+                    placeholders = ", ".join(["?"] * len(chunk))
+                    cur.execute(f"SELECT key, value FROM object_cache WHERE key IN ({placeholders})", [keys[i] for i in chunk])
+                    rows = dict(cur.fetchall())
+                    for i in chunk:
+                        if keys[i] in rows:
+                            results[i] = pickle.loads(rows[keys[i]])
+                            self.memory.set(("object", keys[i]), results[i], len(rows[keys[i]]))
+        return results
+
+    def set_objects(self, items: t.List[t.Tuple[str, t.Any]]):
+        """Set multiple (key, object) pairs. Commits once per db."""
+        by_db = self._group_by_db([key for key, _ in items])
+        for idx, positions in by_db.items():
+            rows = [(items[i][0], pickle.dumps(items[i][1])) for i in positions]
+            db, db_lock = self.dbs[idx], self.db_locks[idx]
+            with db_lock:
+                cur = db.cursor()
+                cur.executemany("REPLACE INTO object_cache (key, value) VALUES (?, ?)", rows)
+                self.committer.written(idx, len(rows))
+            for i, (key, serialized) in zip(positions, rows):
+                self.memory.set(("object", key), items[i][1], len(serialized))
+
+    def flush(self):
+        """Commit pending writes."""
+        self.committer.flush()
+
+    def metrics(self) -> t.Dict[str, t.Any]:
+        return {"memory": self.memory.metrics(), "commits": self.committer.metrics()}
 
 
 CACHE = Cache()
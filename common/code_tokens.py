@@ -0,0 +1,52 @@
+import re
+import typing as t
+
+# Identifiers and numbers. Everything else separates tokens.
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|[0-9]+")
+# Parts of an identifier: snake_case, camelCase, acronyms (HTTPResponse -> HTTP, Response) and digits.
+PART_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+
+def identifier_parts(identifier: str) -> t.List[str]:
+    """Lowercased parts of an identifier."""
+    return [part.lower() for part in PART_PATTERN.findall(identifier)]
+
+
+def canonical_identifier(identifier: str) -> str:
+    """Spelling-independent form of an identifier: safe_infer, SafeInfer and safeInfer all become safeinfer."""
+    return "".join(identifier_parts(identifier))
+
+
+def index_tokens(text: str) -> str:
+    """
+    Text to index in place of code, for the default FTS5 tokenizer.
+    Each identifier is indexed in canonical form, followed by its parts when it has several.
+    """
+    tokens = []
+    for identifier in IDENTIFIER_PATTERN.findall(text):
+        parts = identifier_parts(identifier)
+        if len(parts) == 0:
+            continue
+        tokens.append("".join(parts))
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return " ".join(tokens)
+
+
+def query_tokens(query: str) -> t.List[str]:
+    """
+    FTS5 terms of a query, one per identifier, normalized like `index_tokens`.
+    An identifier with several parts matches its canonical form or all of its parts, so "safe_infer" matches SafeInfer
+    and safe_infer_call. Exact identifiers match more terms, so they still rank first.
+    """
+    terms = []
+    for identifier in IDENTIFIER_PATTERN.findall(query):
+        parts = identifier_parts(identifier)
+        if len(parts) == 0:
+            continue
+        canonical = "".join(parts)
+        if len(parts) > 1:
+            terms.append(f"({canonical} OR ({' AND '.join(parts)}))")
+        else:
+            terms.append(canonical)
+    return terms
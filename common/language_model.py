@@ -1,5 +1,11 @@
 from .cache import CACHE
 from .colors import bcolors
+from .rate_limiter import RateLimiter
+from .single_flight import SingleFlight
+from .tokenizer import TokenCounter
+import asyncio
+import contextlib
+import weakref
 import tomllib
 import boto3
 import typing as t
@@ -8,6 +14,8 @@ import os
 import openai
 from enum import Enum
 import json
+import hashlib
+import numpy as np
 import dotenv
 
 class TokenLimitException(Exception):
@@ -16,7 +24,31 @@ class TokenLimitException(Exception):
 
 class RateLimitException(Exception):
     """Exception raised exceeding rate limit."""
-    pass
+    def __init__(self, msg: str, retry_after: t.Optional[float] = None):
+        super().__init__(msg)
+        # Seconds to wait before retrying, when the provider says so.
+        self.retry_after = retry_after
+
+
+def parse_retry_after(e: Exception) -> t.Optional[float]:
+    """Get the Retry-After delay (in seconds) from an OpenAI or botocore error, if any."""
+    headers = {}
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        # botocore ClientError
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    elif response is not None:
+        # openai APIStatusError
+        headers = response.headers
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except ValueError:
+        # Retry-After can also be an HTTP date. Just use the default backoff.
+        pass
+    return None
 
 class LLMType(Enum):
     GPT_4O = "gpt-4o"
@@ -42,7 +74,35 @@ class LLMType(Enum):
         if self == LLMType.SONNET:
             return "anthropic.claude-3-5-sonnet-20240620-v1:0"
         raise ValueError(f"Unknown LLM type {self}")
-    
+
+    def embedding_model_id(self) -> str:
+        if self.is_openai():
+            return "text-embedding-3-large"
+        if self.is_bedrock():
+            return "amazon.titan-embed-text-v2:0"
+        raise ValueError(f"Unknown LLM type {self}")
+
+
+class AsyncLimits:
+    """
+    Concurrency limits and clients for async calls.
+    Asyncio primitives are bound to a single event loop, so there is one of these per loop.
+    """
+    def __init__(self, llm: LLMType, concurrency: t.Dict[str, t.Any]):
+        self.global_limit = concurrency["global"]
+        self.model_limits = concurrency.get("models", {})
+        self.global_semaphore = asyncio.Semaphore(self.global_limit)
+        self.model_semaphores: t.Dict[str, asyncio.Semaphore] = {}
+        self.client = None
+        if llm.is_openai():
+            self.client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+    def model_semaphore(self, model_id: str) -> asyncio.Semaphore:
+        if model_id not in self.model_semaphores:
+            limit = self.model_limits.get(model_id, self.global_limit)
+            self.model_semaphores[model_id] = asyncio.Semaphore(limit)
+        return self.model_semaphores[model_id]
+
 
 
 class LanguageModel:
@@ -61,6 +121,85 @@ class LanguageModel:
             self.client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
         if self.llm.is_bedrock():
             self.client = boto3.client("bedrock-runtime", region_name="us-east-1", config=bedrock_config)
+        rate_limits = self.config["rate_limits"]
+        self.max_retries = rate_limits["max_retries"]
+        self.rate_limiters: t.Dict[str, RateLimiter] = {}
+        for model_id in [self.llm.model_id(), self.llm.embedding_model_id()]:
+            model_limits = rate_limits["models"].get(model_id, {})
+            self.rate_limiters[model_id] = RateLimiter(
+                model_id,
+                requests_per_minute=model_limits.get("requests_per_minute", rate_limits["requests_per_minute"]),
+                tokens_per_minute=model_limits.get("tokens_per_minute", rate_limits["tokens_per_minute"]),
+                base_backoff=rate_limits["base_backoff"],
+                max_backoff=rate_limits["max_backoff"],
+            )
+        self.async_limits: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncLimits] = weakref.WeakKeyDictionary()
+        self.token_counter = TokenCounter()
+        self.prompt_token_limit = self.config["token_limits"][self.llm.model_id()]
+        self.embedding_token_limit = self.config["token_limits"][self.llm.embedding_model_id()]
+        # Concurrent identical prompts/embeddings share a single call.
+        self.single_flight = SingleFlight()
+
+    @contextlib.asynccontextmanager
+    async def _async_slot(self, model_id: str):
+        """Wait for a free slot for the model (and globally). Yields the limits of the running loop."""
+        loop = asyncio.get_running_loop()
+        if loop not in self.async_limits:
+            self.async_limits[loop] = AsyncLimits(self.llm, self.config["concurrency"])
+        limits = self.async_limits[loop]
+        # Take the model slot first, so that a global slot is not held while waiting for it.
+        async with limits.model_semaphore(model_id), limits.global_semaphore:
+            yield limits
+
+    def _rate_limited(self, model_id: str, num_tokens: int, call: t.Callable[[], t.Tuple[t.Any, t.Optional[Exception]]]):
+        """Make a provider call within the model's rate limits. Throttled calls are retried."""
+        limiter = self.rate_limiters[model_id]
+        for attempt in range(self.max_retries + 1):
+            limiter.acquire(num_tokens)
+            response, error = call()
+            if not isinstance(error, RateLimitException) or attempt == self.max_retries:
+                return response, error
+            # The next acquire waits for the backoff.
+            delay = limiter.throttled(attempt, error.retry_after)
+            if self.verbose:
+                print(f"{bcolors.WARNING}Throttled ({model_id}). Retrying in {delay:.1f}s.{bcolors.ENDC}")
+
+    async def _arate_limited(self, model_id: str, num_tokens: int, call: t.Callable[[], t.Awaitable[t.Tuple[t.Any, t.Optional[Exception]]]]):
+        """Async version of `_rate_limited`."""
+        limiter = self.rate_limiters[model_id]
+        for attempt in range(self.max_retries + 1):
+            await limiter.aacquire(num_tokens)
+            response, error = await call()
+            if not isinstance(error, RateLimitException) or attempt == self.max_retries:
+                return response, error
+            delay = limiter.throttled(attempt, error.retry_after)
+            if self.verbose:
+                print(f"{bcolors.WARNING}Throttled ({model_id}). Retrying in {delay:.1f}s.{bcolors.ENDC}")
+
+    def rate_limit_metrics(self) -> t.Dict[str, t.Dict[str, t.Any]]:
+        """Queue depth and wait time metrics of every rate limiter."""
+        return {model_id: limiter.metrics() for model_id, limiter in self.rate_limiters.items()}
+
+    def embedding_cache_key(self, text: str) -> str:
+        """Cache key of an embedding, by embedding model and text. Identical texts share it across instances and repos."""
+        digest = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+        return f"embedding_{self.llm.embedding_model_id()}_{digest}"
+
+    def estimate_tokens(self, text: str) -> int:
+        """Token count used for rate limiting."""
+        return self.count_tokens(text)
+
+    def count_tokens(self, text: str, model_id: t.Optional[str] = None) -> int:
+        """Count the tokens of a text. Defaults to the chat model."""
+        if model_id is None:
+            model_id = self.llm.model_id()
+        return self.token_counter.count(text, model_id)
+
+    def truncate_tokens(self, text: str, max_tokens: int, model_id: t.Optional[str] = None) -> str:
+        """Truncate a text to a number of tokens. Defaults to the chat model."""
+        if model_id is None:
+            model_id = self.llm.model_id()
+        return self.token_counter.truncate(text, max_tokens, model_id)
 
 
     def _invoke_openai(self, system_msg: str, prompt: str) -> str:
@@ -82,7 +221,7 @@ class LanguageModel:
         except openai.BadRequestError as e:
             error = TokenLimitException(f"Token Limit Error (OpenAI): {e}")
         except openai.RateLimitError as e:
-            error = RateLimitException(f"Rate Limit Error (OpenAI): {e}")
+            error = RateLimitException(f"Rate Limit Error (OpenAI): {e}", retry_after=parse_retry_after(e))
         except Exception as e:
             error = e
         return response, error
@@ -109,132 +248,335 @@ class LanguageModel:
             error = e
             if "ThrottlingException" in f"{e}":
                 # Treat as a rate limit error
-                error = RateLimitException(f"Rate Limit Error (Bedrock): {e}")
+                error = RateLimitException(f"Rate Limit Error (Bedrock): {e}", retry_after=parse_retry_after(e))
+        return response, error
+
+
+    async def _ainvoke_openai(self, system_msg: str, prompt: str) -> str:
+        """Invoke the LLM using the async OpenAI client."""
+        if not self.within_prompt_limits(prompt, system_msg):
+            raise TokenLimitException("Token limit exceeded (OpenAI).")
+        model_id = self.llm.model_id()
+        response, error = None, None
+        async with self._async_slot(model_id) as limits:
+            try:
+                response = await limits.client.chat.completions.create(
+                    model=model_id,
+                    messages=[
+                        {"role": "system", "content": system_msg},
+                        {"role": "user", "content": prompt}
+                    ],
+                    temperature=0.0,
+                )
+                response = response.choices[0].message.content
+            except openai.BadRequestError as e:
+                error = TokenLimitException(f"Token Limit Error (OpenAI): {e}")
+            except openai.RateLimitError as e:
+                error = RateLimitException(f"Rate Limit Error (OpenAI): {e}", retry_after=parse_retry_after(e))
+            except Exception as e:
+                error = e
         return response, error
 
+    async def _ainvoke_bedrock(self, system_msg: str, prompt: str) -> str:
+        """Invoke the LLM using Bedrock. boto3 has no async client, so the call runs in a worker thread."""
+        async with self._async_slot(self.llm.model_id()):
+            return await asyncio.to_thread(self._invoke_bedrock, system_msg, prompt)
+
 
-    def _embed_openai(self, text: str):
-        """Embed text using OpenAI."""
-        if not self.within_embedding_limits(text):
+    def _embed_openai(self, texts: t.List[str]):
+        """Embed a batch of texts using OpenAI."""
+        if not all(self.within_embedding_limits(text) for text in texts):
             raise TokenLimitException("Embedding token limit exceeded (OpenAI).")
         response, error = None, None
         try:
-            response = self.client.embeddings.create(
-                input=[text],
-                model="text-embedding-3-large",
+            data = self.client.embeddings.create(
+                input=texts,
+                model=self.llm.embedding_model_id(),
                 dimensions=1024,
-            ).data[0].embedding
+            ).data
+            # Results should already be ordered, but the index is authoritative.
+            data = sorted(data, key=lambda d: d.index)
+            response = [d.embedding for d in data]
         except openai.BadRequestError as e:
             error = TokenLimitException(f"Embedding Limit Error (OpenAI): {e}")
         except openai.RateLimitError as e:
-            error = RateLimitException(f"Embedding Rate Limit Error (OpenAI): {e}")
+            error = RateLimitException(f"Embedding Rate Limit Error (OpenAI): {e}", retry_after=parse_retry_after(e))
         except Exception as e:
             error = e
         return response, error
     
-    def _embed_bedrock(self, text: str):
-        """Embed text using Bedrock."""
-        if not self.within_embedding_limits(text):
+    def _embed_bedrock(self, texts: t.List[str]):
+        """Embed a batch of texts using Bedrock."""
+        if not all(self.within_embedding_limits(text) for text in texts):
             raise TokenLimitException("Embedding token limit exceeded (Bedrock).")
         response, error = None, None
         try:
-            body = json.dumps({
-                "inputText": text,
-                "dimensions": 1024,
-                "normalize": True,
-            })
-            response = self.client.invoke_model(
-                body=body,
-                modelId="amazon.titan-embed-text-v2:0",
-                accept="application/json",
-                contentType="application/json",
-            )
-            response = json.loads(response.get("body").read())
-            response = response.get("embedding")
+            # Titan does not accept multiple inputs per call. So embed one at a time.
+            response = []
+            for text in texts:
+                body = json.dumps({
+                    "inputText": text,
+                    "dimensions": 1024,
+                    "normalize": True,
+                })
+                embedding = self.client.invoke_model(
+                    body=body,
+                    modelId=self.llm.embedding_model_id(),
+                    accept="application/json",
+                    contentType="application/json",
+                )
+                embedding = json.loads(embedding.get("body").read())
+                response.append(embedding.get("embedding"))
         except Exception as e:
+            response = None
             error = e
             if "ThrottlingException" in f"{e}":
-                error = TokenLimitException(f"Embedding Rate Limit Error (Bedrock): {e}")
+                error = RateLimitException(f"Embedding Rate Limit Error (Bedrock): {e}", retry_after=parse_retry_after(e))
+        return response, error
+
+    async def _aembed_openai(self, texts: t.List[str]):
+        """Embed a batch of texts using the async OpenAI client."""
+        if not all(self.within_embedding_limits(text) for text in texts):
+            raise TokenLimitException("Embedding token limit exceeded (OpenAI).")
+        model_id = self.llm.embedding_model_id()
+        response, error = None, None
+        async with self._async_slot(model_id) as limits:
+            try:
+                data = (await limits.client.embeddings.create(
+                    input=texts,
+                    model=model_id,
+                    dimensions=1024,
+                )).data
+                data = sorted(data, key=lambda d: d.index)
+                response = [d.embedding for d in data]
+            except openai.BadRequestError as e:
+                error = TokenLimitException(f"Embedding Limit Error (OpenAI): {e}")
+            except openai.RateLimitError as e:
+                error = RateLimitException(f"Embedding Rate Limit Error (OpenAI): {e}", retry_after=parse_retry_after(e))
+            except Exception as e:
+                error = e
         return response, error
 
+    async def _aembed_bedrock(self, texts: t.List[str]):
+        """Embed a batch of texts using Bedrock, in a worker thread."""
+        async with self._async_slot(self.llm.embedding_model_id()):
+            return await asyncio.to_thread(self._embed_bedrock, texts)
+
+    def _embed_batch(self, texts: t.List[str]) -> t.List[t.List[float]]:
+        """Embed a batch of texts with the configured provider."""
+        model_id = self.llm.embedding_model_id()
+        if self.llm.is_openai():
+            num_tokens = sum(self.estimate_tokens(text) for text in texts)
+            response, error = self._rate_limited(model_id, num_tokens, lambda: self._embed_openai(texts))
+        elif self.llm.is_bedrock():
+            # Titan takes one text per request, so each one counts against the request limit.
+            response, error = [], None
+            for text in texts:
+                embedding, error = self._rate_limited(model_id, self.estimate_tokens(text), lambda: self._embed_bedrock([text]))
+                if error is not None:
+                    break
+                response.extend(embedding)
+        # Check error
+        if error is not None:
+            if self.verbose:
+                print(f"{bcolors.FAIL}Error: {error}{bcolors.ENDC}")
+            raise error
+        return response
+
+
+    def _cached_response(self, prompt: str, cache_key: t.Optional[str], system_msg: str) -> t.Optional[str]:
+        """Lookup the cached response to a prompt."""
+        if cache_key is None:
+            return None
+        cache_prompt = f"{system_msg}____{prompt}"
+        cached = CACHE.get_prompt(cache_key, cache_prompt)
+        if cached is not None and self.verbose:
+            print(f"{bcolors.OKBLUE}Using cached response for {cache_key}.{bcolors.ENDC}")
+        return cached
+
+    def _finish_invoke(self, prompt: str, cache_key: t.Optional[str], system_msg: str, response: t.Optional[str], error: t.Optional[Exception]) -> str:
+        """Check for errors, then cache the response."""
+        if error is not None:
+            if self.verbose:
+                print(f"{bcolors.FAIL}Error: {error}{bcolors.ENDC}")
+            raise error
+        if cache_key is not None:
+            cache_prompt = f"{system_msg}____{prompt}"
+            CACHE.set_prompt(cache_key, cache_prompt, response)
+        if self.verbose:
+            print(f"{bcolors.OKBLUE}Response: {response}{bcolors.ENDC}")
+        return response
 
     def invoke(self, prompt: str, cache_key: t.Optional[str] = None, system_msg: t.Optional[str] = None) -> str:
         """Invoke the LLM."""
         # Default system message
         if system_msg is None:
             system_msg = self.default_system_msg
+        flight_key = ("prompt", cache_key, system_msg, prompt)
+        return self.single_flight.do(flight_key, lambda: self._invoke(prompt, cache_key, system_msg))
+
+    def _invoke(self, prompt: str, cache_key: t.Optional[str], system_msg: str) -> str:
         # Check cache
-        if cache_key is not None:
-            cache_prompt = f"{system_msg}____{prompt}"
-            cached = CACHE.get_prompt(cache_key, cache_prompt)
-            if cached is not None:
-                if self.verbose:
-                    print(f"{bcolors.OKBLUE}Using cached response for {cache_key}.{bcolors.ENDC}")
-                return cached
+        cached = self._cached_response(prompt, cache_key, system_msg)
+        if cached is not None:
+            return cached
         if self.verbose:
             print(f"{bcolors.OKGREEN}{bcolors.BOLD}Prompt:\n{prompt}{bcolors.ENDC}")
         # Call LLM
+        model_id = self.llm.model_id()
+        num_tokens = self.estimate_tokens(system_msg) + self.estimate_tokens(prompt)
         if self.llm.is_openai():
-            response, error = self._invoke_openai(system_msg, prompt)
+            response, error = self._rate_limited(model_id, num_tokens, lambda: self._invoke_openai(system_msg, prompt))
         elif self.llm.is_bedrock():
-            response, error = self._invoke_bedrock(system_msg, prompt)
-        # Check for errors.
-        if error is not None:
-            if self.verbose:
-                print(f"{bcolors.FAIL}Error: {error}{bcolors.ENDC}")
-            raise error
-        # Cache response
+            response, error = self._rate_limited(model_id, num_tokens, lambda: self._invoke_bedrock(system_msg, prompt))
+        # Check for errors and cache response.
+        return self._finish_invoke(prompt, cache_key, system_msg, response, error)
+
+    async def ainvoke(self, prompt: str, cache_key: t.Optional[str] = None, system_msg: t.Optional[str] = None) -> str:
+        """Invoke the LLM asynchronously. Concurrency is bounded by the `concurrency` config."""
+        # Default system message
+        if system_msg is None:
+            system_msg = self.default_system_msg
+        flight_key = ("prompt", cache_key, system_msg, prompt)
+        return await self.single_flight.ado(flight_key, lambda: self._ainvoke(prompt, cache_key, system_msg))
+
+    async def _ainvoke(self, prompt: str, cache_key: t.Optional[str], system_msg: str) -> str:
+        # Check cache
+        cached = self._cached_response(prompt, cache_key, system_msg)
+        if cached is not None:
+            return cached
+        if self.verbose:
+            print(f"{bcolors.OKGREEN}{bcolors.BOLD}Prompt:\n{prompt}{bcolors.ENDC}")
+        # Call LLM
+        model_id = self.llm.model_id()
+        num_tokens = self.estimate_tokens(system_msg) + self.estimate_tokens(prompt)
+        if self.llm.is_openai():
+            response, error = await self._arate_limited(model_id, num_tokens, lambda: self._ainvoke_openai(system_msg, prompt))
+        elif self.llm.is_bedrock():
+            response, error = await self._arate_limited(model_id, num_tokens, lambda: self._ainvoke_bedrock(system_msg, prompt))
+        # Check for errors and cache response.
+        return self._finish_invoke(prompt, cache_key, system_msg, response, error)
+
+
+    def _cached_embedding(self, text: str, cache_key: t.Optional[str]) -> t.Optional[np.ndarray]:
+        """Lookup the cached embedding of a text."""
+        if cache_key is None:
+            return None
+        cached_response = CACHE.get_embedding(cache_key, text)
+        if cached_response is not None and self.verbose:
+            print(f"{bcolors.OKBLUE}Using cached embedding for {cache_key}{bcolors.ENDC}")
+        return cached_response
+
+    def _finish_embed(self, text: str, cache_key: t.Optional[str], response: t.List[float]) -> np.ndarray:
+        """Cache the embedding."""
+        response = np.asarray(response, dtype=np.float32)
         if cache_key is not None:
-            cache_prompt = f"{system_msg}____{prompt}"
-            CACHE.set_prompt(cache_key, cache_prompt, response)
-        # Done.
+            CACHE.set_embedding(cache_key, text, response)
         if self.verbose:
-            print(f"{bcolors.OKBLUE}Response: {response}{bcolors.ENDC}")
+            print(f"{bcolors.OKBLUE}Embedding: {response[:4]}{bcolors.ENDC}")
         return response
 
-
-    def embed(self, text: str, cache_key: t.Optional[str] = None) -> t.List[float]:
+    def embed(self, text: str, cache_key: t.Optional[str] = None) -> np.ndarray:
         """Embed text."""
+        flight_key = ("embedding", cache_key, text)
+        return self.single_flight.do(flight_key, lambda: self._embed(text, cache_key))
+
+    def _embed(self, text: str, cache_key: t.Optional[str]) -> np.ndarray:
         # Check cache.
-        cached_response = CACHE.get_prompt(cache_key, text)
+        cached_response = self._cached_embedding(text, cache_key)
         if cached_response is not None:
-            if self.verbose:
-                print(f"{bcolors.OKBLUE}Using cached embedding for {cache_key}{bcolors.ENDC}")
             return cached_response
         if self.verbose:
             print(f"{bcolors.OKGREEN}{bcolors.BOLD}Calling Embedding ({cache_key}):\n{text}{bcolors.ENDC}")
         # Make the call.
+        response = self._embed_batch([text])[0]
+        return self._finish_embed(text, cache_key, response)
+
+    async def aembed(self, text: str, cache_key: t.Optional[str] = None) -> np.ndarray:
+        """Embed text asynchronously. Concurrency is bounded by the `concurrency` config."""
+        flight_key = ("embedding", cache_key, text)
+        return await self.single_flight.ado(flight_key, lambda: self._aembed(text, cache_key))
+
+    async def _aembed(self, text: str, cache_key: t.Optional[str]) -> np.ndarray:
+        # Check cache.
+        cached_response = self._cached_embedding(text, cache_key)
+        if cached_response is not None:
+            return cached_response
+        if self.verbose:
+            print(f"{bcolors.OKGREEN}{bcolors.BOLD}Calling Embedding ({cache_key}):\n{text}{bcolors.ENDC}")
+        # Make the call.
+        model_id = self.llm.embedding_model_id()
+        num_tokens = self.estimate_tokens(text)
         if self.llm.is_openai():
-            response, error = self._embed_openai(text)
+            response, error = await self._arate_limited(model_id, num_tokens, lambda: self._aembed_openai([text]))
         elif self.llm.is_bedrock():
-            response, error = self._embed_bedrock(text)
-        # Check error
+            response, error = await self._arate_limited(model_id, num_tokens, lambda: self._aembed_bedrock([text]))
         if error is not None:
             if self.verbose:
                 print(f"{bcolors.FAIL}Error: {error}{bcolors.ENDC}")
             raise error
-        # Cache.
-        if cache_key is not None:
-            CACHE.set_prompt(cache_key, text, response)
-        # Done.
-        if self.verbose:
-            print(f"{bcolors.OKBLUE}Embedding: {response[:4]}{bcolors.ENDC}")
-        return response
+        return self._finish_embed(text, cache_key, response[0])
+
+
+    def embed_many(self, texts: t.List[str], cache_keys: t.List[t.Optional[str]]) -> t.List[np.ndarray]:
+        """
+        Embed multiple texts. Only cache misses are sent, in batches of `embedding_batch_size`.
+        Texts over the embedding token limit are embedded truncated to it.
+        """
+        assert len(texts) == len(cache_keys)
+        embeddings = [None] * len(texts)
+        # Texts that another caller is already embedding are waited for instead.
+        flight_keys = [("embedding", cache_key, text) for text, cache_key in zip(texts, cache_keys)]
+        flights = [self.single_flight.join(flight_key) for flight_key in flight_keys]
+        led_idxs = [i for i, (_, leader) in enumerate(flights) if leader]
+        try:
+            # Check cache in one pass.
+            cached_idxs = [i for i in led_idxs if cache_keys[i] is not None]
+            cached_responses = CACHE.get_embeddings([(cache_keys[i], texts[i]) for i in cached_idxs])
+            for i, cached_response in zip(cached_idxs, cached_responses):
+                if cached_response is not None:
+                    embeddings[i] = cached_response
+                    self.single_flight.finish(flight_keys[i], flights[i][0], result=cached_response)
+            missing_idxs = [i for i in led_idxs if embeddings[i] is None]
+            if self.verbose:
+                print(f"{bcolors.OKBLUE}Using cached embeddings for {len(led_idxs) - len(missing_idxs)}/{len(texts)} texts. {len(texts) - len(led_idxs)} already in flight.{bcolors.ENDC}")
+            # Embed the misses in batches.
+            batch_size = self.config["embedding_batch_size"]
+            for start in range(0, len(missing_idxs), batch_size):
+                batch_idxs = missing_idxs[start:start+batch_size]
+                if self.verbose:
+                    print(f"{bcolors.OKGREEN}{bcolors.BOLD}Calling Embedding on batch of {len(batch_idxs)} texts.{bcolors.ENDC}")
+                # Truncate oversized texts, so that one of them does not fail the whole batch. They are cached under their full text.
+                model_id = self.llm.embedding_model_id()
+                batch_texts = [self.truncate_tokens(texts[i], self.embedding_token_limit, model_id) for i in batch_idxs]
+                response = self._embed_batch(batch_texts)
+                for i, embedding in zip(batch_idxs, response):
+                    embeddings[i] = np.asarray(embedding, dtype=np.float32)
+                # Cache after every batch, so that progress is kept on failures.
+                CACHE.set_embeddings([(cache_keys[i], texts[i], embeddings[i]) for i in batch_idxs if cache_keys[i] is not None])
+                for i in batch_idxs:
+                    self.single_flight.finish(flight_keys[i], flights[i][0], result=embeddings[i])
+        except BaseException as e:
+            for i in led_idxs:
+                if not flights[i][0].done():
+                    self.single_flight.finish(flight_keys[i], flights[i][0], error=e)
+            raise
+        # Wait for the texts led by other callers.
+        for i, (future, leader) in enumerate(flights):
+            if not leader:
+                embeddings[i] = future.result()
+        return embeddings
 
 
     def within_prompt_limits(self, prompt: str, system_msg: t.Optional[str] = None):
         """Check if the prompt is within the limits."""
-        # Clause does not support client-side tokenization or limit checking. So I am using a heuristic.
-        # This should be a generous enough limit.
         if system_msg is None:
             system_msg = self.default_system_msg
-        return len(prompt) + len(system_msg) <= 96_000
+        return self.count_tokens(prompt) + self.count_tokens(system_msg) <= self.prompt_token_limit
     
     def within_embedding_limits(self, text: str):
         """Check if the text is within the embedding limits."""
-        # Clause does not support client-side tokenization or limit checking. So I am using a heuristic.
-        # This should be a generous enough limit.
-        return len(text) <= 5000
+        return self.count_tokens(text, self.llm.embedding_model_id()) <= self.embedding_token_limit
     
 
     def _parse_block(self, output: str, tag: str, lang: str=None):
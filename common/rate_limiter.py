@@ -0,0 +1,109 @@
+from threading import Lock
+import asyncio
+import random
+import time
+import typing as t
+
+
+class TokenBucket:
+    """Bucket that refills `per_minute` units every minute, up to `per_minute` units."""
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.last_refill = time.monotonic()
+
+    def reserve(self, amount: int, now: float) -> float:
+        """Reserve units and return how long to wait before using them. Must be called under a lock."""
+        self.level = min(self.capacity, self.level + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        # A single request larger than the bucket would otherwise wait forever.
+        self.level -= min(amount, self.capacity)
+        if self.level >= 0:
+            return 0.0
+        return -self.level / self.rate
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limits for a single model."""
+    def __init__(self, model_id: str, requests_per_minute: int, tokens_per_minute: int, base_backoff: float, max_backoff: float):
+        self.model_id = model_id
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.paused_until = 0.0
+        self.lock = Lock()
+        # Metrics.
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.num_acquired = 0
+        self.num_waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.num_throttled = 0
+
+    def _reserve(self, num_tokens: int) -> float:
+        """Reserve a request and its tokens. Returns the wait time."""
+        with self.lock:
+            now = time.monotonic()
+            wait = max(
+                self.requests.reserve(1, now),
+                self.tokens.reserve(num_tokens, now),
+                self.paused_until - now,
+            )
+            self.num_acquired += 1
+            if wait > 0:
+                self.num_waits += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.queue_depth += 1
+                self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            return wait
+
+    def _dequeue(self):
+        with self.lock:
+            self.queue_depth -= 1
+
+    def acquire(self, num_tokens: int):
+        """Block until a request with `num_tokens` tokens can be sent."""
+        wait = self._reserve(num_tokens)
+        if wait > 0:
+            time.sleep(wait)
+            self._dequeue()
+
+    async def aacquire(self, num_tokens: int):
+        """Wait until a request with `num_tokens` tokens can be sent."""
+        wait = self._reserve(num_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+            self._dequeue()
+
+    def throttled(self, attempt: int, retry_after: t.Optional[float]) -> float:
+        """
+        Record a throttled request and return how long to back off.
+        Honors the provider's Retry-After when given, otherwise uses jittered exponential backoff.
+        Every caller of this model is paused for that long, not just the throttled one.
+        """
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, self.base_backoff)
+        else:
+            delay = min(self.max_backoff, self.base_backoff * (2 ** attempt))
+            delay = random.uniform(delay / 2, delay)
+        with self.lock:
+            self.num_throttled += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        return delay
+
+    def metrics(self) -> t.Dict[str, t.Any]:
+        with self.lock:
+            return {
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "num_acquired": self.num_acquired,
+                "num_waits": self.num_waits,
+                "total_wait": self.total_wait,
+                "avg_wait": self.total_wait / self.num_waits if self.num_waits > 0 else 0.0,
+                "max_wait": self.max_wait,
+                "num_throttled": self.num_throttled,
+            }
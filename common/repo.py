@@ -12,6 +12,11 @@ class Repo:
         self.download_dir = f"{working_stage}/downloaded_repos"
         self.verbose = config["verbose"]
 
+    def repo_target(self, item: t.Dict[str, t.Any]) -> str:
+        """Directory a repository is downloaded to."""
+        owner, repo = item["repo"].split("/")
+        return f"{self.download_dir}/{owner}__{repo}/"
+
     def download_repo(self, item: t.Dict[str, t.Any], force=False) -> str:
         """Download a repository at a specific commit."""
         # Repo is in the form of "owner/repo"
@@ -20,7 +25,7 @@ class Repo:
         owner, repo = repo.split("/")
         github_token = os.environ.get("GITHUB_TOKEN")
         repo_url = f"https://{github_token}@github.com/{owner}/{repo}.git"
-        repo_target = f"{self.download_dir}/{owner}__{repo}/"
+        repo_target = self.repo_target(item)
         if os.path.exists(repo_target) and force:
             print(f"Repo {owner}/{repo} already exists at {repo_target}. Removing it.")
             assert len(repo_target) > 10 # Just to be sure
@@ -35,6 +40,31 @@ class Repo:
         return repo_target
 
 
+    def blob_shas(self, repo_target: str) -> t.Dict[str, str]:
+        """Git blob SHA of every file at the checked out commit, keyed by path within the repo."""
+        repo = git.Repo(repo_target)
+        listing = repo.git.ls_tree("-r", "-z", "HEAD")
+        shas = {}
+        for entry in listing.split("\0"):
+            if len(entry) == 0:
+                continue
+            # Entries are "<mode> <type> <sha>\t<path>".
+            info, path = entry.split("\t", 1)
+            _mode, obj_type, sha = info.split(" ")
+            if obj_type == "blob":
+                shas[path] = sha
+        return shas
+
+
+    def changed_files(self, repo_target: str, from_commit: str, to_commit: str) -> t.Dict[str, str]:
+        """Files that differ between two commits, with their status: A(dded), M(odified), D(eleted) or T(ype changed)."""
+        repo = git.Repo(repo_target)
+        # Without rename detection, renamed files are listed as deleted and added.
+        output = repo.git.diff("--name-status", "--no-renames", "-z", from_commit, to_commit)
+        fields = [field for field in output.split("\0") if len(field) > 0]
+        return {path: status for status, path in zip(fields[0::2], fields[1::2])}
+
+
     def _check_patch_applies(self, repo: git.Repo, item: t.Dict[str, t.Any], patch, relaxed) -> t.Optional[str]:
         """
         Check if a patch applies cleanly. Return the final patch (potentially tweaked) if it does.
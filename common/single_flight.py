@@ -0,0 +1,62 @@
+from concurrent.futures import Future
+from threading import Lock
+import asyncio
+import typing as t
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: the first caller (the leader) makes the call, the others wait for its result.
+    Works across threads and event loops, since waiters share a concurrent.futures.Future.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.in_flight: t.Dict[t.Hashable, Future] = {}
+        # Metrics.
+        self.num_coalesced = 0
+
+    def join(self, key: t.Hashable) -> t.Tuple[Future, bool]:
+        """Join the flight for a key. Returns its future and whether the caller is the leader."""
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.num_coalesced += 1
+                return future, False
+            future = Future()
+            self.in_flight[key] = future
+            return future, True
+
+    def finish(self, key: t.Hashable, future: Future, result: t.Any = None, error: t.Optional[BaseException] = None):
+        """Called by the leader to publish the result (or error) of a flight."""
+        with self.lock:
+            del self.in_flight[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key: t.Hashable, fn: t.Callable[[], t.Any]) -> t.Any:
+        """Call `fn`, unless an identical call is in flight."""
+        future, leader = self.join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result=result)
+        return result
+
+    async def ado(self, key: t.Hashable, fn: t.Callable[[], t.Awaitable[t.Any]]) -> t.Any:
+        """Await `fn()`, unless an identical call is in flight."""
+        future, leader = self.join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result=result)
+        return result
@@ -0,0 +1,156 @@
+import sqlite3
+from threading import Lock, Thread, Event
+import atexit
+import os
+import time
+import typing as t
+
+# Oldest SQLite the stores run on: RETURNING needs 3.35, and the FTS5 trigram tokenizer 3.34.
+MIN_SQLITE_VERSION = (3, 35, 0)
+if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+    raise RuntimeError(f"SQLite {'.'.join(map(str, MIN_SQLITE_VERSION))} or later is required, found {sqlite3.sqlite_version}.")
+
+# WAL lets readers proceed during writes. With WAL, synchronous=NORMAL only fsyncs at checkpoints.
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+]
+
+
+def connect(db_file: str) -> sqlite3.Connection:
+    """Open a db shared between threads, with the tuned pragmas."""
+    db = sqlite3.connect(db_file, check_same_thread=False)
+    for pragma in PRAGMAS:
+        db.execute(pragma)
+    return db
+
+
+def migrate(db: sqlite3.Connection, migrations_dir: str) -> int:
+    """
+    Apply the migrations of a db that are newer than its user_version, in order. Returns the resulting version.
+    Migrations are files named `<version>_<description>.sql`, each applied in its own transaction along with the version bump.
+    """
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    migrations = []
+    for filename in os.listdir(migrations_dir):
+        if filename.endswith(".sql"):
+            migrations.append((int(filename.split("_")[0]), filename))
+    migrations.sort()
+    for migration_version, filename in migrations:
+        if migration_version <= version:
+            continue
+        print(f"Applying migration {filename}")
+        with open(f"{migrations_dir}/{filename}", "r") as f:
+            script = f.read()
+        try:
+            db.executescript(f"BEGIN;\n{script};\nPRAGMA user_version = {migration_version};\nCOMMIT;")
+        except sqlite3.Error:
+            db.rollback()
+            raise
+        version = migration_version
+    return version
+
+
+class GroupCommitter:
+    """
+    Write-behind commits for a set of dbs, each guarded by its own lock.
+    Writers execute their statements under the db lock as usual, but instead of committing they call `written`.
+    The db is committed once `max_pending` writes are pending, or by a background thread after `max_delay` seconds.
+    Since the pending writes are on the same connection, they are visible to reads right away.
+    Pending writes are flushed at exit.
+    """
+    def __init__(self, dbs: t.List[sqlite3.Connection], db_locks: t.List[Lock], max_pending: int, max_delay: float):
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        # Dbs by index. Dbs can be added and removed, e.g. for partitions.
+        self.dbs: t.Dict[int, sqlite3.Connection] = {}
+        self.db_locks: t.Dict[int, Lock] = {}
+        self.pending: t.Dict[int, int] = {}
+        self.oldest_pending: t.Dict[int, float] = {}
+        self.next_idx = 0
+        self.lock = Lock()
+        for db, db_lock in zip(dbs, db_locks):
+            self.add(db, db_lock)
+        # Metrics.
+        self.num_writes = 0
+        self.num_commits = 0
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def add(self, db: sqlite3.Connection, db_lock: Lock) -> int:
+        """Add a db. Returns its index."""
+        with self.lock:
+            idx = self.next_idx
+            self.next_idx += 1
+            self.dbs[idx] = db
+            self.db_locks[idx] = db_lock
+            self.pending[idx] = 0
+            self.oldest_pending[idx] = 0.0
+            return idx
+
+    def remove(self, idx: int):
+        """Remove a db, dropping its pending writes. Must be called under the db lock."""
+        with self.lock:
+            del self.dbs[idx]
+            del self.db_locks[idx]
+            del self.pending[idx]
+            del self.oldest_pending[idx]
+
+    def written(self, idx: int, num_writes: int = 1):
+        """Record writes to a db. Must be called under the db lock."""
+        if self.pending[idx] == 0:
+            self.oldest_pending[idx] = time.monotonic()
+        self.pending[idx] += num_writes
+        self.num_writes += num_writes
+        if self.pending[idx] >= self.max_pending:
+            self._commit(idx)
+
+    def _commit(self, idx: int):
+        """Commit a db. Must be called under the db lock."""
+        self.dbs[idx].commit()
+        self.pending[idx] = 0
+        self.num_commits += 1
+
+    def _indices(self) -> t.List[int]:
+        with self.lock:
+            return list(self.dbs.keys())
+
+    def _commit_pending(self, idx: int, max_age: float):
+        """Commit a db if its oldest pending write is at least `max_age` seconds old."""
+        with self.lock:
+            db_lock = self.db_locks.get(idx)
+        if db_lock is None:
+            return
+        with db_lock:
+            # The db may have been removed while waiting for its lock.
+            if self.pending.get(idx, 0) > 0 and time.monotonic() - self.oldest_pending[idx] >= max_age:
+                self._commit(idx)
+
+    def _run(self):
+        while not self.stopped.wait(self.max_delay / 2):
+            for idx in self._indices():
+                self._commit_pending(idx, self.max_delay)
+
+    def flush(self):
+        """Commit every db with pending writes."""
+        for idx in self._indices():
+            self._commit_pending(idx, 0.0)
+
+    def close(self):
+        """Stop the background thread and flush."""
+        self.stopped.set()
+        self.flush()
+
+    def metrics(self) -> t.Dict[str, t.Any]:
+        with self.lock:
+            return {
+                "num_writes": self.num_writes,
+                "num_commits": self.num_commits,
+                "pending": sum(self.pending.values()),
+            }
@@ -1,25 +1,91 @@
 import sqlite3, sqlite_vss
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 import typing as t
 from common.language_model import LANGUAGE_MODEL
-import struct
+from common.cache import CACHE
+from common.sqlite_store import connect, migrate, GroupCommitter
+from common.vector_index import VectorIndex, InstanceVectors, CODE_ELEM_TYPES
+from common.code_tokens import index_tokens, query_tokens
+import numpy as np
 from semantic_text_splitter import TextSplitter, MarkdownSplitter
 import json
 import os
-import zlib
-import re, string
+import re
+# The regex parser is private: re._parser since Python 3.11, sre_parse before. Without it, regex searches scan every file.
+try:
+    import re._parser as re_parser
+except ImportError:
+    try:
+        import sre_parse as re_parser
+    except ImportError:
+        re_parser = None
 
 EXACT_ONLY_PATTERNS = ["test", "example"]
+# Version of the indexed format. Partitions indexed with another version are indexed again.
+INDEX_VERSION = 3
+# Schema migrations of partitions and of the catalog. See common/sqlite_store.py:migrate.
+MIGRATIONS_DIR = "configs/schemas/migrations/text_search"
+CATALOG_MIGRATIONS_DIR = "configs/schemas/migrations/text_search_catalog"
+# Shortest literal usable with the trigram index.
+MIN_TRIGRAM_LITERAL = 3
+# Reciprocal rank fusion constant. Dampens the advantage of the very first ranks.
+RRF_K = 60
+# Largest code point. Upper bound of the filenames under an empty directory prefix.
+MAX_CHAR = chr(0x10FFFF)
 
-def serialize(vector: t.List[float]) -> bytes:
+def serialize(vector: t.Union[t.List[float], np.ndarray]) -> bytes:
     """Serialize a vector to a byte string."""
-    return struct.pack(f"{len(vector)}f", *vector)
+    return np.asarray(vector, dtype=np.float32).tobytes()
 
 
-def hash_str(s: str, l: int) -> int:
-    """Hash a string."""
-    k = zlib.adler32(s.encode())
-    return k % l
+def regex_literals(pattern: str) -> t.List[str]:
+    """Literal strings that any match of the regex must contain. Used to prefilter files with the trigram index."""
+    if re_parser is None:
+        return []
+    literals = []
+    run = []
+    for op, arg in re_parser.parse(pattern):
+        if op == re_parser.LITERAL:
+            run.append(chr(arg))
+            continue
+        literals.append("".join(run))
+        run = []
+    literals.append("".join(run))
+    return [literal for literal in literals if len(literal) >= MIN_TRIGRAM_LITERAL]
+
+
+def prefix_range(prefix: str) -> t.Tuple[str, str]:
+    """Bounds [lo, hi) of the strings starting with a prefix, in SQLite's default (binary) order."""
+    if len(prefix) == 0:
+        return "", MAX_CHAR
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def fusion_key(result: t.Dict[str, t.Any]) -> t.Tuple:
+    """Identifies a code element across retrievers. Display levels of the same element share a key."""
+    return (result["filename"], result["elem_name"], result["parent_name"], result["elem_type"], result["split_idx"])
+
+
+def reciprocal_rank_fusion(rankings: t.List[t.List[t.Dict[str, t.Any]]]) -> t.Tuple[t.Dict[t.Tuple, t.Dict[str, t.Any]], t.Dict[t.Tuple, float]]:
+    """
+    Fuse ranked result lists. Returns the first result of each key, and its fused score.
+    Each ranking counts an element once, at its best rank, so a score is at most len(rankings) / (RRF_K + 1).
+    """
+    fused = {}
+    scores = {}
+    for results in rankings:
+        seen = set()
+        rank = 0
+        for r in results:
+            key = fusion_key(r)
+            if key in seen:
+                continue
+            seen.add(key)
+            rank += 1
+            fused.setdefault(key, r)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank)
+    return fused, scores
 
 
 def exact_only(elems) -> bool:
@@ -30,6 +96,20 @@ def exact_only(elems) -> bool:
                 return True
     return False
 
+class Partition:
+    """Search db of one (repo, base_commit)."""
+    def __init__(self, key: str, db_file: str, db: sqlite3.Connection, commit_idx: int):
+        self.key = key
+        self.db_file = db_file
+        self.db = db
+        self.lock = Lock()
+        self.commit_idx = commit_idx
+
+
+def make_partition_key(repo: str, base_commit: str) -> str:
+    return f"{repo.replace('/', '__')}_{base_commit}"
+
+
 class TextSearch:
     """Perform text + embedding search."""
 
@@ -41,124 +121,342 @@ class TextSearch:
         llm = LANGUAGE_MODEL.llm
         # Make db directory.
         db_dir = f"{working_stage}/text_search_{llm.value}"
-        os.makedirs(db_dir, exist_ok=True)
-        # Create the databases.
-        parallelism = 8
-        self.db_locks = [Lock() for _ in range(parallelism)]
-        db_files = [f"{db_dir}/text_search_{i}.db" for i in range(parallelism)]
+        self.partition_dir = f"{db_dir}/partitions"
+        os.makedirs(self.partition_dir, exist_ok=True)
+        # The catalog maps instances to partitions. Partitions are opened on first use.
+        with open("configs/schemas/text_search_catalog.sql", "r") as f:
+            catalog_schema = f.read()
         with open("configs/schemas/text_search.sql", "r") as f:
-            schema = f.read()
-        self.dbs = []
-        for db_file in db_files:
+            self.schema = f.read()
+        catalog_file = f"{db_dir}/catalog.db"
+        print(f"Opening {catalog_file}")
+        self.catalog = connect(catalog_file)
+        self.catalog.executescript(catalog_schema)
+        self.catalog.commit()
+        migrate(self.catalog, CATALOG_MIGRATIONS_DIR)
+        self.catalog_lock = Lock()
+        self.partitions: t.Dict[str, Partition] = {}
+        self.partition_keys: t.Dict[str, str] = {}
+        # (repo, base_commit) of the partitions of registered instances.
+        self.partition_commits: t.Dict[str, t.Tuple[str, str]] = {}
+        self.partitions_lock = Lock()
+        commit_config = config["group_commit"]
+        self.committer = GroupCommitter([], [], commit_config["max_pending"], commit_config["max_delay"])
+        text_split_length = config["text_split_length"]
+        overlap = text_split_length // 8
+        self.splitter = TextSplitter(capacity=text_split_length, overlap=overlap)
+        self.subsystem = "text_search"
+        self.use_vector_index = config.get("vector_index", True)
+        self.vector_index = VectorIndex(f"{db_dir}/vector_index")
+        # Runs the retrievers of hybrid searches concurrently.
+        self.search_pool = ThreadPoolExecutor(max_workers=8)
+
+    def register_instance(self, item):
+        """Assign an instance to the partition of its (repo, base_commit)."""
+        instance_id = item["instance_id"]
+        partition_key = make_partition_key(item["repo"], item["base_commit"])
+        with self.catalog_lock:
+            self.catalog.execute("REPLACE INTO instance_partitions (instance_id, partition_key) VALUES (?, ?)", (instance_id, partition_key))
+            self.catalog.commit()
+        with self.partitions_lock:
+            self.partition_keys[instance_id] = partition_key
+            self.partition_commits[partition_key] = (item["repo"], item["base_commit"])
+
+    def partition_key(self, instance_id: str) -> str:
+        """Partition of an instance. Unregistered instances get a partition of their own."""
+        with self.partitions_lock:
+            if instance_id in self.partition_keys:
+                return self.partition_keys[instance_id]
+        with self.catalog_lock:
+            cur = self.catalog.cursor()
+            cur.execute("SELECT partition_key FROM instance_partitions WHERE instance_id = ?", (instance_id,))
+            row = cur.fetchone()
+        partition_key = row[0] if row is not None else instance_id
+        with self.partitions_lock:
+            self.partition_keys[instance_id] = partition_key
+        return partition_key
+
+    def _partition(self, instance_id: str) -> Partition:
+        """Open partition of an instance."""
+        return self._open_partition(self.partition_key(instance_id))
+
+    def _open_partition(self, partition_key: str) -> Partition:
+        """Open partition by key."""
+        with self.partitions_lock:
+            partition = self.partitions.get(partition_key)
+            if partition is not None:
+                return partition
+            db_file = f"{self.partition_dir}/{partition_key}.db"
             print(f"Opening {db_file}")
-            db = sqlite3.connect(db_file, check_same_thread=False)
+            db = connect(db_file)
             db.enable_load_extension(True)
             sqlite_vss.load(db)
             cur = db.cursor()
-            cur.executescript(schema)
+            cur.executescript(self.schema)
             db.commit()
-            self.dbs.append(db)
-        text_split_length = config["text_split_length"]
-        overlap = text_split_length // 8
-        self.splitter = TextSplitter(capacity=text_split_length, overlap=overlap)
-        self.subsystem = "text_search"
+            migrate(db, MIGRATIONS_DIR)
+            partition = Partition(partition_key, db_file, db, -1)
+            partition.commit_idx = self.committer.add(db, partition.lock)
+            self.partitions[partition_key] = partition
+            return partition
 
+    def is_indexed(self, instance_id: str) -> bool:
+        """Whether the partition of an instance was fully indexed, possibly for another instance."""
+        # partition_key takes the catalog lock itself.
+        partition_key = self.partition_key(instance_id)
+        with self.catalog_lock:
+            cur = self.catalog.cursor()
+            cur.execute("SELECT 1 FROM indexed_partitions WHERE partition_key = ? AND version = ?", (partition_key, INDEX_VERSION))
+            return cur.fetchone() is not None
 
+    def mark_indexed(self, instance_id: str):
+        """Record that the partition of an instance is fully indexed."""
+        partition = self._partition(instance_id)
+        with partition.lock:
+            partition.db.commit()
+        with self.partitions_lock:
+            repo, base_commit = self.partition_commits.get(partition.key, (None, None))
+        with self.catalog_lock:
+            self.catalog.execute(
+                "REPLACE INTO indexed_partitions (partition_key, version, repo, base_commit) VALUES (?, ?, ?, ?)",
+                (partition.key, INDEX_VERSION, repo, base_commit)
+            )
+            self.catalog.commit()
 
-    def db_idx(self, instance_id):
-        return hash_str(instance_id, len(self.dbs))
+    def latest_indexed_partition(self, repo: str) -> t.Optional[t.Tuple[str, str]]:
+        """Most recently indexed partition of a repo, as (partition_key, base_commit)."""
+        with self.catalog_lock:
+            cur = self.catalog.cursor()
+            cur.execute(
+                "SELECT partition_key, base_commit FROM indexed_partitions WHERE repo = ? AND version = ? ORDER BY rowid DESC LIMIT 1",
+                (repo, INDEX_VERSION)
+            )
+            row = cur.fetchone()
+        if row is None or not os.path.exists(f"{self.partition_dir}/{row[0]}.db"):
+            return None
+        return row[0], row[1]
 
-    def _get_db(self, instance_id):
-        idx = self.db_idx(instance_id)
-        return self.dbs[idx], self.db_locks[idx]
-        
-    
+    def copy_partition(self, instance_id: str, source_key: str):
+        """
+        Replace the content of the partition of an instance with a copy of another partition, to update it incrementally.
+        The partition stays open, so handles held by other instances of the same partition remain valid.
+        """
+        target = self._partition(instance_id)
+        if target.key == source_key:
+            return
+        source = self._open_partition(source_key)
+        self._unmark_indexed(target.key)
+        self.vector_index.invalidate(target.key)
+        with source.lock, target.lock:
+            source.db.commit()
+            target.db.commit()
+            source.db.backup(target.db)
+
+    def remove_files(self, instance_id: str, filenames: t.List[str]):
+        """Remove the elements and the whole files of some filenames from the partition of an instance."""
+        partition = self._partition(instance_id)
+        self.vector_index.invalidate(partition.key)
+        filenames_param = json.dumps(filenames)
+        ids_expr = "SELECT id FROM content_table WHERE filename IN (SELECT value FROM json_each(?))"
+        with partition.lock:
+            cur = partition.db.cursor()
+            cur.execute(f"DELETE FROM fts_search_table WHERE rowid IN ({ids_expr})", (filenames_param,))
+            cur.execute(f"DELETE FROM vss_search_table WHERE rowid IN ({ids_expr})", (filenames_param,))
+            cur.execute("DELETE FROM content_table WHERE filename IN (SELECT value FROM json_each(?))", (filenames_param,))
+            cur.execute("DELETE FROM trigram_table WHERE filename IN (SELECT value FROM json_each(?))", (filenames_param,))
+            self.committer.written(partition.commit_idx, len(filenames))
 
     def insert_into_db(self, instance_id, filename, elem_name, parent_name, elem_type, display_level, content):
         """Insert an element into the database."""
-        content_embeddings = []
-        is_exact_only = exact_only([filename, elem_name]) or display_level == "full"
-        for split_idx, split_content in self.splitter.chunk_indices(content):
-            if is_exact_only:
-                embedding = []
-            else:
-                cache_key = f"{self.subsystem}_{instance_id}_{filename}_{parent_name}_{elem_name}_{elem_type}_{display_level}_{split_idx}"
-                embedding = LANGUAGE_MODEL.embed(split_content, cache_key=cache_key)
-            content_embeddings.append((split_idx, split_content, embedding))
+        elem = {
+            "filename": filename, "elem_name": elem_name, "parent_name": parent_name,
+            "elem_type": elem_type, "display_level": display_level, "content": content,
+        }
+        self.insert_many_into_db(instance_id, [elem])
+
+    def insert_many_into_db(self, instance_id, elems: t.List[t.Dict[str, t.Any]]):
+        """
+        Insert elements into the database.
+        Each element is a dict with the same fields as `insert_into_db`.
+        The chunks of all elements are embedded together.
+        """
+        # Split all the elements.
+        splits = []
+        for elem in elems:
+            filename, elem_name, parent_name = elem["filename"], elem["elem_name"], elem["parent_name"]
+            elem_type, display_level = elem["elem_type"], elem["display_level"]
+            is_exact_only = exact_only([filename, elem_name]) or display_level == "full"
+            for split_idx, split_content in self.splitter.chunk_indices(elem["content"]):
+                if is_exact_only:
+                    cache_key = None
+                else:
+                    cache_key = LANGUAGE_MODEL.embedding_cache_key(split_content)
+                splits.append((elem, is_exact_only, split_idx, split_content, cache_key))
+        self.vector_index.invalidate(self.partition_key(instance_id))
+        # Embed all the chunks at once. Chunks already embedded for any instance are not sent again.
+        to_embed = [i for i, split in enumerate(splits) if not split[1]]
+        embeddings = LANGUAGE_MODEL.embed_many([splits[i][3] for i in to_embed], [splits[i][4] for i in to_embed])
+        content_embeddings = [None for _ in splits]
+        for i, embedding in zip(to_embed, embeddings):
+            content_embeddings[i] = embedding
         insert_stmt = f"""
-            INSERT INTO content_table
-            (instance_id, filename, elem_name, parent_name, elem_type, display_level, split_idx, content, embedding)
+            INSERT OR IGNORE INTO content_table
+            (instance_id, filename, elem_name, parent_name, elem_type, display_level, split_idx, content)
             VALUES
-            (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            (?, ?, ?, ?, ?, ?, ?, ?)
             RETURNING id
         """.strip()
         embedding_stmt = f"INSERT INTO vss_search_table (rowid, embedding) VALUES (?, ?)"
         fts_stmt = f"INSERT INTO fts_search_table (rowid, filename, content) VALUES (?, ?, ?)"
-        db, db_lock = self._get_db(instance_id)
-        with db_lock:
-            try:
-                cur = db.cursor()
-                for split_idx, split_content, content_embedding in content_embeddings:
-                    cur.execute(
-                        insert_stmt,
-                        (instance_id, filename, elem_name, parent_name, elem_type, display_level, split_idx, split_content, json.dumps(content_embedding))
-                    )
-                    rowid = cur.fetchone()[0]
-                    print(f"Rowid: {rowid}")
-                    if not is_exact_only:
-                        cur.execute(embedding_stmt, (rowid, serialize(content_embedding)))
-                    cur.execute(fts_stmt, (rowid, filename, split_content))
-                db.commit()
-            except sqlite3.IntegrityError:
-                # Duplicate entry. Skip.
-                pass
+        partition = self._partition(instance_id)
+        with partition.lock:
+            cur = partition.db.cursor()
+            for (elem, is_exact_only, split_idx, split_content, _), content_embedding in zip(splits, content_embeddings):
+                filename = elem["filename"]
+                cur.execute(
+                    insert_stmt,
+                    (instance_id, filename, elem["elem_name"], elem["parent_name"], elem["elem_type"], elem["display_level"], split_idx, split_content)
+                )
+                row = cur.fetchone()
+                if row is None:
+                    # Duplicate entry. Skip only this chunk.
+                    continue
+                rowid = row[0]
+                if not is_exact_only:
+                    cur.execute(embedding_stmt, (rowid, serialize(content_embedding)))
+                cur.execute(fts_stmt, (rowid, index_tokens(filename), index_tokens(split_content)))
+            self.committer.written(partition.commit_idx, len(splits))
 
     
+    def insert_files(self, instance_id, files: t.Dict[str, str]):
+        """Insert whole files into the trigram index, for substring and regex search."""
+        partition = self._partition(instance_id)
+        with partition.lock:
+            cur = partition.db.cursor()
+            cur.executemany("INSERT INTO trigram_table (filename, content) VALUES (?, ?)", list(files.items()))
+            self.committer.written(partition.commit_idx, len(files))
+
+    def grep_search(self, instance_id, pattern: str, regex: bool = False, case_sensitive: bool = True, max_hits: int = 50, in_dirs=None):
+        """
+        Find lines containing a substring, or matching a regex, in the files of an instance.
+        Candidate files come from the trigram index. Returns hits as {"filename", "line" (1-indexed), "content"}.
+        """
+        flags = 0 if case_sensitive else re.IGNORECASE
+        matcher = re.compile(pattern if regex else re.escape(pattern), flags)
+        literals = regex_literals(pattern) if regex else [pattern]
+        literals = [literal for literal in literals if len(literal) >= MIN_TRIGRAM_LITERAL]
+        dir_expr, dir_params = self._make_dir_expr(in_dirs, table="trigram_table")
+        if len(literals) > 0:
+            # The trigram tokenizer matches phrases as case-insensitive substrings.
+            fts_query = " AND ".join(['"' + literal.replace('"', '""') + '"' for literal in literals])
+            get_files = f"SELECT filename, content FROM trigram_table WHERE trigram_table MATCH ? {dir_expr}"
+            params = [fts_query, *dir_params]
+        else:
+            get_files = f"SELECT filename, content FROM trigram_table WHERE TRUE {dir_expr}"
+            params = dir_params
+        partition = self._partition(instance_id)
+        with partition.lock:
+            cur = partition.db.cursor()
+            cur.execute(get_files, params)
+            files = cur.fetchall()
+        hits = []
+        for filename, content in sorted(files):
+            for line_idx, line in enumerate(content.split("\n")):
+                if matcher.search(line) is not None:
+                    hits.append({"filename": filename, "line": line_idx + 1, "content": line})
+                    if len(hits) >= max_hits:
+                        return hits
+        return hits
+
+    def _unmark_indexed(self, partition_key: str):
+        with self.catalog_lock:
+            self.catalog.execute("DELETE FROM indexed_partitions WHERE partition_key = ?", (partition_key,))
+            self.catalog.commit()
+
+    def reset_partition(self, instance_id):
+        """
+        Empty the partition of an instance, to index it again.
+        The partition stays open, so handles held by other instances of the same partition remain valid.
+        """
+        partition = self._partition(instance_id)
+        self._unmark_indexed(partition.key)
+        self.vector_index.invalidate(partition.key)
+        with partition.lock:
+            cur = partition.db.cursor()
+            for table in ["content_table", "fts_search_table", "vss_search_table", "trigram_table"]:
+                cur.execute(f"DELETE FROM {table}")
+            partition.db.commit()
+
     def cleanup(self, instance_id):
-        """Cleanup entries for a given instance."""
-        vss_delete = f"""
-            DELETE FROM vss_search_table WHERE rowid IN (SELECT id FROM content_table WHERE instance_id = ?)
-        """.strip()
-        fts_delete = f"""
-            DELETE FROM fts_search_table WHERE rowid IN (SELECT id FROM content_table WHERE instance_id = ?)
-        """.strip()
-        delete_stmt = f"""
-            DELETE FROM content_table WHERE instance_id = ?
-        """.strip()
-        db, db_lock = self._get_db(instance_id)
-        with db_lock:
-            cur = db.cursor()
-            cur.execute(vss_delete, (instance_id,))
-            cur.execute(fts_delete, (instance_id,))
-            cur.execute(delete_stmt, (instance_id,))
-            db.commit()
+        """Unregister an instance. Its partition is only dropped when no other registered instance uses it."""
+        partition_key = self.partition_key(instance_id)
+        with self.catalog_lock:
+            self.catalog.execute("DELETE FROM instance_partitions WHERE instance_id = ?", (instance_id,))
+            cur = self.catalog.cursor()
+            cur.execute("SELECT COUNT(*) FROM instance_partitions WHERE partition_key = ?", (partition_key,))
+            num_users = cur.fetchone()[0]
+            if num_users == 0:
+                self.catalog.execute("DELETE FROM indexed_partitions WHERE partition_key = ?", (partition_key,))
+            self.catalog.commit()
+        with self.partitions_lock:
+            self.partition_keys.pop(instance_id, None)
+            if num_users > 0:
+                return
+            partition = self.partitions.pop(partition_key, None)
+            self.partition_commits.pop(partition_key, None)
+        self.vector_index.invalidate(partition_key)
+        if partition is not None:
+            with partition.lock:
+                self.committer.remove(partition.commit_idx)
+                partition.db.close()
+        db_file = f"{self.partition_dir}/{partition_key}.db"
+        for path in [db_file, f"{db_file}-wal", f"{db_file}-shm"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def flush(self):
+        """Commit pending writes."""
+        self.committer.flush()
 
-    def _make_elem_type_expr(self, elem_type):
-        """Create an expression to filter for element types."""
+    def _make_elem_type_expr(self, elem_type, table: str = "content_table") -> t.Tuple[str, t.List[t.Any]]:
+        """
+        Create an expression to filter for element types, with its parameters.
+        Values are bound, lists through json_each, so the statement text only depends on which filters are used.
+        """
         if elem_type == "code":
-            code_expr = "AND elem_type NOT IN ('readme', 'other') AND filename NOT LIKE '%tests%'"
-        elif elem_type is not None:
-            if isinstance(elem_type, list):
-                elem_types = ", ".join([f"'{et}'" for et in elem_type])
-                code_expr = f"AND elem_type IN ({elem_types})"
-            else:
-                code_expr = f"AND elem_type = '{elem_type}'"
-        else:
-            code_expr = ""
-        return code_expr
-    
-    def _make_dir_expr(self, in_dirs):
-        """Create an expression to filter for directories."""
+            return f"AND {table}.elem_type IN (SELECT value FROM json_each(?)) AND {table}.filename NOT LIKE '%tests%'", [json.dumps(CODE_ELEM_TYPES)]
+        if elem_type is None:
+            return "", []
+        elem_types = elem_type if isinstance(elem_type, list) else [elem_type]
+        return f"AND {table}.elem_type IN (SELECT value FROM json_each(?))", [json.dumps(elem_types)]
+
+    def _dir_ranges(self, in_dirs) -> str:
+        """Filename ranges of directories, as a JSON list of [lo, hi) pairs. Unlike LIKE, '_' and '%' are not wildcards."""
+        dirs = in_dirs if isinstance(in_dirs, list) else [in_dirs]
+        return json.dumps([prefix_range(d) for d in dirs], ensure_ascii=False)
+
+    def _make_dir_expr(self, in_dirs, table: str = "content_table") -> t.Tuple[str, t.List[t.Any]]:
+        """Create an expression to filter for directories, with its parameters. Checked row by row."""
         if in_dirs is None:
-            return ""
-        if isinstance(in_dirs, list):
-            terms = [f"filename LIKE '{d}%'" for d in in_dirs]
-            terms = " OR ".join(terms)
-            dir_expr = f"AND ({terms})"
-        else:
-            dir_expr = f"AND filename LIKE '{in_dirs}%'"
-        return dir_expr
-    
+            return "", []
+        in_range = f"{table}.filename >= json_extract(dirs.value, '$[0]') AND {table}.filename < json_extract(dirs.value, '$[1]')"
+        return f"AND EXISTS (SELECT 1 FROM json_each(?) AS dirs WHERE {in_range})", [self._dir_ranges(in_dirs)]
+
+    def _filtered_ids(self, elem_type=None, in_dirs=None) -> t.Tuple[str, t.List[t.Any]]:
+        """
+        Statement selecting the content ids that pass the filters, with its parameters.
+        Ids are read from the covering indexes: the filename ranges of directories are searched one by one,
+        in the (elem_type, filename) index when element types are filtered too.
+        """
+        elem_type_expr, elem_type_params = self._make_elem_type_expr(elem_type)
+        if in_dirs is None:
+            return f"SELECT content_table.id FROM content_table WHERE TRUE {elem_type_expr}", elem_type_params
+        in_range = "content_table.filename >= json_extract(dirs.value, '$[0]') AND content_table.filename < json_extract(dirs.value, '$[1]')"
+        return (
+            f"SELECT content_table.id FROM json_each(?) AS dirs CROSS JOIN content_table ON {in_range} WHERE TRUE {elem_type_expr}",
+            [self._dir_ranges(in_dirs), *elem_type_params],
+        )
+
     def _dedup_results(self, results, num_results, dedup_by_file=False):
         """Deduplicate the results."""
         idxs = []
@@ -173,63 +471,152 @@ class TextSearch:
                 idxs.append(i)
         return [results[i] for i in idxs][:num_results]
         
+    def _instance_vectors(self, instance_id: str) -> t.Optional[InstanceVectors]:
+        """
+        Vectors of the partition of an instance. Built from the embedding cache on first use.
+        Returns None if some embeddings are not cached anymore, in which case sqlite-vss is used.
+        """
+        partition = self._partition(instance_id)
+        vectors = self.vector_index.get(partition.key)
+        if vectors is not None:
+            return vectors
+        get_rows = f"""
+            SELECT id, filename, elem_name, elem_type, display_level, content FROM content_table ORDER BY id
+        """.strip()
+        with partition.lock:
+            cur = partition.db.cursor()
+            cur.execute(get_rows)
+            rows = cur.fetchall()
+        # Same rows as the ones inserted in vss_search_table.
+        rows = [r for r in rows if not (exact_only([r[1], r[2]]) or r[4] == "full")]
+        if len(rows) == 0:
+            return None
+        embeddings = CACHE.get_embeddings([(LANGUAGE_MODEL.embedding_cache_key(r[5]), r[5]) for r in rows])
+        if any(embedding is None for embedding in embeddings):
+            print(f"Missing cached embeddings for {instance_id}. Using sqlite-vss.")
+            return None
+        return self.vector_index.save(
+            partition.key, np.stack(embeddings), [r[0] for r in rows], [r[1] for r in rows], [r[3] for r in rows],
+        )
+
     def approximate_search(self, instance_id: str, query: str, num_results=5, cache_key=None, elem_type=None, in_dirs=None, dedup_by_file=True):
         """Perform an approximate search."""
+        results = self._approximate_candidates(instance_id, query, num_results, cache_key, elem_type, in_dirs)
+        return self._dedup_results(results, num_results, dedup_by_file=dedup_by_file)
+
+    def _approximate_candidates(self, instance_id: str, query: str, num_results: int, cache_key=None, elem_type=None, in_dirs=None):
+        """Closest chunks to the query, before deduplication."""
         embedding = LANGUAGE_MODEL.embed(query.strip(), cache_key=cache_key)
-        elem_type_expr = self._make_elem_type_expr(elem_type)
-        dir_expr = self._make_dir_expr(in_dirs)
+        partition = self._instance_vectors(instance_id) if self.use_vector_index else None
+        if partition is None:
+            results = self._vss_search(instance_id, embedding, num_results, elem_type, in_dirs)
+        else:
+            matches = partition.top_k(embedding, 3*num_results, partition.filter_mask(elem_type, in_dirs))
+            results = self._fetch_matches(instance_id, matches)
+        results = [
+            {"filename": r[0], "elem_name": r[1], "parent_name": r[2], "elem_type": r[3], "split_idx": r[4], "content": r[5], "distance": r[6]}
+            for r in results
+        ]
+        return results
 
+    def _fetch_matches(self, instance_id: str, matches: t.List[t.Tuple[int, float]]):
+        """Rows of the matched content ids, with their distance, in order of distance."""
+        if len(matches) == 0:
+            return []
+        placeholders = ", ".join(["?"] * len(matches))
+        get_elems = f"""
+            SELECT id, filename, elem_name, parent_name, elem_type, split_idx, content FROM content_table WHERE id IN ({placeholders})
+        """.strip()
+        partition = self._partition(instance_id)
+        with partition.lock:
+            cur = partition.db.cursor()
+            cur.execute(get_elems, [match_id for match_id, _ in matches])
+            rows = {r[0]: r[1:] for r in cur.fetchall()}
+        return [(*rows[match_id], distance) for match_id, distance in matches if match_id in rows]
+
+    def _vss_search(self, instance_id: str, embedding: np.ndarray, num_results: int, elem_type=None, in_dirs=None):
+        """Approximate search through sqlite-vss."""
+        filtered_ids, filter_params = self._filtered_ids(elem_type, in_dirs)
         get_elems = f"""
             WITH matching_ids(match_id, distance) AS (
                 SELECT rowid, vss_distance_l1(embedding, ?) AS l1_distance FROM vss_search_table
-                WHERE rowid IN (SELECT id FROM content_table WHERE instance_id = ? {elem_type_expr} {dir_expr})
+                WHERE rowid IN ({filtered_ids})
                 ORDER BY l1_distance
-                LIMIT {3*num_results}
+                LIMIT ?
             )
             SELECT filename, elem_name, parent_name, elem_type, split_idx, content, distance FROM content_table, matching_ids WHERE id = match_id
             ORDER BY distance
         """.strip()
         print(get_elems)
-        db, db_lock = self._get_db(instance_id)
-        with db_lock:
-            cur = db.cursor()
-            cur.execute(get_elems, (serialize(embedding), instance_id))
-            results = cur.fetchall()
-        results = [
-            {"filename": r[0], "elem_name": r[1], "parent_name": r[2], "elem_type": r[3], "split_idx": r[4], "content": r[5], "distance": r[6]}
-            for r in results
-        ]
-        return self._dedup_results(results, num_results, dedup_by_file=dedup_by_file)
-        return results
+        partition = self._partition(instance_id)
+        with partition.lock:
+            cur = partition.db.cursor()
+            cur.execute(get_elems, [serialize(embedding), *filter_params, 3*num_results])
+            return cur.fetchall()
 
-    def _escape_fts_query(self, query: str):
-        # Replace punctuation with spaces.
-        query = query.translate(str.maketrans(string.punctuation, " " * len(string.punctuation)))
-        return query
+    def query_plan(self, instance_id: str, stmt: str, params: t.List[t.Any]) -> t.List[str]:
+        """Steps of the plan SQLite picks for a statement on the partition of an instance."""
+        partition = self._partition(instance_id)
+        with partition.lock:
+            cur = partition.db.cursor()
+            cur.execute(f"EXPLAIN QUERY PLAN {stmt}", params)
+            return [r[3] for r in cur.fetchall()]
 
+    def _make_fts_query(self, query: str, any_terms: bool = False):
+        """FTS query with the same code-aware normalization as the indexed content. Matches all terms, or any of them."""
+        tokens = query_tokens(query)
+        if any_terms:
+            return " OR ".join(tokens)
+        return " AND ".join(tokens)
 
-    def exact_search(self, instance_id, query, num_results=5, elem_type=None, in_dirs=None, dedup=True):
-        """Perform an exact search."""
-        query = self._escape_fts_query(query)
-        print(f"Query: {query}")
-        elem_type_expr = self._make_elem_type_expr(elem_type)
-        dir_expr = self._make_dir_expr(in_dirs)
+    def _exact_search_stmt(self, fts_query: str, num_results: int, elem_type=None, in_dirs=None) -> t.Tuple[str, t.List[t.Any]]:
+        """
+        Statement and parameters of an exact search.
+        Without directories, matches are filtered by joining them with their content rows. The join order is forced: a
+        `rowid IN (...)` constraint would be handed to FTS5, which then runs the MATCH once per content row.
+        Directories are selective, so their ids are read from the filename indexes first, and matches are checked against them
+        (the unary + keeps the check out of FTS5).
+        """
+        if in_dirs is None:
+            elem_type_expr, elem_type_params = self._make_elem_type_expr(elem_type)
+            get_elems = f"""
+                WITH matching_ids(match_id, distance) AS (
+                    SELECT content_table.id, bm25(fts_search_table) AS distance
+                    FROM fts_search_table CROSS JOIN content_table ON content_table.id = fts_search_table.rowid
+                    WHERE fts_search_table MATCH ? {elem_type_expr}
+                    ORDER BY distance
+                    LIMIT ?
+                )
+                SELECT filename, elem_name, parent_name, elem_type, split_idx, content, distance FROM content_table, matching_ids WHERE id = match_id
+            """.strip()
+            return get_elems, [fts_query, *elem_type_params, 3*num_results]
+        filtered_ids, filter_params = self._filtered_ids(elem_type, in_dirs)
         get_elems = f"""
-            WITH matching_ids(match_id, distance) AS (
-                SELECT rowid, bm25(fts_search_table) AS distance FROM fts_search_table
-                WHERE rowid IN (SELECT id FROM content_table WHERE instance_id = ? {elem_type_expr} {dir_expr})
-                AND fts_search_table MATCH ?
+            WITH filtered_ids(id) AS ({filtered_ids}),
+            matching_ids(match_id, distance) AS (
+                SELECT fts_search_table.rowid, bm25(fts_search_table) AS distance
+                FROM fts_search_table
+                WHERE fts_search_table MATCH ? AND +fts_search_table.rowid IN filtered_ids
                 ORDER BY distance
-                LIMIT {3*num_results}
+                LIMIT ?
             )
             SELECT filename, elem_name, parent_name, elem_type, split_idx, content, distance FROM content_table, matching_ids WHERE id = match_id
         """.strip()
+        return get_elems, [*filter_params, fts_query, 3*num_results]
+
+    def exact_search(self, instance_id, query, num_results=5, elem_type=None, in_dirs=None, dedup=True, any_terms=False):
+        """Perform an exact search."""
+        query = self._make_fts_query(query, any_terms=any_terms)
+        print(f"Query: {query}")
+        if len(query) == 0:
+            return []
+        get_elems, params = self._exact_search_stmt(query, num_results, elem_type, in_dirs)
         print(get_elems)
-        db, db_lock = self._get_db(instance_id)
-        with db_lock:
+        partition = self._partition(instance_id)
+        with partition.lock:
             try:
-                cur = db.cursor()
-                cur.execute(get_elems, (instance_id, query))
+                cur = partition.db.cursor()
+                cur.execute(get_elems, params)
                 results = cur.fetchall()
             except sqlite3.OperationalError as e:
                 is_fts5 = "fts5" in str(e)
@@ -246,5 +633,17 @@ class TextSearch:
             return self._dedup_results(results, num_results)
         return results
 
+    def hybrid_search(self, instance_id: str, query: str, num_results=5, cache_key=None, elem_type=None, in_dirs=None, dedup_by_file=True):
+        """
+        Perform both exact and approximate search with the same filters, and fuse their rankings with reciprocal rank fusion.
+        The distance of a fused result is its negated fused score, so lower is still better.
+        """
+        exact_future = self.search_pool.submit(self.exact_search, instance_id, query, num_results=num_results, elem_type=elem_type, in_dirs=in_dirs, dedup=False, any_terms=True)
+        approximate_future = self.search_pool.submit(self._approximate_candidates, instance_id, query, num_results, cache_key, elem_type, in_dirs)
+        fused, scores = reciprocal_rank_fusion([exact_future.result(), approximate_future.result()])
+        results = [{**r, "distance": -scores[key]} for key, r in fused.items()]
+        results.sort(key=lambda r: r["distance"])
+        return self._dedup_results(results, num_results, dedup_by_file=dedup_by_file)
+
 
 TEXT_SEARCH = TextSearch()
\ No newline at end of file
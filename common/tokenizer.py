@@ -0,0 +1,59 @@
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+import math
+import typing as t
+import tiktoken
+
+# Models with a public tiktoken encoding.
+TIKTOKEN_ENCODINGS = {
+    "gpt-4o": "o200k_base",
+    "text-embedding-3-large": "cl100k_base",
+}
+# Other models (Claude, Titan) have no client-side tokenizer. cl100k_base is used as a proxy, with a safety margin.
+PROXY_ENCODING = "cl100k_base"
+PROXY_MARGIN = 1.2
+
+
+class TokenCounter:
+    """Counts tokens with per-model tokenizers. Counts are cached by string hash."""
+    def __init__(self, max_cached: int = 100_000):
+        self.encodings: t.Dict[str, tiktoken.Encoding] = {}
+        self.max_cached = max_cached
+        self.counts: OrderedDict[t.Tuple[str, bytes], int] = OrderedDict()
+        self.lock = Lock()
+
+    def _encoding(self, name: str) -> tiktoken.Encoding:
+        if name not in self.encodings:
+            self.encodings[name] = tiktoken.get_encoding(name)
+        return self.encodings[name]
+
+    def _count(self, encoding_name: str, text: str) -> int:
+        key = (encoding_name, hashlib.blake2b(text.encode(), digest_size=16).digest())
+        with self.lock:
+            if key in self.counts:
+                self.counts.move_to_end(key)
+                return self.counts[key]
+        count = len(self._encoding(encoding_name).encode_ordinary(text))
+        with self.lock:
+            self.counts[key] = count
+            if len(self.counts) > self.max_cached:
+                self.counts.popitem(last=False)
+        return count
+
+    def count(self, text: str, model_id: str) -> int:
+        """Count the tokens of a text for the given model."""
+        if model_id in TIKTOKEN_ENCODINGS:
+            return self._count(TIKTOKEN_ENCODINGS[model_id], text)
+        return math.ceil(self._count(PROXY_ENCODING, text) * PROXY_MARGIN)
+
+    def truncate(self, text: str, max_tokens: int, model_id: str) -> str:
+        """Truncate a text to at most `max_tokens` tokens for the given model."""
+        if self.count(text, model_id) <= max_tokens:
+            return text
+        if model_id in TIKTOKEN_ENCODINGS:
+            encoding = self._encoding(TIKTOKEN_ENCODINGS[model_id])
+        else:
+            encoding = self._encoding(PROXY_ENCODING)
+            max_tokens = int(max_tokens / PROXY_MARGIN)
+        return encoding.decode(encoding.encode_ordinary(text)[:max_tokens])
@@ -0,0 +1,24 @@
+import numpy as np
+import typing as t
+
+# Blob layout: a one byte dtype tag, followed by the raw little-endian values.
+DTYPE_TAGS = {
+    "float32": b"f",
+    "float16": b"e",
+}
+TAG_DTYPES = {
+    b"f": np.dtype("<f4"),
+    b"e": np.dtype("<f2"),
+}
+
+
+def encode_vector(vector: t.Union[t.List[float], np.ndarray], dtype: str = "float32") -> bytes:
+    """Encode a vector as a binary blob."""
+    tag = DTYPE_TAGS[dtype]
+    return tag + np.asarray(vector, dtype=TAG_DTYPES[tag]).tobytes()
+
+
+def decode_vector(blob: bytes) -> np.ndarray:
+    """Decode a blob made by `encode_vector` into a float32 array."""
+    values = np.frombuffer(blob, dtype=TAG_DTYPES[blob[:1]], offset=1)
+    return values.astype(np.float32)
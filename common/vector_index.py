@@ -0,0 +1,124 @@
+from threading import Lock
+import numpy as np
+import typing as t
+import json
+import os
+
+# Element types of the "code" filter. The others are "readme" and "other".
+CODE_ELEM_TYPES = ["module", "function", "class", "method"]
+
+
+class InstanceVectors:
+    """
+    Embedded chunks of one instance: a memory-mapped matrix of vectors, and the content ids and metadata of its rows.
+    Filter masks are computed once per elem_type and directory prefix.
+    """
+    def __init__(self, vectors: np.ndarray, ids: t.List[int], filenames: t.List[str], elem_types: t.List[str]):
+        self.vectors = vectors
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.filenames = filenames
+        self.elem_types = np.asarray(elem_types, dtype=object)
+        self.masks: t.Dict[t.Tuple[str, str], np.ndarray] = {}
+        self.lock = Lock()
+
+    def _mask(self, kind: str, value: str) -> np.ndarray:
+        key = (kind, value)
+        with self.lock:
+            mask = self.masks.get(key)
+        if mask is not None:
+            return mask
+        if kind == "elem_type" and value == "code":
+            # Same as the "code" filter of TextSearch._make_elem_type_expr. SQLite's LIKE ignores ASCII case.
+            is_code = np.isin(self.elem_types, CODE_ELEM_TYPES)
+            not_tests = np.array(["tests" not in filename.lower() for filename in self.filenames], dtype=bool)
+            mask = is_code & not_tests
+        elif kind == "elem_type":
+            mask = self.elem_types == value
+        else:
+            mask = np.array([filename.startswith(value) for filename in self.filenames], dtype=bool)
+        with self.lock:
+            self.masks[key] = mask
+        return mask
+
+    def filter_mask(self, elem_type=None, in_dirs=None) -> np.ndarray:
+        """Rows passing the same filters as TextSearch's SQL expressions."""
+        mask = np.ones(len(self.filenames), dtype=bool)
+        if elem_type is not None:
+            elem_types = elem_type if isinstance(elem_type, list) else [elem_type]
+            type_mask = np.zeros_like(mask)
+            for et in elem_types:
+                type_mask |= self._mask("elem_type", et)
+            mask &= type_mask
+        if in_dirs is not None:
+            dirs = in_dirs if isinstance(in_dirs, list) else [in_dirs]
+            dir_mask = np.zeros_like(mask)
+            for d in dirs:
+                dir_mask |= self._mask("dir", d)
+            mask &= dir_mask
+        return mask
+
+    def top_k(self, query: np.ndarray, k: int, mask: np.ndarray) -> t.List[t.Tuple[int, float]]:
+        """Content ids and L1 distances of the `k` closest rows within the mask."""
+        candidates = np.flatnonzero(mask)
+        if len(candidates) == 0:
+            return []
+        distances = np.abs(self.vectors[candidates] - query).sum(axis=1)
+        if len(candidates) > k:
+            best = np.argpartition(distances, k)[:k]
+        else:
+            best = np.arange(len(candidates))
+        best = best[np.argsort(distances[best])]
+        return [(int(self.ids[candidates[i]]), float(distances[i])) for i in best]
+
+
+class VectorIndex:
+    """
+    Per-instance vector partitions, stored as .npy files and memory-mapped on first use.
+    Search cost only depends on the size of the instance, not of the whole db.
+    """
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        self.loaded: t.Dict[str, InstanceVectors] = {}
+        self.lock = Lock()
+
+    def _paths(self, instance_id: str) -> t.Tuple[str, str]:
+        base = f"{self.index_dir}/{instance_id}"
+        return f"{base}.npy", f"{base}.json"
+
+    def get(self, instance_id: str) -> t.Optional[InstanceVectors]:
+        """Load the partition of an instance, if it was saved."""
+        with self.lock:
+            if instance_id in self.loaded:
+                return self.loaded[instance_id]
+        vectors_path, meta_path = self._paths(instance_id)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        vectors = np.load(vectors_path, mmap_mode="r")
+        partition = InstanceVectors(vectors, meta["ids"], meta["filenames"], meta["elem_types"])
+        with self.lock:
+            self.loaded[instance_id] = partition
+        return partition
+
+    def save(self, instance_id: str, vectors: np.ndarray, ids: t.List[int], filenames: t.List[str], elem_types: t.List[str]) -> InstanceVectors:
+        """Save the partition of an instance. The metadata is written last, since its presence marks the partition as complete."""
+        vectors_path, meta_path = self._paths(instance_id)
+        with open(f"{vectors_path}.tmp", "wb") as f:
+            np.save(f, np.asarray(vectors, dtype=np.float32))
+        os.replace(f"{vectors_path}.tmp", vectors_path)
+        with open(f"{meta_path}.tmp", "w") as f:
+            json.dump({"ids": ids, "filenames": filenames, "elem_types": elem_types}, f)
+        os.replace(f"{meta_path}.tmp", meta_path)
+        with self.lock:
+            self.loaded.pop(instance_id, None)
+        return self.get(instance_id)
+
+    def invalidate(self, instance_id: str):
+        """Drop the partition of an instance, after its content changed."""
+        with self.lock:
+            self.loaded.pop(instance_id, None)
+        for path in self._paths(instance_id):
+            if os.path.exists(path):
+                os.remove(path)
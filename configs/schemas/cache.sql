@@ -1,10 +1,20 @@
-CREATE TABLE IF NOT EXISTS prompt_cache (
+-- Prompts are identified by their digest. The (compressed) prompt text is only kept for debugging.
+-- WITHOUT ROWID: a lookup by key is a single probe of the primary key B-tree.
+CREATE TABLE IF NOT EXISTS prompt_digest_cache (
     key TEXT PRIMARY KEY,
-    prompt TEXT NOT NULL,
+    prompt_digest BLOB NOT NULL,
+    prompt BLOB,
     value TEXT NOT NULL
-);
+) WITHOUT ROWID;
+
+-- Embeddings are binary vectors (see common/vector_codec.py), identified by the digest of the embedded text.
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    key TEXT PRIMARY KEY,
+    text_digest BLOB NOT NULL,
+    value BLOB NOT NULL
+) WITHOUT ROWID;
 
 CREATE TABLE IF NOT EXISTS object_cache (
     key TEXT PRIMARY KEY,
     value BLOB NOT NULL
-)
\ No newline at end of file
+)
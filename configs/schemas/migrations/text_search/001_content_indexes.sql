@@ -0,0 +1,4 @@
+-- Covering indexes for the search filters. The rowid is part of every index, so filtered ids are read from the index alone.
+-- Partitions hold a single (repo, base_commit), so instance_id is not needed as a leading column.
+CREATE INDEX IF NOT EXISTS content_elem_type_filename ON content_table (elem_type, filename);
+CREATE INDEX IF NOT EXISTS content_filename ON content_table (filename)
@@ -0,0 +1,3 @@
+-- Repo and commit of indexed partitions, to find a partition of the same repo to update incrementally.
+ALTER TABLE indexed_partitions ADD COLUMN repo TEXT;
+ALTER TABLE indexed_partitions ADD COLUMN base_commit TEXT
@@ -3,12 +3,20 @@ CREATE VIRTUAL TABLE IF NOT EXISTS vss_search_table USING vss0 (
     embedding(1024),
 );
 
+-- Columns hold code tokens (see common/code_tokens.py), not the raw text.
 CREATE VIRTUAL TABLE IF NOT EXISTS fts_search_table USING fts5 (
     filename, -- The filename of the code element.
     content, -- The code of the element.
 );
 
 
+-- Whole files, for substring and regex search.
+CREATE VIRTUAL TABLE IF NOT EXISTS trigram_table USING fts5 (
+    filename UNINDEXED,
+    content,
+    tokenize = 'trigram'
+);
+
 CREATE TABLE IF NOT EXISTS content_table (
     id INTEGER PRIMARY KEY,
     instance_id TEXT,
@@ -19,6 +27,6 @@ CREATE TABLE IF NOT EXISTS content_table (
     display_level TEXT,
     split_idx INTEGER,
     content TEXT,
-    content_with_lines TEXT,
-    embedding TEXT
+    content_with_lines TEXT
+    -- The embedding is only stored in vss_search_table, under the same rowid.
 )
\ No newline at end of file
@@ -0,0 +1,11 @@
+-- Search content is partitioned by (repo, base_commit). Instances at the same commit share a partition.
+CREATE TABLE IF NOT EXISTS instance_partitions (
+    instance_id TEXT PRIMARY KEY,
+    partition_key TEXT NOT NULL
+);
+
+-- Partitions whose content was fully inserted, and the version of the indexed format.
+CREATE TABLE IF NOT EXISTS indexed_partitions (
+    partition_key TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+)
@@ -1,7 +1,44 @@
 from common.handles import LANGUAGE_MODEL, TEXT_SEARCH
-from .module import SourceCodeIndex, CodeDisplayLevel, LineNumberMode
+from .module import SourceCodeIndex, CodeDisplayLevel, LineNumberMode, display_within_budget
+from .context_packer import ContextSnippet, PRIORITY_AUX
 import typing as t
+import asyncio
 import json
+import re
+
+# Token budgets for search results. Larger classes are shown at the signature level.
+CLASS_RESULT_MAX_TOKENS = 1250
+EXTRACTED_CLASS_MAX_TOKENS = 2500
+# Larger file sections are replaced by the module signature.
+FILE_RESULT_MAX_TOKENS = 5000
+# Number of fused text search results shown to the file filter, and most files extracted from after it.
+TEXT_SEARCH_NUM_RESULTS = 25
+TEXT_SEARCH_MAX_EXTRACTIONS = 4
+# Definitions found by grep, and how many lines of each are shown.
+GREP_MAX_RESULTS = 5
+GREP_RESULT_LINES = 40
+# Near-matches of a misspelled symbol name, with a similarity score between 0 and 1.
+FUZZY_MIN_SCORE = 0.75
+FUZZY_MAX_RESULTS = 5
+
+
+def enclosing_class(lines: t.List[str], line_idx: int) -> t.Optional[str]:
+    """Name of the innermost class around a line, found by indentation. None at module level."""
+    indent = len(lines[line_idx]) - len(lines[line_idx].lstrip())
+    for line in reversed(lines[:line_idx]):
+        stripped = line.lstrip()
+        if len(stripped) == 0 or stripped.startswith("#"):
+            continue
+        line_indent = len(line) - len(stripped)
+        if line_indent >= indent:
+            continue
+        match = re.match(r"class\s+(\w+)", stripped)
+        if match is not None:
+            return match.group(1)
+        if line_indent == 0:
+            return None
+        indent = line_indent
+    return None
 
 
 SYSTEM_MSG = """
@@ -218,32 +255,12 @@ class AuxiliarySearch:
         pass
 
     def perform_aux_search(self, code_index: SourceCodeIndex, additional_context: str=""):
-        search_queries = self.formulate_search_queries(code_index, additional_context)
-        print(search_queries)
-        best_search_results = []
-        for i, (reasoning, query) in enumerate(search_queries):
-            if self._is_query_exact(query):
-                results = self.try_exact_search(code_index, query, reasoning, i)
-            elif self._is_query_semantic(query):
-                results = self.try_text_search(code_index, query['semantic'], reasoning, i, approximate=True)
-            if len(results) == 0:
-                continue
-            if len(results) == 1:
-                best_index = 0
-            else:
-                best_index = self.quality_search_results(code_index, query, reasoning, i, results)
-                # if 'semantic' in query and 'infer' in query['semantic']:
-                #     exit(0)
-                best_index = best_index["index"]
-                if isinstance(best_index, list):
-                    best_index = best_index[0]
-            result = results[best_index]
-            print(f"Query {query}. Result file: {result[0]}. Result code:\n{result[1]}")
-            best_search_results.append(result)
-        aux = self.final_decision(code_index, best_search_results, additional_context)
+        return asyncio.run(self.aperform_aux_search(code_index, additional_context))
+
+    async def aperform_aux_search(self, code_index: SourceCodeIndex, additional_context: str=""):
+        aux_results = await self.select_aux_results(code_index, additional_context)
         final_aux_context = []
-        for r in aux:
-            filename, code = best_search_results[r["index"]]
+        for filename, code in aux_results:
             context = f"""
 ~~~~~
 Potentially helpful auxialliary information:
@@ -264,7 +281,48 @@ Here are auxiliary code snippets that you may be able to use in the fix:
 """.strip()
         return final_aux_context
 
-    def formulate_search_queries(self, code_index: SourceCodeIndex, additional_context: t.Optional[str] = None):
+    async def select_aux_results(self, code_index: SourceCodeIndex, additional_context: str="") -> t.List[t.Tuple[str, str]]:
+        """Search for auxiliary code. Returns the selected (filename, code) results."""
+        search_queries = await self.formulate_search_queries(code_index, additional_context)
+        print(search_queries)
+        # Queries are independent, so they are searched concurrently.
+        best_search_results = await asyncio.gather(*[
+            self.search_query(code_index, query, reasoning, i) for i, (reasoning, query) in enumerate(search_queries)
+        ])
+        best_search_results = [result for result in best_search_results if result is not None]
+        aux = await self.final_decision(code_index, best_search_results, additional_context)
+        return [best_search_results[r["index"]] for r in aux]
+
+    def aux_context_snippets(self, aux_results: t.List[t.Tuple[str, str]]) -> t.List[ContextSnippet]:
+        """Selected results as snippets for the context packer."""
+        return [
+            ContextSnippet.from_text(
+                "aux", PRIORITY_AUX, f"Potentially helpful auxialliary information:\nFrom Filename: {filename}\nAuxiliary Sub Content:",
+                code, filename=filename,
+            )
+            for filename, code in aux_results
+        ]
+
+    async def search_query(self, code_index: SourceCodeIndex, query: t.Dict[str, str], reasoning: str, query_idx: int):
+        """Perform a single search query. Returns the best result, if any."""
+        if self._is_query_exact(query):
+            results = await self.try_exact_search(code_index, query, reasoning, query_idx)
+        elif self._is_query_semantic(query):
+            results = await self.try_text_search(code_index, query['semantic'], reasoning, query_idx)
+        if len(results) == 0:
+            return None
+        if len(results) == 1:
+            best_index = 0
+        else:
+            best_index = await self.quality_search_results(code_index, query, reasoning, query_idx, results)
+            best_index = best_index["index"]
+            if isinstance(best_index, list):
+                best_index = best_index[0]
+        result = results[best_index]
+        print(f"Query {query}. Result file: {result[0]}. Result code:\n{result[1]}")
+        return result
+
+    async def formulate_search_queries(self, code_index: SourceCodeIndex, additional_context: t.Optional[str] = None):
         instance_id = code_index.dataset_item["instance_id"]
         issue = code_index.dataset_item["problem_statement"]
         repo = code_index.dataset_item["repo"]
@@ -280,7 +338,7 @@ End of Issue
 Your task: {SEARCH_FORMULATION_INSTRUCTIONS}
 """
         cache_key = f"auxiliary_search_{instance_id}"
-        response = LANGUAGE_MODEL.invoke(prompt, system_msg=SEARCH_FORMULATION_SYSTEM_MSG, cache_key=cache_key)
+        response = await LANGUAGE_MODEL.ainvoke(prompt, system_msg=SEARCH_FORMULATION_SYSTEM_MSG, cache_key=cache_key)
         reasons, codes, attrs = LANGUAGE_MODEL.parse_standard_response(response, code_tag="queries", code_lang="json")
         code = codes["queries"].strip()
         code = json.loads(code)
@@ -312,30 +370,71 @@ Your task: {SEARCH_FORMULATION_INSTRUCTIONS}
 
     def _find_exact_fn(self, code_index: SourceCodeIndex, fn_name: str):
         results = []
-        for filename, module in code_index.modules.items():
-            if fn_name in module.functions:
-                fn = module.display_function(fn_name, level=CodeDisplayLevel.MODERATE, line_mode=LineNumberMode.ENABLED)
-                results.append((filename, fn))
+        for symbol in code_index.symbols.lookup(fn_name, kind="function"):
+            module = code_index.modules[symbol.filename]
+            fn = module.display_function(fn_name, level=CodeDisplayLevel.MODERATE, line_mode=LineNumberMode.ENABLED)
+            results.append((symbol.filename, fn))
         return results
     
     def _find_exact_method(self, code_index: SourceCodeIndex, class_name: str, method_name: str):
         results = []
-        for filename, module in code_index.modules.items():
-            if class_name in module.classes and method_name in module.classes[class_name].methods:
-                method = module.display_method(class_name, method_name, level=CodeDisplayLevel.MODERATE, line_mode=LineNumberMode.ENABLED)
-                results.append((filename, method))
+        for symbol in code_index.symbols.lookup(method_name, kind="method", parent=class_name):
+            module = code_index.modules[symbol.filename]
+            method = module.display_method(class_name, method_name, level=CodeDisplayLevel.MODERATE, line_mode=LineNumberMode.ENABLED)
+            results.append((symbol.filename, method))
         return results
     
     def _find_exact_class(self, code_index: SourceCodeIndex, class_name: str):
         results = []
-        for filename, module in code_index.modules.items():
-            if class_name in module.classes:
-                klass = module.display_class(class_name, level=CodeDisplayLevel.MODERATE, line_mode=LineNumberMode.ENABLED)
-                if len(klass) > 5000:
-                    klass = module.display_class(class_name, level=CodeDisplayLevel.SIGNATURE, line_mode=LineNumberMode.ENABLED)
-                results.append((filename, klass))
+        for symbol in code_index.symbols.lookup(class_name, kind="class"):
+            module = code_index.modules[symbol.filename]
+            level, klass = display_within_budget(module.classes[class_name], [CodeDisplayLevel.MODERATE], CLASS_RESULT_MAX_TOKENS, LineNumberMode.ENABLED)
+            if level is None:
+                klass = module.display_class(class_name, level=CodeDisplayLevel.SIGNATURE, line_mode=LineNumberMode.ENABLED)
+            results.append((symbol.filename, klass))
         return results
     
+    def _fuzzy_symbols(self, code_index: SourceCodeIndex, name: str, kind: str):
+        """Symbols with the closest names to a name that does not exist, for when the model misspells it."""
+        matches = code_index.symbols.fuzzy_lookup(name, kind=kind, min_score=FUZZY_MIN_SCORE, max_results=FUZZY_MAX_RESULTS)
+        if len(matches) == 0:
+            return []
+        best_score = matches[0][1]
+        symbols = [symbol for symbol, score in matches if score == best_score]
+        print(f"Fuzzy matches for {name}: {[(symbol.parent, symbol.name, round(score, 2)) for symbol, score in matches]}")
+        # The same name in several files is displayed once per file by the exact lookups.
+        unique = {(symbol.name, symbol.parent): symbol for symbol in symbols}
+        return list(unique.values())
+
+    async def _grep_definitions(self, code_index: SourceCodeIndex, name: str, class_name: t.Optional[str] = None):
+        """
+        Definitions of a name anywhere in the code, including nested ones that modules do not list.
+        With a class name, only the definitions inside that class are kept, and only the files defining it are searched.
+        """
+        instance_id = code_index.dataset_item["instance_id"]
+        in_dirs = None
+        if class_name is not None:
+            class_pattern = rf"^\s*class\s+{re.escape(class_name)}\b"
+            class_hits = await asyncio.to_thread(TEXT_SEARCH.grep_search, instance_id, class_pattern, regex=True, max_hits=GREP_MAX_RESULTS)
+            # A filename is a prefix of itself.
+            in_dirs = sorted({hit["filename"] for hit in class_hits})
+            if len(in_dirs) == 0:
+                return []
+        pattern = rf"^\s*(async\s+def|def|class)\s+{re.escape(name)}\b"
+        hits = await asyncio.to_thread(TEXT_SEARCH.grep_search, instance_id, pattern, regex=True, max_hits=GREP_MAX_RESULTS, in_dirs=in_dirs)
+        results = []
+        for hit in hits:
+            if hit["filename"] not in code_index.modules:
+                continue
+            source_file = code_index.modules[hit["filename"]].source_file
+            line_start = hit["line"] - 1
+            if class_name is not None and enclosing_class(source_file.lines, line_start) != class_name:
+                continue
+            line_end = min(len(source_file.lines), line_start + GREP_RESULT_LINES)
+            content = source_file.display_content(source_file.lines[line_start:line_end], line_start, line_number_mode=LineNumberMode.ENABLED)
+            results.append((hit["filename"], content))
+        return results
+
     def _find_exact_file(self, code_index: SourceCodeIndex, filename: str, line_start: int, line_end: int):
         if filename not in code_index.modules:
             return []
@@ -346,7 +445,7 @@ Your task: {SEARCH_FORMULATION_INSTRUCTIONS}
             line_end = len(lines)
         line_end = min(len(lines), line_end + 10)
         content = module.source_file.display_content(lines[line_start:line_end], line_start, line_number_mode=LineNumberMode.ENABLED)
-        if len(content) > 20000:
+        if LANGUAGE_MODEL.count_tokens(content) > FILE_RESULT_MAX_TOKENS:
             content = module.display(level=CodeDisplayLevel.SIGNATURE, line_mode=LineNumberMode.ENABLED)
         return [(filename, content)]
 
@@ -366,8 +465,8 @@ Your task: {SEARCH_FORMULATION_INSTRUCTIONS}
         elif self._is_query_class(query):
             class_name = query["class_name"]
             if class_name in module.classes:
-                klass = module.display_class(class_name, level=CodeDisplayLevel.MODERATE, line_mode=LineNumberMode.ENABLED)
-                if len(klass) > 10000:
+                level, klass = display_within_budget(module.classes[class_name], [CodeDisplayLevel.MODERATE], EXTRACTED_CLASS_MAX_TOKENS, LineNumberMode.ENABLED)
+                if level is None:
                     klass = module.display_class(class_name, level=CodeDisplayLevel.SIGNATURE, line_mode=LineNumberMode.ENABLED)
                 return klass
         elif self._is_query_file(query):
@@ -378,23 +477,38 @@ Your task: {SEARCH_FORMULATION_INSTRUCTIONS}
         else:
             raise ValueError(f"Invalid extraction query type: {query}")
 
-    def try_exact_search(self, code_index: SourceCodeIndex, query: t.Dict[str, str], reasoning: str, query_idx: int):
+    async def try_exact_search(self, code_index: SourceCodeIndex, query: t.Dict[str, str], reasoning: str, query_idx: int):
         results = []
         alternative = None
         if self._is_query_fn(query):
             fn_name = query["fn_name"]
             results = self._find_exact_fn(code_index, fn_name)
+            if len(results) == 0:
+                results = await self._grep_definitions(code_index, fn_name)
+            if len(results) == 0:
+                for symbol in self._fuzzy_symbols(code_index, fn_name, kind="function"):
+                    results.extend(self._find_exact_fn(code_index, symbol.name))
             if len(results) == 0:
                 alternative = fn_name
         elif self._is_query_method(query):
             class_name = query["class_name"]
             method_name = query["method_name"]
             results = self._find_exact_method(code_index, class_name, method_name)
+            if len(results) == 0:
+                results = await self._grep_definitions(code_index, method_name, class_name=class_name)
+            if len(results) == 0:
+                for symbol in self._fuzzy_symbols(code_index, method_name, kind="method"):
+                    results.extend(self._find_exact_method(code_index, symbol.parent, symbol.name))
             if len(results) == 0:
                 alternative = f"{class_name} {method_name}"
         elif self._is_query_class(query):
             class_name = query["class_name"]
             results = self._find_exact_class(code_index, class_name)
+            if len(results) == 0:
+                results = await self._grep_definitions(code_index, class_name)
+            if len(results) == 0:
+                for symbol in self._fuzzy_symbols(code_index, class_name, kind="class"):
+                    results.extend(self._find_exact_class(code_index, symbol.name))
             if len(results) == 0:
                 alternative = class_name
         elif self._is_query_file(query):
@@ -405,19 +519,19 @@ Your task: {SEARCH_FORMULATION_INSTRUCTIONS}
             if len(results) == 0:
                 alternative = filename
         if len(results) == 0:
-            return self.try_text_search(code_index, alternative, reasoning, query_idx, approximate=False)
+            return await self.try_text_search(code_index, alternative, reasoning, query_idx)
         print(f"Relevant files: {results}")
         filenames = [filename for filename, _ in results]
-        filenames = self.file_filter(code_index, query, reasoning, query_idx, filenames)
+        filenames = await self.file_filter(code_index, query, reasoning, query_idx, filenames)
         print(f"Relevant files: {filenames}")
         filenames = set(filenames)
         results = [(filename, code) for filename, code in results if filename in filenames]
         if len(results) == 0:
-            return self.try_text_search(code_index, alternative, reasoning, query_idx, approximate=False)
+            return await self.try_text_search(code_index, alternative, reasoning, query_idx)
         return results
         
 
-    def file_filter(self, code_index: SourceCodeIndex, query: str, reasoning: str, query_idx: int, filenames: t.List[str]):
+    async def file_filter(self, code_index: SourceCodeIndex, query: str, reasoning: str, query_idx: int, filenames: t.List[str]):
         instance_id = code_index.dataset_item["instance_id"]
         issue = code_index.dataset_item["problem_statement"]
         repo = code_index.dataset_item["repo"]
@@ -440,14 +554,14 @@ Here a are the files I am considering for the search:
 Your task: {FILE_FILTER_INSTRUCTIONS}
 """
         cache_key = f"auxiliary_search_file_filter_{instance_id}_{query_idx}"
-        response = LANGUAGE_MODEL.invoke(prompt, system_msg=FILE_FILTER_SYSTEM_MSG, cache_key=cache_key)
+        response = await LANGUAGE_MODEL.ainvoke(prompt, system_msg=FILE_FILTER_SYSTEM_MSG, cache_key=cache_key)
         reasons, codes, attrs = LANGUAGE_MODEL.parse_standard_response(response, code_tag="files", code_lang="json")
         files = codes["files"].strip()
         files = json.loads(files)
         return files
     
 
-    def quality_search_results(self, code_index: SourceCodeIndex, query: str, reasoning: str, query_idx: int, results: t.List[t.Tuple[str, str]]):
+    async def quality_search_results(self, code_index: SourceCodeIndex, query: str, reasoning: str, query_idx: int, results: t.List[t.Tuple[str, str]]):
         instance_id = code_index.dataset_item["instance_id"]
         issue = code_index.dataset_item["problem_statement"]
         repo = code_index.dataset_item["repo"]
@@ -477,7 +591,7 @@ Query: {query}
 Your task: {RESULT_FILTER_INSTRUCTIONS}
 """
         cache_key = f"auxiliary_search_result_filter_{instance_id}_{query_idx}"
-        response = LANGUAGE_MODEL.invoke(prompt, system_msg=RESULT_FILTER_SYSTEM_MSG, cache_key=cache_key)
+        response = await LANGUAGE_MODEL.ainvoke(prompt, system_msg=RESULT_FILTER_SYSTEM_MSG, cache_key=cache_key)
         # if 'semantic' in query and 'infer' in query['semantic']:
         #     print(response)
         #     exit(0)
@@ -486,7 +600,7 @@ Your task: {RESULT_FILTER_INSTRUCTIONS}
         results = json.loads(results)
         return results
     
-    def extract_functionality(self, code_index: SourceCodeIndex, query: str, reasoning: str, query_idx: int, result: t.Dict[str, t.Any], result_idx: int):
+    async def extract_functionality(self, code_index: SourceCodeIndex, query: str, reasoning: str, query_idx: int, result: t.Dict[str, t.Any], result_idx: int):
         instance_id = code_index.dataset_item["instance_id"]
         issue = code_index.dataset_item["problem_statement"]
         repo = code_index.dataset_item["repo"]
@@ -513,14 +627,14 @@ Query: {query}
 Your task: {EXTRACTION_INSTRUCTIONS}
 """
         cache_key = f"auxiliary_search_extraction_{instance_id}_{query_idx}_{result_idx}"
-        response = LANGUAGE_MODEL.invoke(prompt, system_msg=EXTRACTION_SYSTEM_MSG, cache_key=cache_key)
+        response = await LANGUAGE_MODEL.ainvoke(prompt, system_msg=EXTRACTION_SYSTEM_MSG, cache_key=cache_key)
         reasons, codes, attrs = LANGUAGE_MODEL.parse_standard_response(response, code_tag="extractions", code_lang="json")
         extractions = codes["extractions"].strip()
         extractions = json.loads(extractions)
         extractions = [self._extract_in_file(code_index, filename, extraction['extract']) for extraction in extractions]
         return [extraction for extraction in extractions if extraction is not None]
     
-    def try_text_search(self, code_index: SourceCodeIndex, query: str, reasoning: str, query_idx: int, approximate: bool = True):
+    async def try_text_search(self, code_index: SourceCodeIndex, query: str, reasoning: str, query_idx: int):
         if any(["Function that" in q for q in (query, reasoning)]):
             elem_type = "function"
         elif any(["Class that" in q for q in (query, reasoning)]):
@@ -529,27 +643,27 @@ Your task: {EXTRACTION_INSTRUCTIONS}
             elem_type = "code"
         elem_type = "code"
         instance_id = code_index.dataset_item["instance_id"]
-        if approximate:
-            cache_key = f"auxiliary_search_query_{instance_id}_{query_idx}"
-            results = TEXT_SEARCH.approximate_search(instance_id, query=query, num_results=25, elem_type=elem_type, cache_key=cache_key, dedup_by_file=True)
-        else:
-            results = TEXT_SEARCH.exact_search(instance_id, query=query, num_results=10, elem_type="code")
+        # Fused exact and semantic ranking, then one file filter call. Only the best few kept files are extracted from.
+        cache_key = f"auxiliary_search_query_{instance_id}_{query_idx}"
+        results = await asyncio.to_thread(TEXT_SEARCH.hybrid_search, instance_id, query=query, num_results=TEXT_SEARCH_NUM_RESULTS, elem_type=elem_type, cache_key=cache_key, dedup_by_file=True)
         filenames = [result["filename"] for result in results]
         print(query)
         print(f"Pre-Relevant files: {filenames}")
-        filenames = self.file_filter(code_index, query, reasoning, query_idx, filenames)
+        filenames = await self.file_filter(code_index, query, reasoning, query_idx, filenames)
         print(f"Relevant files: {filenames}")
         filenames = set(filenames)
-        results = [result for result in results if result["filename"] in filenames]
+        results = [result for result in results if result["filename"] in filenames][:TEXT_SEARCH_MAX_EXTRACTIONS]
+        all_extractions = await asyncio.gather(*[
+            self.extract_functionality(code_index, query, reasoning, query_idx, result, i) for i, result in enumerate(results)
+        ])
         extracted_results = []
-        for i, result in enumerate(results):
-            extractions = self.extract_functionality(code_index, query, reasoning, query_idx, result, i)
+        for result, extractions in zip(results, all_extractions):
             print(f"Extractions: {extractions}")
             extracted_results.extend([(result['filename'], extraction) for extraction in extractions])
         print(f"Extracted Results: {extracted_results}")
         return extracted_results
     
-    def final_decision(self, code_index: SourceCodeIndex, results: t.List[t.Tuple[str, str]], additional_context: t.Optional[str] = None):
+    async def final_decision(self, code_index: SourceCodeIndex, results: t.List[t.Tuple[str, str]], additional_context: t.Optional[str] = None):
         instance_id = code_index.dataset_item["instance_id"]
         issue = code_index.dataset_item["problem_statement"]
         repo = code_index.dataset_item["repo"]
@@ -579,7 +693,7 @@ Here are the potential auxiliary codes:
 Your task: {FINAL_SELECTION_INSTRUCTIONS}
 """
         cache_key = f"auxiliary_search_final_selection_{instance_id}"
-        response = LANGUAGE_MODEL.invoke(prompt, system_msg=FINAL_SELECTION_SYSTEM_MSG, cache_key=cache_key)
+        response = await LANGUAGE_MODEL.ainvoke(prompt, system_msg=FINAL_SELECTION_SYSTEM_MSG, cache_key=cache_key)
         reasons, codes, attrs = LANGUAGE_MODEL.parse_standard_response(response, code_tag="selection", code_lang="json")
         selection = codes["selection"].strip()
         selection = json.loads(selection)
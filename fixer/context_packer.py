@@ -0,0 +1,186 @@
+from common.handles import LANGUAGE_MODEL
+from .module import CodeDisplayLevel, LineNumberMode, SourceFile
+from collections import namedtuple
+import typing as t
+import re
+
+# Line numbered content looks like "  12 |code".
+LINE_NUMBER_PATTERN = re.compile(r"^\s*(\d+) \|", re.MULTILINE)
+
+# One way of displaying a snippet.
+SnippetDisplay = namedtuple("SnippetDisplay", ["level", "render"])
+
+# Snippet priorities. Lower values are packed first.
+PRIORITY_FIX_SECTION = 0
+PRIORITY_AUX = 1
+PRIORITY_MODULE_OVERVIEW = 2
+PRIORITY_PUBLIC = 3
+
+
+def parse_line_range(content: str) -> t.Tuple[t.Optional[t.Tuple[int, int]], bool]:
+    """
+    Find the range of lines (0-indexed, end exclusive) shown in line numbered content.
+    Also returns whether the shown lines are contiguous.
+    """
+    line_nums = sorted(set(int(m.group(1)) for m in LINE_NUMBER_PATTERN.finditer(content)))
+    if len(line_nums) == 0:
+        return None, False
+    lo, hi = line_nums[0] - 1, line_nums[-1]
+    return (lo, hi), len(line_nums) == hi - lo
+
+
+class ContextSnippet:
+    """
+    A candidate piece of prompt context.
+    Snippets with lower priority values are packed first.
+    Displays are ordered from most to least detailed. The packer picks one of them.
+    """
+    def __init__(
+            self,
+            section: str,
+            priority: int,
+            header: str,
+            displays: t.List[SnippetDisplay],
+            filename: t.Optional[str] = None,
+            line_range: t.Optional[t.Tuple[int, int]] = None,
+            covers_lines: bool = False,
+            source_file: t.Optional[SourceFile] = None,
+        ):
+        self.section = section
+        self.priority = priority
+        self.header = header
+        self.displays = displays
+        self.filename = filename
+        # Lines of `filename` the snippet is about.
+        self.line_range = line_range
+        # Whether every line in `line_range` is shown. Other snippets showing those lines are then redundant.
+        self.covers_lines = covers_lines
+        # Set for plain line snippets, which can be trimmed to the lines not shown elsewhere.
+        self.source_file = source_file
+
+    @staticmethod
+    def from_lines(section: str, priority: int, header: str, filename: str, source_file: SourceFile, lo: int, hi: int) -> "ContextSnippet":
+        """Snippet showing lines [lo, hi) of a file."""
+        render = lambda: source_file.display_content(source_file.lines[lo:hi], lo, line_number_mode=LineNumberMode.ENABLED)
+        return ContextSnippet(
+            section, priority, header, [SnippetDisplay(None, render)],
+            filename=filename, line_range=(lo, hi), covers_lines=True, source_file=source_file,
+        )
+
+    @staticmethod
+    def from_element(section: str, priority: int, header: str, filename: str, elem: t.Any, levels: t.List[CodeDisplayLevel]) -> "ContextSnippet":
+        """Snippet showing a module, class or function at one of `levels`."""
+        displays = [SnippetDisplay(level, lambda level=level: elem.display(level, LineNumberMode.ENABLED)) for level in levels]
+        return ContextSnippet(section, priority, header, displays, filename=filename)
+
+    @staticmethod
+    def from_text(section: str, priority: int, header: str, content: str, filename: t.Optional[str] = None) -> "ContextSnippet":
+        """Snippet with fixed content. The line range is parsed from line numbers, if any."""
+        line_range, contiguous = parse_line_range(content) if filename is not None else (None, False)
+        return ContextSnippet(
+            section, priority, header, [SnippetDisplay(None, lambda: content)],
+            filename=filename, line_range=line_range, covers_lines=contiguous,
+        )
+
+
+class ContextPacker:
+    """Packs candidate snippets into a token budget."""
+    def __init__(self):
+        pass
+
+    def dedup(self, snippets: t.List[ContextSnippet]) -> t.List[ContextSnippet]:
+        """
+        Remove snippets whose lines are already shown by a higher priority snippet.
+        Line snippets that partially overlap are trimmed to their largest unshown part.
+        """
+        covered: t.Dict[str, t.List[t.Tuple[int, int]]] = {}
+        seen_contents = set()
+        deduped = []
+        for snippet in sorted(snippets, key=lambda s: s.priority):
+            if snippet.line_range is None and len(snippet.displays) == 1:
+                # Identical fixed snippets are redundant.
+                content_key = (snippet.filename, snippet.displays[0].render())
+                if content_key in seen_contents:
+                    continue
+                seen_contents.add(content_key)
+            if snippet.line_range is not None:
+                lo, hi = snippet.line_range
+                file_covered = covered.setdefault(snippet.filename, [])
+                uncovered = self._uncovered(lo, hi, file_covered)
+                if len(uncovered) == 0:
+                    continue
+                if snippet.source_file is not None and uncovered[0] != (lo, hi):
+                    lo, hi = max(uncovered, key=lambda r: r[1] - r[0])
+                    snippet = ContextSnippet.from_lines(snippet.section, snippet.priority, snippet.header, snippet.filename, snippet.source_file, lo, hi)
+                if snippet.covers_lines:
+                    file_covered.append((lo, hi))
+            deduped.append(snippet)
+        return deduped
+
+    def _uncovered(self, lo: int, hi: int, covered: t.List[t.Tuple[int, int]]) -> t.List[t.Tuple[int, int]]:
+        """Parts of [lo, hi) not in any of the covered ranges."""
+        parts = []
+        curr = lo
+        for c_lo, c_hi in sorted(covered):
+            if c_hi <= curr or c_lo >= hi:
+                continue
+            if c_lo > curr:
+                parts.append((curr, c_lo))
+            curr = max(curr, c_hi)
+        if curr < hi:
+            parts.append((curr, hi))
+        return parts
+
+    def pack(self, snippets: t.List[ContextSnippet], max_tokens: int) -> t.List[t.Tuple[ContextSnippet, str]]:
+        """
+        Choose which snippets to include, and at which display, to fill `max_tokens`.
+        First, snippets are added at their least detailed display, by priority.
+        Then, by priority, they are upgraded to the most detailed display that still fits.
+        Returns (snippet, text) pairs in priority order.
+        """
+        snippets = self.dedup(snippets)
+        rendered: t.Dict[t.Tuple[int, int], t.Tuple[str, int]] = {}
+        def render(i: int, d: int) -> t.Tuple[str, int]:
+            if (i, d) not in rendered:
+                snippet = snippets[i]
+                text = f"{snippet.header}\n{snippet.displays[d].render()}"
+                rendered[(i, d)] = (text, LANGUAGE_MODEL.count_tokens(text))
+            return rendered[(i, d)]
+        used = 0
+        chosen: t.Dict[int, int] = {}
+        for i, snippet in enumerate(snippets):
+            d = len(snippet.displays) - 1
+            _, num_tokens = render(i, d)
+            if used + num_tokens <= max_tokens:
+                chosen[i] = d
+                used += num_tokens
+        for i in chosen:
+            _, curr_tokens = render(i, chosen[i])
+            for d in range(chosen[i]):
+                _, num_tokens = render(i, d)
+                if used + num_tokens - curr_tokens <= max_tokens:
+                    used += num_tokens - curr_tokens
+                    chosen[i] = d
+                    break
+        print(f"Packed {len(chosen)}/{len(snippets)} snippets into {used}/{max_tokens} tokens.")
+        return [(snippets[i], render(i, d)[0]) for i, d in chosen.items()]
+
+    def format(self, packed: t.List[t.Tuple[ContextSnippet, str]], section_titles: t.Dict[str, str]) -> str:
+        """Format packed snippets, grouped by section in the order of `section_titles`."""
+        sections = []
+        for section, title in section_titles.items():
+            texts = [text for snippet, text in packed if snippet.section == section]
+            if len(texts) == 0:
+                continue
+            texts = "\n=======\n".join(texts)
+            sections.append(f"""
+=====================
+{title}
+=======
+{texts}
+=====================
+""".strip())
+        return "\n".join(sections)
+
+
+CONTEXT_PACKER = ContextPacker()
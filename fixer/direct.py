@@ -1,11 +1,13 @@
-from common.handles import LANGUAGE_MODEL, REPO
+from common.handles import LANGUAGE_MODEL, REPO, CACHE
 from fixer.module import make_code_index
 from fixer.public_search import PUBLIC_SEARCH
 from fixer.auxiliary_search import AUX_SEARCH
 from fixer.golden_retriever import GOLDEN_RETRIEVER
+from fixer.context_packer import CONTEXT_PACKER
 from datasets import load_dataset
 
 import typing as t
+import asyncio
 import time
 import json
 from enum import Enum
@@ -51,6 +53,12 @@ Here are some general tips:
     - When explicitly asked to, try to use the exact error message provided if any.
 """
 
+CONTEXT_SECTION_TITLES = {
+    "fix": "Here is the code that likely needs to be changed:",
+    "aux": "Here are auxiliary code snippets that you may be able to use in the fix:",
+    "public": "Here is auxiliary information from the internet:",
+}
+
 
 class DirectFixer:
     def __init__(self, specific_instance_ids=None, check_cache=True):
@@ -73,31 +81,44 @@ class DirectFixer:
         self.result_file = f"{working_stage}/direct_fixes.jsonl"
 
     def make_fix(self, instance_id: str):
+        return asyncio.run(self.amake_fix(instance_id))
+
+    async def amake_fix(self, instance_id: str):
         item = self.instance_items[instance_id]
         issue = item["problem_statement"]
         repo = item["repo"]
-        code_index = make_code_index(item, check_cache=self.check_cache)
-        fix_context = GOLDEN_RETRIEVER.retrieve_fix_context(code_index)
-        print(f"Fix context:\n{fix_context}")
-        aux_context = AUX_SEARCH.perform_aux_search(code_index)
-        print(f"Aux context:\n{aux_context}")
-        print(f"Fix context length: {len(fix_context)}")
-        print(f"Aux context length: {len(aux_context)}")
-        prompt = f"""
+        code_index = await asyncio.to_thread(make_code_index, item, check_cache=self.check_cache)
+        if LANGUAGE_MODEL.config["direct"].get("public_search", False):
+            aux_results, public_results = await asyncio.gather(
+                AUX_SEARCH.select_aux_results(code_index),
+                asyncio.to_thread(PUBLIC_SEARCH.perform_public_search, item),
+            )
+        else:
+            aux_results, public_results = await AUX_SEARCH.select_aux_results(code_index), []
+        snippets = GOLDEN_RETRIEVER.fix_context_snippets(code_index) + AUX_SEARCH.aux_context_snippets(aux_results) + PUBLIC_SEARCH.public_context_snippets(public_results)
+        make_prompt = lambda context: f"""
 Repository: {repo}
 ---
 Start of issue:
 {issue}
 End of issue.
 ---
-{fix_context}
-{aux_context}
+{context}
 ---
 
 Your task: {DIRECT_FIX_INSTRUCTIONS}
 """
+        # The context gets whatever the rest of the prompt leaves, up to the configured budget.
+        context_tokens = min(
+            LANGUAGE_MODEL.config["direct"]["context_tokens"],
+            LANGUAGE_MODEL.prompt_token_limit - LANGUAGE_MODEL.count_tokens(make_prompt("")) - LANGUAGE_MODEL.count_tokens(DIRECT_FIX_SYSTEM_MSG),
+        )
+        packed = CONTEXT_PACKER.pack(snippets, context_tokens)
+        context = CONTEXT_PACKER.format(packed, CONTEXT_SECTION_TITLES)
+        print(f"Context:\n{context}")
+        prompt = make_prompt(context)
         cache_key = f"direct_fix_{instance_id}"
-        response = LANGUAGE_MODEL.invoke(prompt, system_msg=DIRECT_FIX_SYSTEM_MSG, cache_key=cache_key)
+        response = await LANGUAGE_MODEL.ainvoke(prompt, system_msg=DIRECT_FIX_SYSTEM_MSG, cache_key=cache_key)
         print(f"Response:\n{response}")
         reasons, codes, attrs = LANGUAGE_MODEL.parse_standard_response(response, code_tag="patch", code_lang="diff")
         if len(codes) == 0:
@@ -107,10 +128,20 @@ Your task: {DIRECT_FIX_INSTRUCTIONS}
 
 
     def make_fixes(self):
-        with open(self.result_file, "w") as f:
-            for instance_id, item in self.instance_items.items():
-                patch = self.make_fix(instance_id)
-                patch = REPO.explore_valid_patch(item, patch)
+        asyncio.run(self.amake_fixes())
+
+    async def amake_fixes(self):
+        # Instances of the same repo share a checkout, so they are fixed one after the other.
+        # Different repos are fixed concurrently.
+        by_repo: t.Dict[str, t.List[str]] = {}
+        for instance_id, item in self.instance_items.items():
+            by_repo.setdefault(item["repo"], []).append(instance_id)
+        results: t.Dict[str, t.Dict[str, t.Any]] = {}
+        async def fix_repo(instance_ids: t.List[str]):
+            for instance_id in instance_ids:
+                item = self.instance_items[instance_id]
+                patch = await self.amake_fix(instance_id)
+                patch = await asyncio.to_thread(REPO.explore_valid_patch, item, patch)
                 if patch is not None:
                     test_file = f"working_stage/essai-fix-{instance_id}.patch"
                     with open(test_file, "w") as tf:
@@ -119,14 +150,22 @@ Your task: {DIRECT_FIX_INSTRUCTIONS}
                     patch = ""
                     raise ValueError(f"Fix for {instance_id} is None.")
                 print(f"Serializing {instance_id}:\n{patch}")
-                res = {
+                results[instance_id] = {
                     "instance_id": instance_id,
                     "model_patch": patch,
                     "model_name_or_path": LANGUAGE_MODEL.llm.value,
                 }
-                res = json.dumps(res)
-                f.write(res + "\n")
+        try:
+            await asyncio.gather(*[fix_repo(instance_ids) for instance_ids in by_repo.values()])
+        finally:
+            # Written once, in instance order, whatever order the repos finish in. Finished fixes are kept on failures.
+            with open(self.result_file, "w") as f:
+                for instance_id in self.instance_items:
+                    if instance_id in results:
+                        f.write(json.dumps(results[instance_id]) + "\n")
         print(f"Serialized fixes to {self.result_file}")
+        print(f"Rate limits: {json.dumps(LANGUAGE_MODEL.rate_limit_metrics(), indent=2)}")
+        print(f"Cache: {json.dumps(CACHE.metrics(), indent=2)}")
 
 
 
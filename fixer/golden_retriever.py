@@ -5,9 +5,15 @@ import os
 
 import unidiff.errors
 from common.handles import LANGUAGE_MODEL, REPO
-from fixer.module import SourceCodeIndex, CodeDisplayLevel, LineNumberMode
+from fixer.module import SourceCodeIndex, HighLevelModule, CodeDisplayLevel, LineNumberMode, display_within_budget
+from fixer.context_packer import ContextSnippet, PRIORITY_FIX_SECTION, PRIORITY_MODULE_OVERVIEW
 import typing as t
 
+# Token budget for the overview of a modified module.
+MODULE_SUMMARY_MAX_TOKENS = 5000
+# Lines shown before and after each hunk of the patch.
+HUNK_CONTEXT_LINES = 10
+
 
 
 class GoldenRetriever:
@@ -30,34 +36,39 @@ class GoldenRetriever:
         return fix_context
 
 
-    def read_source_patch(self, code_index: SourceCodeIndex) -> str:
+    def _patch_sections(self, code_index: SourceCodeIndex) -> t.List[t.Tuple[str, HighLevelModule, t.List[t.Tuple[int, int]]]]:
+        """Python files modified by the gold patch, with the line ranges of their hunks and some surrounding lines."""
         patch = unidiff.PatchSet(code_index.dataset_item["patch"])
-        retrieved_context = []
-        for p in patch.modified_files:                
+        sections = []
+        for p in patch.modified_files:
             file_path = p.source_file
             if file_path.startswith("a/"):
                 file_path = file_path[2:]
             if not file_path.endswith(".py"):
                 continue
             module = code_index.modules[file_path]
-            module_summary = module.display(level=CodeDisplayLevel.MODERATE, line_mode=LineNumberMode.ENABLED)
-            if len(module_summary) > 20000:
-                module_summary = module.display(level=CodeDisplayLevel.SIGNATURE, line_mode=LineNumberMode.ENABLED)
-            if len(module_summary) > 20000:
-                module_summary = ""
-            else:
+            num_lines = len(module.source_file.lines)
+            line_ranges = []
+            for hunk in p:
+                line_start = hunk.source_start - 1
+                line_end = line_start + hunk.source_length
+                line_ranges.append((max(0, line_start-HUNK_CONTEXT_LINES), min(num_lines, line_end+HUNK_CONTEXT_LINES)))
+            sections.append((file_path, module, line_ranges))
+        return sections
+
+    def read_source_patch(self, code_index: SourceCodeIndex) -> str:
+        retrieved_context = []
+        for file_path, module, line_ranges in self._patch_sections(code_index):
+            summary_levels = [CodeDisplayLevel.MODERATE, CodeDisplayLevel.SIGNATURE]
+            summary_level, module_summary = display_within_budget(module, summary_levels, MODULE_SUMMARY_MAX_TOKENS, LineNumberMode.ENABLED)
+            if summary_level is not None:
                 module_summary = f"""
 Here is an overview of the {file_path} file:
 {module_summary}                
 """.strip()
             module_subcontents = []
             module_lines = module.source_file.lines
-            for hunk in p:
-                line_start = hunk.source_start - 1
-                source_length = hunk.source_length
-                line_end = line_start + source_length
-                line_start = max(0, line_start-10)
-                line_end = min(len(module_lines), line_end+10)
+            for line_start, line_end in line_ranges:
                 sublines = module_lines[line_start:line_end]
                 subcontent = module.source_file.display_content(sublines, line_start, line_number_mode=LineNumberMode.ENABLED)
                 module_subcontents.append(f"""
@@ -76,6 +87,26 @@ Here is a relevant section of the {file_path} file. The bug is potentially in th
         retrieved_context = "\n".join(retrieved_context)
         return retrieved_context
     
+    def fix_context_snippets(self, code_index: SourceCodeIndex) -> t.List[ContextSnippet]:
+        """Same context as `read_source_patch`, as snippets for the context packer."""
+        try:
+            sections = self._patch_sections(code_index)
+        except unidiff.errors.UnidiffParseError as e:
+            print(f"Error parsing patch: {e}")
+            return []
+        snippets = []
+        for file_path, module, line_ranges in sections:
+            snippets.append(ContextSnippet.from_element(
+                "fix", PRIORITY_MODULE_OVERVIEW, f"Here is an overview of the {file_path} file:",
+                file_path, module, [CodeDisplayLevel.MODERATE, CodeDisplayLevel.SIGNATURE],
+            ))
+            for line_start, line_end in line_ranges:
+                snippets.append(ContextSnippet.from_lines(
+                    "fix", PRIORITY_FIX_SECTION, f"Here is a relevant section of the {file_path} file. The bug is potentially in this section:",
+                    file_path, module.source_file, line_start, line_end,
+                ))
+        return snippets
+
     def collect_stats(self, dataset_name, code_only=True):
         """Collect stats."""
         import datasets
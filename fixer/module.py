@@ -2,9 +2,13 @@ import ast
 from ast import iter_fields
 import os
 import typing as t
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from collections import namedtuple
 from enum import Enum
-from common.handles import TEXT_SEARCH, REPO, CACHE
+from common.handles import LANGUAGE_MODEL, TEXT_SEARCH, REPO, CACHE
+from fixer.symbol_table import SymbolTable
 
 # Comments to exclude from the display.
 EXCLUDE_COMMENTS = ["TODO", "FIXME"]
@@ -13,8 +17,17 @@ EXCLUDE_DIRS = [".git", ".github", "venv", "node_modules", "__pycache__"]
 # Extensions to exclude from the search.
 EXCLUDE_EXTS = [".pyc"]
 
+# Version of the parsed code index. Cached indices of another version are rebuilt.
+INDEXER_VERSION = 2
+# Number of files parsed per work unit when parsing in parallel.
+PARSE_CHUNK_SIZE = 32
+# Largest number of files changed since an indexed commit for which its text search partition is updated instead of rebuilt.
+MAX_INCREMENTAL_CHANGES = 500
+
 # Named tuple to represent a line index.
 LineIdx = namedtuple("LineIdx", ["line", "idx"])
+# Half-open range of 0-indexed lines of a source file, or None.
+LineRange = t.Optional[t.Tuple[int, int]]
 
 
 class CodeDisplayLevel(Enum):
@@ -36,13 +49,13 @@ def is_assignment(node: ast.AST):
 
 class SourceCodeIndex:
     """Represents an entire source code repository."""
-    def __init__(self, dataset_item: t.Dict[str, t.Any], modules, raw_files, dirs, repo_dir):
+    def __init__(self, dataset_item: t.Dict[str, t.Any], modules, raw_files, dirs, symbols: t.Optional[SymbolTable] = None):
         self.dataset_item = dataset_item
         self.instance_id = dataset_item["instance_id"]
         self.modules: t.Dict[str, HighLevelModule] = modules
         self.raw_files: t.Dict[str, str] = raw_files
         self.dirs = dirs
-        self.repo_dir = repo_dir
+        self.symbols = symbols if symbols is not None else SymbolTable.from_modules(modules)
 
     def get_dirs(self, prefix: t.Optional[str] = None, max_depth: int = 0):
         if prefix is None:
@@ -54,17 +67,81 @@ class SourceCodeIndex:
         return dirs
 
 class SourceFile:
-    """Represents a source file."""
+    """
+    Represents a source file. Its content is the only copy of its text: elements refer to it by line ranges.
+    Lines are split on first use, and are not pickled.
+    """
+    __slots__ = ("filename", "content", "line_padding", "_lines")
+
     def __init__(self, filename, content):
         self.filename = filename
         self.content = content
-        self.lines = content.split("\n")
-        self.stripped_lines = [line.strip() for line in self.lines]
-        self.line_idxs = [LineIdx(line, idx) for idx, line in enumerate(self.lines)]
-        self.stripped_lines_idxs = [LineIdx(line, idx) for idx, line in enumerate(self.stripped_lines)]
-        self.line_padding = len(str(len(self.lines)))
+        self.line_padding = len(str(content.count("\n") + 1))
+        self._lines = None
+
+    def __getstate__(self):
+        return {"filename": self.filename, "content": self.content, "line_padding": self.line_padding}
+
+    def __setstate__(self, state):
+        self.filename = state["filename"]
+        self.content = state["content"]
+        self.line_padding = state["line_padding"]
+        self._lines = None
+
+    @property
+    def lines(self) -> t.List[str]:
+        if self._lines is None:
+            self._lines = self.content.split("\n")
+        return self._lines
+
+    def text(self, line_range: LineRange) -> t.Optional[str]:
+        """Text of a range of lines."""
+        if line_range is None:
+            return None
+        lo, hi = line_range
+        return "\n".join(self.lines[lo:hi])
+
+    def display_range(self, line_range: LineRange, line_number_mode: LineNumberMode = LineNumberMode.ENABLED):
+        if line_range is None:
+            return ""
+        lo, hi = line_range
+        return self.display_content(self.lines[lo:hi], lo, line_number_mode)
+
+    def display_content(self, content, starting_line, line_number_mode: LineNumberMode = LineNumberMode.ENABLED):
+        if content is None:
+            return ""
+        line_num = starting_line + 1
+        if isinstance(content, str):
+            lines = content.split("\n")
+        else:
+            lines = content
+        output = []
+        for line in lines:
+            if line_number_mode == LineNumberMode.ENABLED:
+                line_num_str = str(line_num).rjust(self.line_padding)
+                output.append(f"{line_num_str} |{line}")
+            else:
+                output.append(line)
+            line_num += 1
+        return "\n".join(output) + "\n"
+    
+
+    def find_line_num(self, char_idx: int):
+        """Find the line number for a character index."""
+        curr_idx = 0
+        for idx, line in enumerate(self.lines):
+            curr_idx += len(line)
+            if curr_idx >= char_idx:
+                return idx
+
+
+class SourceParser:
+    """Finds the line ranges of the parts of AST nodes in a source file. Only used while parsing."""
+    def __init__(self, source_file: SourceFile):
+        self.source_file = source_file
+        self.stripped_lines_idxs = [LineIdx(line.strip(), idx) for idx, line in enumerate(source_file.lines)]
 
-    def parse_signature(self, node: ast.AST):
+    def parse_signature(self, node: ast.AST) -> LineRange:
         start_line = node.lineno
         ending = ":"
         segment = self.stripped_lines_idxs[start_line-1:]
@@ -75,23 +152,21 @@ class SourceFile:
                 break
         lo_idx = min(idxes)
         hi_idx = max(idxes)
-        return "\n".join(self.lines[lo_idx:hi_idx+1]), lo_idx
+        return lo_idx, hi_idx+1
     
-    def parse_full(self, node: ast.AST):
-        start_line = node.lineno
-        end_line = node.end_lineno
-        return "\n".join(self.lines[start_line-1:end_line]), (start_line-1)
+    def parse_full(self, node: ast.AST) -> LineRange:
+        return node.lineno-1, node.end_lineno
 
-    def parse_upper_comments(self, node: ast.AST):
+    def parse_upper_comments(self, node: ast.AST) -> LineRange:
         # Check for comments right above the node
         start_line = node.lineno
         if start_line <= 1:
-            return None, None
+            return None
         upper_segment = self.stripped_lines_idxs[:(start_line-1)]
         # Skip empty lines and decorators.
         upper_segment = [l for l in upper_segment if l.line != "" and not l.line.startswith("@")]
         if len(upper_segment) == 0:
-            return None, None
+            return None
         # If the last line is a comment, return contiguous comments
         idxs = []
         if upper_segment[-1].line.startswith("#"):
@@ -122,12 +197,12 @@ class SourceFile:
                 if starts_with_docstring(l.line):
                     break
         if len(idxs) == 0:
-            return None, None
+            return None
         lo_idx = min(idxs)
         hi_idx = max(idxs)
-        return "\n".join(self.lines[lo_idx:hi_idx+1]), lo_idx
+        return lo_idx, hi_idx+1
     
-    def parse_lower_comments(self, node: ast.AST):
+    def parse_lower_comments(self, node: ast.AST) -> LineRange:
         if isinstance(node, ast.Module):
             lower_segment = self.stripped_lines_idxs[0:]
         elif is_assignment(node):
@@ -147,7 +222,7 @@ class SourceFile:
         else:
             raise NotImplementedError(f"Cannot parse lower comments for node {node}.")
         if len(lower_segment) == 0:
-            return None, None
+            return None
         idxs = []
         # If the first line is a comment, return contiguous comments
         if lower_segment[0].line.startswith("#") and not is_assignment(node):
@@ -178,132 +253,146 @@ class SourceFile:
                 if ends_with_docstring(l.line):
                     break
         if len(idxs) == 0:
-            return None, None
+            return None
         lo_idx = min(idxs)
         hi_idx = max(idxs)
-        return "\n".join(self.lines[lo_idx:hi_idx+1]), lo_idx
+        return lo_idx, hi_idx+1
 
-    def display_content(self, content, starting_line, line_number_mode: LineNumberMode = LineNumberMode.ENABLED):
-        if content is None:
-            return ""
-        line_num = starting_line + 1
-        if isinstance(content, str):
-            lines = content.split("\n")
-        else:
-            lines = content
-        output = []
-        for line in lines:
-            if line.strip() == '7':
-                print("Line 7")
-                exit(0)
-            if line_number_mode == LineNumberMode.ENABLED:
-                line_num_str = str(line_num).rjust(self.line_padding)
-                output.append(f"{line_num_str} |{line}")
-            else:
-                output.append(line)
-            line_num += 1
-        return "\n".join(output) + "\n"
-    
-
-    def find_line_num(self, char_idx: int):
-        """Find the line number for a character index."""
-        curr_idx = 0
-        for l in self.line_idxs:
-            curr_idx += len(l.line)
-            if curr_idx >= char_idx:
-                return l.idx
 
 class HighLevelFunction:
     """Represents a top level class or methods"""
-    def __init__(self, node: ast.FunctionDef, source_file: SourceFile, parent_class=None):
-        self.node = node
-        self.source_file = source_file
+    __slots__ = ("name", "source_file", "parent_class", "line_start", "line_end", "upper_comments_range", "lower_comments_range", "signature_range")
+
+    def __init__(self, node: ast.FunctionDef, parser: SourceParser, parent_class=None):
+        self.name = node.name
+        self.source_file = parser.source_file
         self.parent_class = parent_class
-        self.upper_comments, self.upper_comments_line = source_file.parse_upper_comments(node)
-        self.lower_comments, self.lower_comments_line = source_file.parse_lower_comments(node)
-        self.signature, self.signature_line = source_file.parse_signature(node)
-        self.full, self.full_line = source_file.parse_full(node)
+        # 1-indexed and inclusive, as in the AST.
+        self.line_start, self.line_end = node.lineno, node.end_lineno
+        self.upper_comments_range = parser.parse_upper_comments(node)
+        self.lower_comments_range = parser.parse_lower_comments(node)
+        self.signature_range = parser.parse_signature(node)
+
+    @property
+    def full_range(self) -> LineRange:
+        return self.line_start-1, self.line_end
+
+    @property
+    def signature(self) -> str:
+        return self.source_file.text(self.signature_range)
+
+    @property
+    def full(self) -> str:
+        return self.source_file.text(self.full_range)
     
     def display(self, level: CodeDisplayLevel, line_mode: LineNumberMode = LineNumberMode.ENABLED) -> str:
-        signature = self.source_file.display_content(self.signature, self.signature_line, line_mode)
+        signature = self.source_file.display_range(self.signature_range, line_mode)
         if level == CodeDisplayLevel.SIGNATURE:
             return signature
         elif level in [CodeDisplayLevel.MINIMAL, CodeDisplayLevel.MODERATE]:
-            upper = self.source_file.display_content(self.upper_comments, self.upper_comments_line, line_mode)
-            signature = self.source_file.display_content(self.signature, self.signature_line, line_mode)
-            lower = self.source_file.display_content(self.lower_comments, self.lower_comments_line, line_mode)
+            upper = self.source_file.display_range(self.upper_comments_range, line_mode)
+            lower = self.source_file.display_range(self.lower_comments_range, line_mode)
             return f"{upper}{signature}{lower}"
         elif level == CodeDisplayLevel.FULL:
-            upper = self.source_file.display_content(self.upper_comments, self.upper_comments_line, line_mode)
-            full = self.source_file.display_content(self.full, self.full_line, line_mode)
+            upper = self.source_file.display_range(self.upper_comments_range, line_mode)
+            full = self.source_file.display_range(self.full_range, line_mode)
             return f"{upper}{full}"
 
 
 class HighLevelAssignment:
     """Represents a top level or class constant assignment."""
-    def __init__(self, node: t.Union[ast.Assign, ast.AnnAssign], source_file: SourceFile):
-        self.node = node
-        self.target = node.targets[0] if isinstance(node, ast.Assign) else node.target
-        self.source_file = source_file
-        self.upper_comments, self.upper_comments_line = source_file.parse_upper_comments(node)
-        self.lower_comments, self.lower_comments_line = source_file.parse_lower_comments(node)
-        self.full, self.full_line = source_file.parse_full(node)
+    __slots__ = ("name", "source_file", "full_range", "upper_comments_range", "lower_comments_range")
+
+    def __init__(self, node: t.Union[ast.Assign, ast.AnnAssign], parser: SourceParser):
+        target = node.targets[0] if isinstance(node, ast.Assign) else node.target
+        self.name = target.id
+        self.source_file = parser.source_file
+        self.upper_comments_range = parser.parse_upper_comments(node)
+        self.lower_comments_range = parser.parse_lower_comments(node)
+        self.full_range = parser.parse_full(node)
+
+    @property
+    def full(self) -> str:
+        return self.source_file.text(self.full_range)
 
     def display(self, level: CodeDisplayLevel, line_mode: LineNumberMode = LineNumberMode.ENABLED) -> str:
-        full = self.source_file.display_content(self.full, self.full_line, line_mode)
+        full = self.source_file.display_range(self.full_range, line_mode)
         if level == CodeDisplayLevel.SIGNATURE:
             return full
-        upper_comments = self.source_file.display_content(self.upper_comments, self.upper_comments_line, line_mode)
-        lower_comments = self.source_file.display_content(self.lower_comments, self.lower_comments_line, line_mode)
+        upper_comments = self.source_file.display_range(self.upper_comments_range, line_mode)
+        lower_comments = self.source_file.display_range(self.lower_comments_range, line_mode)
         return f"{upper_comments}{full}{lower_comments}"
 
 
 class HighLevelImport:
     """Represents a top level import"""
-    def __init__(self, node: t.Union[ast.Import, ast.ImportFrom], source_file: SourceFile):
-        self.node = node
-        self.source_file = source_file
-        self.full, self.full_line = source_file.parse_full(node)
+    __slots__ = ("source_file", "full_range")
+
+    def __init__(self, node: t.Union[ast.Import, ast.ImportFrom], parser: SourceParser):
+        self.source_file = parser.source_file
+        self.full_range = parser.parse_full(node)
+
+    @property
+    def full(self) -> str:
+        return self.source_file.text(self.full_range)
 
     def display(self, level: CodeDisplayLevel, line_mode: LineNumberMode = LineNumberMode.ENABLED) -> str:
-        return self.source_file.display_content(self.full, self.full_line, line_mode)
+        return self.source_file.display_range(self.full_range, line_mode)
 
 class HighLevelClass:
     """Represents a top level class"""
-    def __init__(self, node: ast.ClassDef, source_file: SourceFile):
-        self.node = node
-        self.source_file = source_file
+    # Weak references are needed for DISPLAY_TOKENS.
+    __slots__ = (
+        "name", "source_file", "methods", "constants", "ordering", "line_start", "line_end",
+        "upper_comments_range", "lower_comments_range", "signature_range", "__weakref__",
+    )
+
+    def __init__(self, node: ast.ClassDef, parser: SourceParser):
+        self.name = node.name
+        self.source_file = parser.source_file
         self.methods: t.Dict[str, HighLevelFunction] = {}
         self.constants: t.Dict[str, HighLevelAssignment] = {}
         self.ordering: t.List[t.Any] = []
-        self.upper_comments, self.upper_comments_line = source_file.parse_upper_comments(node)
-        self.lower_comments, self.lower_comments_line = source_file.parse_lower_comments(node)
-        self.signature, self.signature_line = source_file.parse_signature(node)
-        self.full, self.full_lines = source_file.parse_full(node)
-    
-
-    def add_method(self, node: ast.FunctionDef):
-        # print(f"Adding method {node.name} to class {self.node.name}.")
-        h = HighLevelFunction(node, self.source_file, parent_class=self.node.name)
+        # 1-indexed and inclusive, as in the AST.
+        self.line_start, self.line_end = node.lineno, node.end_lineno
+        self.upper_comments_range = parser.parse_upper_comments(node)
+        self.lower_comments_range = parser.parse_lower_comments(node)
+        self.signature_range = parser.parse_signature(node)
+
+    @property
+    def full_range(self) -> LineRange:
+        return self.line_start-1, self.line_end
+
+    @property
+    def signature(self) -> str:
+        return self.source_file.text(self.signature_range)
+
+    @property
+    def full(self) -> str:
+        return self.source_file.text(self.full_range)
+
+    def add_method(self, node: ast.FunctionDef, parser: SourceParser):
+        # print(f"Adding method {node.name} to class {self.name}.")
+        h = HighLevelFunction(node, parser, parent_class=self.name)
         self.methods[node.name] = h
         self.ordering.append(h)
 
-    def add_constant(self, node: t.Union[ast.Assign, ast.AnnAssign]):
+    def add_constant(self, node: t.Union[ast.Assign, ast.AnnAssign], parser: SourceParser):
         target = node.targets[0] if isinstance(node, ast.Assign) else node.target
         assert isinstance(target, ast.Name)
-        # print(f"Adding constant {target.id} to class {self.node.name}.")
-        h = HighLevelAssignment(node, self.source_file)
+        # print(f"Adding constant {target.id} to class {self.name}.")
+        h = HighLevelAssignment(node, parser)
         self.constants[target.id] = h
         self.ordering.append(h)
 
 
     def display(self, level: CodeDisplayLevel, line_mode: LineNumberMode = LineNumberMode.ENABLED):
-        upper = self.source_file.display_content(self.upper_comments, self.upper_comments_line, line_mode)
+        upper = self.source_file.display_range(self.upper_comments_range, line_mode)
         if level == CodeDisplayLevel.FULL:
-            full = self.source_file.display_content(self.full, self.full_lines, line_mode)
+            full = self.source_file.display_range(self.full_range, line_mode)
             return f"{upper}{full}"
-        class_signature = self.source_file.display_content(self.signature, self.signature_line, line_mode)
-        lower = self.source_file.display_content(self.lower_comments, self.lower_comments_line, line_mode)  
+        class_signature = self.source_file.display_range(self.signature_range, line_mode)
+        lower = self.source_file.display_range(self.lower_comments_range, line_mode)
         children = [child.display(level, line_mode) for child in self.ordering]
         children = "\n".join(children) + "\n"
         if level == CodeDisplayLevel.SIGNATURE:
@@ -315,6 +404,9 @@ class HighLevelClass:
 
 
 class HighLevelModule:
+    # Weak references are needed for DISPLAY_TOKENS.
+    __slots__ = ("source_file", "functions", "classes", "constants", "imports", "ordering", "module_comments_range", "__weakref__")
+
     def __init__(self, filename, content):
         self.source_file = SourceFile(filename, content)
         self.functions: t.Dict[str, HighLevelFunction] = {}
@@ -322,38 +414,42 @@ class HighLevelModule:
         self.constants = {}
         self.imports = []
         self.ordering: t.List[t.Any] = []
-        self.module_comments, self.module_comments_line = None, None
+        self.module_comments_range: LineRange = None
 
-    def add_function(self, node: ast.FunctionDef):
+    @property
+    def module_comments(self) -> t.Optional[str]:
+        return self.source_file.text(self.module_comments_range)
+
+    def add_function(self, node: ast.FunctionDef, parser: SourceParser):
         # print(f"Adding function {node.name}.")
-        h = HighLevelFunction(node, self.source_file)
+        h = HighLevelFunction(node, parser)
         self.functions[node.name] = h
         self.ordering.append(h)
 
-    def add_class(self, node: ast.ClassDef):
+    def add_class(self, node: ast.ClassDef, parser: SourceParser):
         # print(f"Adding class {node.name}.")
-        h = HighLevelClass(node, self.source_file)
+        h = HighLevelClass(node, parser)
         self.classes[node.name] = h
         self.ordering.append(h)
 
-    def add_constant(self, node: t.Union[ast.Assign, ast.AnnAssign]):
+    def add_constant(self, node: t.Union[ast.Assign, ast.AnnAssign], parser: SourceParser):
         target = node.targets[0] if isinstance(node, ast.Assign) else node.target
         assert isinstance(target, ast.Name)
         # print(f"Adding constant {target.id}.")
-        h = HighLevelAssignment(node, self.source_file)
+        h = HighLevelAssignment(node, parser)
         self.constants[target.id] = h
         self.ordering.append(h)
 
-    def add_import(self, node: ast.Import):
+    def add_import(self, node: ast.Import, parser: SourceParser):
         # print(f"Adding import: {node}")
-        h = HighLevelImport(node, self.source_file)
+        h = HighLevelImport(node, parser)
         self.imports.append(h)
         self.ordering.append(h)
 
     def display(self, level: CodeDisplayLevel, line_mode: LineNumberMode = LineNumberMode.ENABLED):
         if level == CodeDisplayLevel.FULL:
-            return self.source_file.display_content(self.source_file.content, 0, line_mode)
-        upper = self.source_file.display_content(self.module_comments, self.module_comments_line, line_mode)
+            return self.source_file.display_content(self.source_file.lines, 0, line_mode)
+        upper = self.source_file.display_range(self.module_comments_range, line_mode)
         children = [child.display(level, line_mode) for child in self.ordering]
         children = "\n".join(children) + "\n"
         if level == CodeDisplayLevel.MINIMAL:
@@ -384,6 +480,24 @@ class HighLevelModule:
     
 
 
+# Token counts of displayed elements, by (display level, line mode).
+# Levels already known to exceed a budget are skipped without re-rendering them.
+DISPLAY_TOKENS: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+def display_within_budget(elem, levels: t.List[CodeDisplayLevel], max_tokens: int, line_mode: LineNumberMode = LineNumberMode.ENABLED) -> t.Tuple[t.Optional[CodeDisplayLevel], str]:
+    """Display a module or class at the first of `levels` that fits in `max_tokens`. Returns (None, "") if none fits."""
+    token_counts = DISPLAY_TOKENS.setdefault(elem, {})
+    for level in levels:
+        key = (level, line_mode)
+        if key in token_counts and token_counts[key] > max_tokens:
+            continue
+        content = elem.display(level, line_mode)
+        token_counts[key] = LANGUAGE_MODEL.count_tokens(content)
+        if token_counts[key] <= max_tokens:
+            return level, content
+    return None, ""
+
+
 class HighLevelVisitor(ast.NodeVisitor):
     def __init__(self, filename, content):
         self.is_top_level = False
@@ -391,6 +505,7 @@ class HighLevelVisitor(ast.NodeVisitor):
         self.filename = filename
         self.content = content
         self.top_level_module = HighLevelModule(filename, content)
+        self.parser = SourceParser(self.top_level_module.source_file)
 
 
     def custom_visit(self, node, top_level=False, parent_class=None):
@@ -419,9 +534,9 @@ class HighLevelVisitor(ast.NodeVisitor):
             self.custom_generic_visit(node)
             return
         if self.is_top_level:
-            self.top_level_module.add_function(node)
+            self.top_level_module.add_function(node, self.parser)
         elif self.current_class is not None:
-            self.current_class.add_method(node)
+            self.current_class.add_method(node, self.parser)
         self.custom_generic_visit(node)
 
     def visit_ClassDef(self, node: ast.ClassDef) -> t.Any:
@@ -430,13 +545,13 @@ class HighLevelVisitor(ast.NodeVisitor):
             # Irrelevant for us.
             self.custom_generic_visit(node)
             return
-        self.top_level_module.add_class(node)
+        self.top_level_module.add_class(node, self.parser)
         parent_class = self.top_level_module.classes[node.name]
         self.custom_generic_visit(node, parent_class=parent_class)
 
     def visit_Module(self, node: ast.Module) -> t.Any:
         # print("Visiting module")
-        self.top_level_module.module_comments, self.top_level_module.module_comments_line = self.top_level_module.source_file.parse_lower_comments(node)
+        self.top_level_module.module_comments_range = self.parser.parse_lower_comments(node)
         self.custom_generic_visit(node, top_level=True)
 
     def visit_assignment(self, node: t.Union[ast.Assign, ast.AnnAssign]) -> t.Any:
@@ -450,9 +565,9 @@ class HighLevelVisitor(ast.NodeVisitor):
             self.custom_generic_visit(node)
             return
         if self.is_top_level:
-            self.top_level_module.add_constant(node)
+            self.top_level_module.add_constant(node, self.parser)
         elif self.current_class is not None:
-            self.current_class.add_constant(node)
+            self.current_class.add_constant(node, self.parser)
         self.custom_generic_visit(node)
 
     def visit_Assign(self, node: ast.Assign) -> t.Any:
@@ -468,7 +583,7 @@ class HighLevelVisitor(ast.NodeVisitor):
             # Not relevant for us.
             self.custom_generic_visit(node)
             return
-        self.top_level_module.add_import(node)
+        self.top_level_module.add_import(node, self.parser)
         self.custom_generic_visit(node)
 
     def visit_ImportFrom(self, node: ast.ImportFrom) -> t.Any:
@@ -477,7 +592,7 @@ class HighLevelVisitor(ast.NodeVisitor):
             # Not relevant for us.
             self.custom_generic_visit(node)
             return
-        self.top_level_module.add_import(node)
+        self.top_level_module.add_import(node, self.parser)
         self.custom_generic_visit(node)
 
 
@@ -527,40 +642,156 @@ def list_dirs(dir):
     return dirs
 
 
+def parse_file(f: str, repo_target: str) -> t.Optional[t.Tuple[str, t.Optional[HighLevelModule], t.Optional[str]]]:
+    """Parse a file of a repo. Returns its name within the repo and either its module or its raw content, or None to skip it."""
+    nice_filename = f.replace(repo_target, "")
+    try:
+        if f.endswith(".py"):
+            module = make_module(f)
+            if module is not None:
+                return nice_filename, module, None
+            with open(f, "r") as file:
+                return nice_filename, None, file.read()
+        if not "README" in f:
+            # TODO: Figure out how to handle non-python and non-readme files.
+            return None
+        with open(f, "r") as file:
+            return nice_filename, None, file.read()
+    except UnicodeError:
+        # Skip files that can't be read as text.
+        return None
+
+
+def parse_files(files: t.List[str], repo_target: str):
+    """Parse a chunk of files. Runs in worker processes, so the results are picklable."""
+    results = []
+    for f in files:
+        result = parse_file(f, repo_target)
+        if result is not None:
+            results.append(result)
+    return results
+
+
+def parsed_file_cache_key(f: str, blob_sha: str) -> str:
+    """Cache key of a parsed file. The path is included since modules hold their filename."""
+    return f"parsed_file_v{INDEXER_VERSION}_{blob_sha}_{f}"
+
+
+def parse_repo_files(files: t.List[str], repo_target: str, num_workers: int = 1, blob_shas: t.Optional[t.Dict[str, str]] = None) -> t.Tuple[t.Dict[str, HighLevelModule], t.Dict[str, str]]:
+    """
+    Parse the files of a repo into modules and raw files, over up to `num_workers` processes (at most one per CPU).
+    Given the git blob SHAs of the files, Python files are cached by content, so that only changed files are parsed again.
+    """
+    results = []
+    to_parse = files
+    if blob_shas is not None:
+        cacheable = [f for f in files if f.endswith(".py") and blob_shas.get(f.replace(repo_target, "")) is not None]
+        # One lookup for all the cached files, instead of a query per file.
+        cached = CACHE.get_objects([parsed_file_cache_key(f, blob_shas[f.replace(repo_target, "")]) for f in cacheable])
+        cached = {f: result for f, result in zip(cacheable, cached) if result is not None}
+        results = list(cached.values())
+        to_parse = [f for f in files if f not in cached]
+        print(f"Parsed files cached: {len(results)}. To parse: {len(to_parse)}")
+    num_workers = min(num_workers, os.cpu_count() or 1)
+    if num_workers <= 1 or len(to_parse) <= PARSE_CHUNK_SIZE:
+        parsed = parse_files(to_parse, repo_target)
+    else:
+        chunks = [to_parse[i:i+PARSE_CHUNK_SIZE] for i in range(0, len(to_parse), PARSE_CHUNK_SIZE)]
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            parsed = [result for chunk_results in pool.map(parse_files, chunks, repeat(repo_target)) for result in chunk_results]
+    if blob_shas is not None:
+        to_cache = []
+        for result in parsed:
+            nice_filename = result[0]
+            blob_sha = blob_shas.get(nice_filename)
+            if blob_sha is not None and nice_filename.endswith(".py"):
+                to_cache.append((parsed_file_cache_key(f"{repo_target}{nice_filename}", blob_sha), result))
+        CACHE.set_objects(to_cache)
+    results.extend(parsed)
+    # Keep the order of the files, whether they were cached or not.
+    order = {f.replace(repo_target, ""): i for i, f in enumerate(files)}
+    results.sort(key=lambda result: order[result[0]])
+    modules: t.Dict[str, HighLevelModule] = {}
+    raw_files: t.Dict[str, str] = {}
+    for nice_filename, module, raw in results:
+        if module is not None:
+            modules[nice_filename] = module
+        else:
+            raw_files[nice_filename] = raw
+    return modules, raw_files
+
+
+def code_index_cache_key(item) -> str:
+    """Cache key of the code index of a (repo, base_commit). Instances at the same commit share it."""
+    return f"code_index_{item['repo']}_{item['base_commit']}_v{INDEXER_VERSION}"
+
+
 def make_code_index(item, check_cache=True) -> SourceCodeIndex:
     instance_id = item["instance_id"]
-    cache_key = f"code_search_{instance_id}"
+    cache_key = code_index_cache_key(item)
+    TEXT_SEARCH.register_instance(item)
+    if check_cache:
+        cached_index = CACHE.get_object(cache_key)
+        if cached_index is not None:
+            # Warm path: the parser is not needed. The checkout may be at another instance's commit.
+            modules, raw_files, dirs, symbols = cached_index
+            if not TEXT_SEARCH.is_indexed(instance_id):
+                index_text_search(instance_id, modules, raw_files, "")
+            return SourceCodeIndex(item, modules, raw_files, dirs, symbols)
     repo_target = REPO.download_repo(item)
     files = list_files(repo_target)
     dirs = list_dirs(repo_target)
-    modules: t.Dict[str, HighLevelModule] = {}
-    raw_files = {}
-    for f in files:
-        nice_filename = f.replace(repo_target, "")
-        try:
-            if f.endswith(".py"):
-                module = make_module(f)
-                if module is not None:
-                    modules[nice_filename] = module
-                else:
-                    with open(f, "r") as file:
-                        raw_files[nice_filename] = file.read()
-            else:
-                if not "README" in f:
-                    # TODO: Figure out how to handle non-python and non-readme files.
-                    continue
-                with open(f, "r") as file:
-                    raw_files[nice_filename] = file.read()
-        except UnicodeError:
-            # Skip files that can't be read as text.
-            continue
+    blob_shas = REPO.blob_shas(repo_target)
+    modules, raw_files = parse_repo_files(files, repo_target, LANGUAGE_MODEL.config["parse_workers"], blob_shas)
     print(f"Modules: {len(modules)}")
     print(f"Raw files: {len(raw_files)}")
-    if check_cache:
-        cached_search = CACHE.get_object(cache_key)
-        if cached_search is not None:
-            return SourceCodeIndex(item, modules, raw_files, dirs, repo_target)
-    TEXT_SEARCH.cleanup(instance_id)
+    if not (check_cache and TEXT_SEARCH.is_indexed(instance_id)):
+        if not (check_cache and index_text_search_incremental(item, modules, raw_files, repo_target)):
+            index_text_search(instance_id, modules, raw_files, repo_target)
+    # Done.
+    modules = {f.replace(repo_target, ""): m for f, m in modules.items()}
+    raw_files = {f.replace(repo_target, ""): r for f, r in raw_files.items()}
+    code_search = SourceCodeIndex(item, modules, raw_files, dirs)
+    CACHE.set_object(cache_key, (modules, raw_files, dirs, code_search.symbols))
+    return code_search
+
+
+def index_text_search(instance_id, modules, raw_files, repo_target):
+    """Index the files of an instance in its text search partition."""
+    TEXT_SEARCH.reset_partition(instance_id)
+    insert_text_search_files(instance_id, modules, raw_files, repo_target)
+    TEXT_SEARCH.mark_indexed(instance_id)
+
+
+def index_text_search_incremental(item, modules, raw_files, repo_target) -> bool:
+    """
+    Index the partition of an instance by copying the latest indexed partition of the same repo,
+    and re-indexing the files that changed since its commit.
+    Returns False, without indexing anything, if there is no such partition or too many files changed.
+    """
+    instance_id = item["instance_id"]
+    base = TEXT_SEARCH.latest_indexed_partition(item["repo"])
+    if base is None:
+        return False
+    base_key, base_commit = base
+    changes = REPO.changed_files(repo_target, base_commit, item["base_commit"])
+    if len(changes) > MAX_INCREMENTAL_CHANGES:
+        return False
+    print(f"Updating partition {base_key} with {len(changes)} changed files")
+    TEXT_SEARCH.copy_partition(instance_id, base_key)
+    TEXT_SEARCH.remove_files(instance_id, list(changes.keys()))
+    # Deleted files are not in the modules or raw files anymore.
+    changed_modules = {f: m for f, m in modules.items() if f.replace(repo_target, "") in changes}
+    changed_raw_files = {f: r for f, r in raw_files.items() if f.replace(repo_target, "") in changes}
+    insert_text_search_files(instance_id, changed_modules, changed_raw_files, repo_target)
+    TEXT_SEARCH.mark_indexed(instance_id)
+    return True
+
+
+def insert_text_search_files(instance_id, modules, raw_files, repo_target):
+    """Insert the elements and whole files of modules and raw files in the text search partition of an instance."""
+    # Collect every element first, so that all chunks are embedded together.
+    elems = []
     for filename, content in raw_files.items():
         filename = filename.replace(repo_target, "")
         if filename.endswith(".py"):
@@ -570,41 +801,40 @@ def make_code_index(item, check_cache=True) -> SourceCodeIndex:
         else:
             elem_type = "other"
         content = f"{content}"
-        TEXT_SEARCH.insert_into_db(
-            instance_id=instance_id, filename=filename, elem_name=filename,
-            parent_name="", display_level="", elem_type=elem_type,
-            content=content
-        )
+        elems.append({
+            "filename": filename, "elem_name": filename,
+            "parent_name": "", "display_level": "", "elem_type": elem_type,
+            "content": content,
+        })
     for filename, module in modules.items():
         filename = filename.replace(repo_target, "")
         module_display_levels = [CodeDisplayLevel.MINIMAL, CodeDisplayLevel.MODERATE, CodeDisplayLevel.FULL]
         for display_level in module_display_levels:
             level = display_level.value
             module_content = f"{module.display(level=display_level, line_mode=LineNumberMode.DISABLED)}"
-            TEXT_SEARCH.insert_into_db(
-                instance_id=instance_id, filename=filename, elem_name=filename,
-                parent_name="", display_level=level, elem_type="module",
-                content=module_content
-            )
+            elems.append({
+                "filename": filename, "elem_name": filename,
+                "parent_name": "", "display_level": level, "elem_type": "module",
+                "content": module_content,
+            })
         # Only do minimal display for now.
         internal_display_levels = [CodeDisplayLevel.MINIMAL]
         for display_level in internal_display_levels:
             level = display_level.value
             for fn_name in module.functions:
-                TEXT_SEARCH.insert_into_db(
-                    instance_id=instance_id, filename=filename, elem_name=fn_name,
-                    parent_name="", display_level=level, elem_type="function",
-                    content=module.display_function(fn_name, level=display_level, line_mode=LineNumberMode.DISABLED)
-                )
+                elems.append({
+                    "filename": filename, "elem_name": fn_name,
+                    "parent_name": "", "display_level": level, "elem_type": "function",
+                    "content": module.display_function(fn_name, level=display_level, line_mode=LineNumberMode.DISABLED),
+                })
             for class_name in module.classes:
-                TEXT_SEARCH.insert_into_db(
-                    instance_id=instance_id, filename=filename, elem_name=class_name,
-                    parent_name="", display_level=level, elem_type="class",
-                    content=module.display_class(class_name, level=display_level, line_mode=LineNumberMode.DISABLED)
-                )
-    # Done.
-    modules = {f.replace(repo_target, ""): m for f, m in modules.items()}
-    raw_files = {f.replace(repo_target, ""): r for f, r in raw_files.items()}
-    code_search = SourceCodeIndex(item, modules, raw_files, dirs, repo_target)
-    CACHE.set_object(cache_key, (modules, raw_files, dirs))
-    return code_search
\ No newline at end of file
+                elems.append({
+                    "filename": filename, "elem_name": class_name,
+                    "parent_name": "", "display_level": level, "elem_type": "class",
+                    "content": module.display_class(class_name, level=display_level, line_mode=LineNumberMode.DISABLED),
+                })
+    TEXT_SEARCH.insert_many_into_db(instance_id, elems)
+    files = {filename.replace(repo_target, ""): content for filename, content in raw_files.items()}
+    for filename, module in modules.items():
+        files[filename.replace(repo_target, "")] = module.source_file.content
+    TEXT_SEARCH.insert_files(instance_id, files)
\ No newline at end of file
@@ -1,10 +1,13 @@
 from common.handles import LANGUAGE_MODEL, TEXT_SEARCH, CACHE
+from .context_packer import ContextSnippet, PRIORITY_PUBLIC
 import typing as t
 import json
 from googlesearch import search as google_search
 from bs4 import BeautifulSoup
 import requests
 
+# Token budget for the content of a single page.
+PAGE_CONTENT_MAX_TOKENS = 11000
 
 FORMULATE_SEARCH_SYSTEM_MSG = f"""
 Based on a github issue, you will help me search the internet for auxiliary information that can help me solve the issue.
@@ -144,7 +147,6 @@ class PublicSearch:
     def perform_public_search(self, item, additional_context: str = ""):
         search_queries = self.formulate_search_queries(item, additional_context)
         print(f"Search queries: {json.dumps(search_queries, indent=2)}")
-        exit(0)
         aggregated_results = []
         for query_idx, (reasoning, query) in enumerate(search_queries):
             responses = self.internet_search(item, query, query_idx)
@@ -162,10 +164,16 @@ class PublicSearch:
             aggregated_results.append((query, aggregated))
         for query, aggregated in aggregated_results:
             print(f"Query: {query}. Aggregated:\n{aggregated}")
-        exit(0)
         return aggregated_results
 
 
+    def public_context_snippets(self, aggregated_results) -> t.List[ContextSnippet]:
+        """Aggregated results as snippets for the context packer."""
+        return [
+            ContextSnippet.from_text("public", PRIORITY_PUBLIC, f"Search query: {query}", aggregated)
+            for query, aggregated in aggregated_results
+        ]
+
     def is_self_referential(self, item, s):
         repo = item['repo']
         repo = repo.split("/")[-1].lower()
@@ -208,7 +216,7 @@ Your task: {FORMULATE_SEARCH_INSTRUCTIONS}
             search_contexts = []
             for search_result in search_results:
                 page_content = self._retrieve_page_content(item, query_idx, search_result["url"])
-                page_content = page_content[:45000]
+                page_content = LANGUAGE_MODEL.truncate_tokens(page_content, PAGE_CONTENT_MAX_TOKENS)
                 search_context = f"""
 ---
 URL: {search_result['url']}
@@ -0,0 +1,138 @@
+from collections import namedtuple
+from common.code_tokens import canonical_identifier
+import bisect
+import typing as t
+
+# Fuzzy candidates must share this many trigrams with the query, and at most this many are scored.
+FUZZY_MIN_SHARED_TRIGRAMS = 1
+FUZZY_MAX_CANDIDATES = 50
+
+# A definition. Lines are 1-indexed and inclusive, as in the AST. Parent is the class of a method.
+Symbol = namedtuple("Symbol", ["name", "filename", "kind", "parent", "line_start", "line_end"])
+
+
+class SymbolTable:
+    """Functions, classes and methods of a repository by name, with exact, prefix and case-insensitive lookups."""
+    def __init__(self):
+        self.by_name: t.Dict[str, t.List[Symbol]] = {}
+        self.by_lower_name: t.Dict[str, t.List[str]] = {}
+        self.sorted_names: t.Optional[t.List[str]] = None
+        # Names by canonical form, and canonical forms by trigram. Built on the first fuzzy lookup.
+        self.by_canonical_name: t.Optional[t.Dict[str, t.List[str]]] = None
+        self.trigram_index: t.Optional[t.Dict[str, t.List[str]]] = None
+
+    def __getstate__(self):
+        # The lookup indices are cheap to rebuild, so they are not cached.
+        return {"by_name": self.by_name, "by_lower_name": self.by_lower_name}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.by_name = state["by_name"]
+        self.by_lower_name = state["by_lower_name"]
+
+    @staticmethod
+    def from_modules(modules: t.Dict[str, t.Any]) -> "SymbolTable":
+        """Build the table from the modules of a code index."""
+        table = SymbolTable()
+        for filename, module in modules.items():
+            for fn_name, fn in module.functions.items():
+                table.add(Symbol(fn_name, filename, "function", None, fn.line_start, fn.line_end))
+            for class_name, klass in module.classes.items():
+                table.add(Symbol(class_name, filename, "class", None, klass.line_start, klass.line_end))
+                for method_name, method in klass.methods.items():
+                    table.add(Symbol(method_name, filename, "method", class_name, method.line_start, method.line_end))
+        return table
+
+    def add(self, symbol: Symbol):
+        if symbol.name not in self.by_name:
+            self.by_name[symbol.name] = []
+            self.by_lower_name.setdefault(symbol.name.lower(), []).append(symbol.name)
+            self.sorted_names = None
+            self.by_canonical_name = None
+            self.trigram_index = None
+        self.by_name[symbol.name].append(symbol)
+
+    def _filter(self, symbols: t.List[Symbol], kind: t.Optional[str], parent: t.Optional[str]) -> t.List[Symbol]:
+        return [s for s in symbols if (kind is None or s.kind == kind) and (parent is None or s.parent == parent)]
+
+    def lookup(self, name: str, kind: t.Optional[str] = None, parent: t.Optional[str] = None) -> t.List[Symbol]:
+        """Symbols with exactly this name."""
+        return self._filter(self.by_name.get(name, []), kind, parent)
+
+    def lookup_case_insensitive(self, name: str, kind: t.Optional[str] = None, parent: t.Optional[str] = None) -> t.List[Symbol]:
+        """Symbols with this name, ignoring case."""
+        symbols = []
+        for actual_name in self.by_lower_name.get(name.lower(), []):
+            symbols.extend(self.by_name[actual_name])
+        return self._filter(symbols, kind, parent)
+
+    def lookup_prefix(self, prefix: str, kind: t.Optional[str] = None, parent: t.Optional[str] = None, max_names: int = 100) -> t.List[Symbol]:
+        """Symbols whose name starts with the prefix, for at most `max_names` names."""
+        if self.sorted_names is None:
+            self.sorted_names = sorted(self.by_name.keys())
+        symbols = []
+        start = bisect.bisect_left(self.sorted_names, prefix)
+        for name in self.sorted_names[start:start+max_names]:
+            if not name.startswith(prefix):
+                break
+            symbols.extend(self.by_name[name])
+        return self._filter(symbols, kind, parent)
+
+    def _build_fuzzy_index(self):
+        by_canonical_name: t.Dict[str, t.List[str]] = {}
+        for name in self.by_name:
+            by_canonical_name.setdefault(canonical_identifier(name) or name.lower(), []).append(name)
+        trigram_index: t.Dict[str, t.List[str]] = {}
+        for canonical in by_canonical_name:
+            for trigram in set(trigrams(canonical)):
+                trigram_index.setdefault(trigram, []).append(canonical)
+        self.by_canonical_name = by_canonical_name
+        self.trigram_index = trigram_index
+
+    def fuzzy_lookup(self, name: str, kind: t.Optional[str] = None, parent: t.Optional[str] = None, min_score: float = 0.75, max_results: int = 5) -> t.List[t.Tuple[Symbol, float]]:
+        """
+        Symbols with a name close to this one, best first, with a similarity score between 0 and 1.
+        Names are compared in canonical form, so that spelling differences (safe_infer vs SafeInfer) score 1.
+        Candidates share trigrams with the name, and are then ranked by edit distance.
+        """
+        if self.trigram_index is None:
+            self._build_fuzzy_index()
+        query = canonical_identifier(name) or name.lower()
+        shared: t.Dict[str, int] = {}
+        for trigram in set(trigrams(query)):
+            for canonical in self.trigram_index.get(trigram, []):
+                shared[canonical] = shared.get(canonical, 0) + 1
+        candidates = [c for c, n in shared.items() if n >= FUZZY_MIN_SHARED_TRIGRAMS]
+        candidates.sort(key=lambda c: shared[c], reverse=True)
+        scored = []
+        for canonical in candidates[:FUZZY_MAX_CANDIDATES]:
+            score = 1.0 - edit_distance(query, canonical) / max(len(query), len(canonical))
+            if score < min_score:
+                continue
+            for actual_name in self.by_canonical_name[canonical]:
+                for symbol in self._filter(self.by_name[actual_name], kind, parent):
+                    scored.append((symbol, score))
+        scored.sort(key=lambda x: x[1], reverse=True)
+        return scored[:max_results]
+
+    def names(self) -> t.List[str]:
+        return list(self.by_name.keys())
+
+
+def trigrams(text: str) -> t.List[str]:
+    """Trigrams of a text, padded so that short texts have at least one."""
+    padded = f"  {text} "
+    return [padded[i:i+3] for i in range(len(padded) - 2)]
+
+
+def edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance."""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j-1] + 1, previous[j-1] + (ca != cb)))
+        previous = current
+    return previous[-1]
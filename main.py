@@ -93,7 +93,7 @@ def main_try_code_search(instance_id: str, force: bool = False, query = None, ex
     # dir_selection.make_final_selection(item, code_search, full_contexts)    
 
     # print(json.dumps(results, indent=2))
-    print(TEXT_SEARCH.db_idx(instance_id))
+    print(TEXT_SEARCH.partition_key(instance_id))
 
 def aux_search(instance_id: str, force: bool = False):
     from fixer.auxiliary_search import AuxiliarySearch
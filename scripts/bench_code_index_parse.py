@@ -0,0 +1,23 @@
+from fixer.module import list_files, parse_repo_files
+import argparse
+import time
+
+
+def main(repo_dir: str, workers: list):
+    if not repo_dir.endswith("/"):
+        repo_dir += "/"
+    files = list_files(repo_dir)
+    print(f"Files: {len(files)}")
+    for num_workers in workers:
+        start = time.perf_counter()
+        modules, raw_files = parse_repo_files(files, repo_dir, num_workers)
+        duration = time.perf_counter() - start
+        print(f"Workers: {num_workers}. Modules: {len(modules)}. Raw files: {len(raw_files)}. Time: {duration:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parsing a downloaded repo (e.g. django or sympy) with different numbers of workers.")
+    parser.add_argument("repo_dir", type=str, help="e.g. working_stage/downloaded_repos/django__django")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+    main(args.repo_dir, args.workers)
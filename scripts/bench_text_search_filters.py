@@ -0,0 +1,79 @@
+from common.handles import TEXT_SEARCH
+from common.sqlite_store import migrate
+from common.text_search import MIGRATIONS_DIR
+import argparse
+import random
+import time
+import typing as t
+
+ELEM_TYPES = ["module", "class", "function", "method", "readme"]
+# Synthetic vocabulary, so that each query term only matches a fraction of the chunks.
+WORDS = [f"word{i}" for i in range(2000)]
+# Filters of the searches in fixer/.
+QUERIES = [
+    ("word1 word2", {}),
+    ("word3 word4", {"elem_type": "function"}),
+    ("word5 word6", {"elem_type": ["class", "method"]}),
+    ("word7 word8", {"elem_type": "code"}),
+    ("word9 word10", {"in_dirs": ["pkg3/", "pkg7/"]}),
+    ("word11 word12", {"elem_type": "module", "in_dirs": "pkg1/"}),
+]
+
+
+def populate(instance_id: str, num_rows: int):
+    """Fill a scratch partition with synthetic chunks."""
+    rng = random.Random(0)
+    db = TEXT_SEARCH._partition(instance_id).db
+    rows = []
+    for i in range(num_rows):
+        filename = f"pkg{rng.randrange(20)}/mod{rng.randrange(50)}.py"
+        content = " ".join(rng.choice(WORDS) for _ in range(100))
+        rows.append((i + 1, instance_id, filename, f"elem{i}", "", rng.choice(ELEM_TYPES), "moderate", 0, content, content))
+    db.executemany("INSERT INTO content_table VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    db.executemany("INSERT INTO fts_search_table (rowid, filename, content) VALUES (?, ?, ?)", [(r[0], r[2], r[8]) for r in rows])
+    db.commit()
+
+
+def time_queries(instance_id: str, repeats: int) -> t.Tuple[float, float]:
+    """
+    Average latencies of the queries, in milliseconds: exact searches, and the filtered ids that sqlite-vss searches within.
+    """
+    db = TEXT_SEARCH._partition(instance_id).db
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for query, filters in QUERIES:
+            TEXT_SEARCH.exact_search(instance_id, query, num_results=5, **filters)
+    exact_ms = (time.perf_counter() - start) * 1000 / (repeats * len(QUERIES))
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for _, filters in QUERIES:
+            filtered_ids, filter_params = TEXT_SEARCH._filtered_ids(filters.get("elem_type"), filters.get("in_dirs"))
+            db.execute(filtered_ids, filter_params).fetchall()
+    filter_ms = (time.perf_counter() - start) * 1000 / (repeats * len(QUERIES))
+    return exact_ms, filter_ms
+
+
+def main(instance_id: str, num_rows: int, repeats: int):
+    try:
+        populate(instance_id, num_rows)
+        db = TEXT_SEARCH._partition(instance_id).db
+        # Back to the unmigrated schema.
+        db.executescript("DROP INDEX IF EXISTS content_elem_type_filename; DROP INDEX IF EXISTS content_filename; PRAGMA user_version = 0;")
+        before = time_queries(instance_id, repeats)
+        migrate(db, MIGRATIONS_DIR)
+        db.execute("ANALYZE")
+        after = time_queries(instance_id, repeats)
+    finally:
+        TEXT_SEARCH.cleanup(instance_id)
+    print(f"Rows: {num_rows}")
+    print(f"Before migration: {before[0]:.2f}ms per exact search, {before[1]:.2f}ms per filter")
+    print(f"After migration: {after[0]:.2f}ms per exact search, {after[1]:.2f}ms per filter")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark filtered text searches before and after the content_table indexes.")
+    parser.add_argument("--instance_id", default="filter_bench", help="Scratch instance whose partition is created and dropped.")
+    parser.add_argument("--num_rows", type=int, default=20000)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+    main(args.instance_id, args.num_rows, args.repeats)
@@ -0,0 +1,43 @@
+from common.handles import TEXT_SEARCH
+import argparse
+
+# Filters of the searches in fixer/, each with two sets of values that must share a statement.
+FILTERS = [
+    ({}, {}),
+    ({"elem_type": "function"}, {"elem_type": ["class", "method"]}),
+    ({"elem_type": "code"}, {"elem_type": "code"}),
+    ({"in_dirs": "src/"}, {"in_dirs": ["src/pkg_name/", "docs/50%_off/"]}),
+    ({"elem_type": "module", "in_dirs": "src/"}, {"elem_type": ["module", "readme"], "in_dirs": ["lib/"]}),
+]
+
+
+def check_exact_search(instance_id: str):
+    for filters, other_filters in FILTERS:
+        stmt, params = TEXT_SEARCH._exact_search_stmt("query", 5, **filters)
+        other_stmt, _ = TEXT_SEARCH._exact_search_stmt("other query", 8, **other_filters)
+        # Statements only differ by their parameters, so they are prepared once and cached.
+        assert stmt == other_stmt, f"Statement depends on filter values: {filters} vs {other_filters}"
+        plan = TEXT_SEARCH.query_plan(instance_id, stmt, params)
+        print(f"Filters: {filters}")
+        print("\n".join(f"    {step}" for step in plan))
+        assert any(step.startswith("SCAN fts_search_table VIRTUAL TABLE INDEX") for step in plan), "FTS index not used"
+        assert any(step.startswith("SEARCH content_table USING INTEGER PRIMARY KEY") for step in plan), "Matches not fetched by id"
+        # Filters read ids from a covering index instead of scanning the table.
+        assert not any(step.startswith("SCAN content_table") for step in plan), "Filters scan content_table"
+        if "in_dirs" in filters:
+            assert any(step.startswith("SEARCH content_table USING COVERING INDEX") for step in plan), "Directories not searched in an index"
+
+
+def main(instance_id: str):
+    try:
+        check_exact_search(instance_id)
+    finally:
+        TEXT_SEARCH.cleanup(instance_id)
+    print("Query plans OK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that text search statements are reusable and use their indices.")
+    parser.add_argument("--instance_id", default="query_plan_check", help="Scratch instance whose partition is created and dropped.")
+    args = parser.parse_args()
+    main(args.instance_id)
@@ -0,0 +1,77 @@
+from common.handles import TEXT_SEARCH
+from common.text_search import reciprocal_rank_fusion, fusion_key, RRF_K
+from common.code_tokens import index_tokens
+from common.vector_index import InstanceVectors
+import numpy as np
+import sqlite3
+
+
+def make_result(name: str, display_level: str = "moderate", split_idx: int = 0):
+    return {"filename": f"pkg/{name}.py", "elem_name": name, "parent_name": "", "elem_type": "function", "display_level": display_level, "split_idx": split_idx}
+
+
+def check_fusion():
+    # The same element at several display levels counts once per ranking, at its best rank.
+    exact = [make_result("a", "moderate"), make_result("a", "signature"), make_result("a", "full"), make_result("b")]
+    approximate = [make_result("a", "signature"), make_result("b"), make_result("a", "full")]
+    fused, scores = reciprocal_rank_fusion([exact, approximate])
+    max_score = 2.0 / (RRF_K + 1)
+    for key, score in scores.items():
+        assert score <= max_score + 1e-12, f"Fused score of {key} is {score} > {max_score}"
+    a_key, b_key = fusion_key(make_result("a")), fusion_key(make_result("b"))
+    assert abs(scores[a_key] - max_score) < 1e-12, f"First in both rankings should score {max_score}"
+    assert abs(scores[b_key] - 2.0 / (RRF_K + 2)) < 1e-12, "Duplicates should not push down later ranks"
+    assert fused[a_key]["display_level"] == "moderate", "First result of a key should be kept"
+    # Different splits of the same element are different elements.
+    _, scores = reciprocal_rank_fusion([[make_result("c", split_idx=0), make_result("c", split_idx=1)]])
+    assert len(scores) == 2
+
+
+def check_query_tokens():
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE VIRTUAL TABLE fts_search_table USING fts5 (filename, content)")
+    codes = ["def safe_infer_call(node): pass", "def SafeInfer(node): pass", "def unrelated(): pass"]
+    for rowid, code in enumerate(codes):
+        db.execute("INSERT INTO fts_search_table(rowid, filename, content) VALUES (?, ?, ?)", (rowid, "", index_tokens(code)))
+    search = lambda query, any_terms=False: [r[0] for r in db.execute(
+        "SELECT rowid FROM fts_search_table WHERE fts_search_table MATCH ? ORDER BY bm25(fts_search_table)",
+        (TEXT_SEARCH._make_fts_query(query, any_terms=any_terms),),
+    )]
+    # Identifiers that contain the query's identifier still match, after the exact identifier.
+    assert search("safe_infer") == [1, 0], search("safe_infer")
+    assert search("safeInfer node") == [1, 0], search("safeInfer node")
+    assert search("safe_infer_call") == [0], search("safe_infer_call")
+    assert sorted(search("unrelated safe_infer_call", any_terms=True)) == [0, 2]
+
+
+def check_filters():
+    # The SQL filters and the masks of the NumPy index select the same rows.
+    rows = [
+        ("pkg/core.py", "function"), ("pkg/tests/test_core.py", "function"), ("Tests/helpers.py", "class"),
+        ("pkg/TESTS.md", "readme"), ("pkg/unittests/case.py", "method"), ("pkg/a_b/mod.py", "module"),
+        ("pkg/aXb/mod.py", "class"), ("docs/index.md", "other"),
+    ]
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE content_table (id INTEGER PRIMARY KEY, filename TEXT, elem_type TEXT)")
+    db.executemany("INSERT INTO content_table (id, filename, elem_type) VALUES (?, ?, ?)", [(i, f, e) for i, (f, e) in enumerate(rows)])
+    vectors = InstanceVectors(np.zeros((len(rows), 1), dtype=np.float32), list(range(len(rows))), [f for f, _ in rows], [e for _, e in rows])
+    filters = [
+        {"elem_type": "code"}, {"elem_type": ["class", "readme"]}, {"in_dirs": "pkg/a_b/"},
+        {"elem_type": "code", "in_dirs": ["pkg/", "Tests/"]}, {"in_dirs": ""},
+    ]
+    for f in filters:
+        stmt, params = TEXT_SEARCH._filtered_ids(f.get("elem_type"), f.get("in_dirs"))
+        sql_ids = sorted(r[0] for r in db.execute(stmt, params))
+        mask_ids = [int(i) for i in np.flatnonzero(vectors.filter_mask(f.get("elem_type"), f.get("in_dirs")))]
+        assert sql_ids == mask_ids, f"Filters {f} differ: SQL {sql_ids}, NumPy {mask_ids}"
+
+
+def main():
+    check_fusion()
+    check_query_tokens()
+    check_filters()
+    print("Text search checks OK")
+
+
+if __name__ == "__main__":
+    main()
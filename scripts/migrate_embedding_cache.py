@@ -0,0 +1,83 @@
+from common.handles import CACHE, LANGUAGE_MODEL, TEXT_SEARCH
+from common.text_search import exact_only
+from common.vector_codec import encode_vector
+import argparse
+import glob
+import json
+import sqlite3
+import typing as t
+
+# Rows read at a time.
+BATCH_SIZE = 1000
+
+
+def is_embedding(value: t.Any) -> bool:
+    return isinstance(value, list) and len(value) > 0 and all(isinstance(x, (int, float)) for x in value)
+
+
+def move_prompt_cache_embeddings() -> int:
+    """Embeddings used to be stored as JSON in the prompt cache. Move them to the embedding cache, under the same key."""
+    moved = 0
+    for db, db_lock in zip(CACHE.dbs, CACHE.db_locks):
+        with db_lock:
+            # Cached responses are JSON strings, so only embeddings are JSON lists.
+            keys = [row[0] for row in db.execute("SELECT key FROM prompt_digest_cache WHERE value LIKE '[%'").fetchall()]
+            for start in range(0, len(keys), BATCH_SIZE):
+                chunk = keys[start:start+BATCH_SIZE]
+                placeholders = ", ".join(["?"] * len(chunk))
+                rows = db.execute(f"SELECT key, prompt_digest, value FROM prompt_digest_cache WHERE key IN ({placeholders})", chunk).fetchall()
+                rows = [(key, digest, json.loads(value)) for key, digest, value in rows]
+                rows = [(key, digest, encode_vector(value, CACHE.embedding_dtype)) for key, digest, value in rows if is_embedding(value)]
+                db.executemany("INSERT OR IGNORE INTO embedding_cache (key, text_digest, value) VALUES (?, ?, ?)", rows)
+                db.executemany("DELETE FROM prompt_digest_cache WHERE key = ?", [(key,) for key, _, _ in rows])
+                db.commit()
+                moved += len(rows)
+    return moved
+
+
+def rekey_instance_embeddings(db_file: str) -> int:
+    """
+    Chunk embeddings used to be cached per instance. Copy the ones indexed in a text search db to their content keys
+    (see LanguageModel.embedding_cache_key), so that they are found without knowing the instance.
+    """
+    db = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    cur = db.execute("SELECT instance_id, filename, elem_name, parent_name, elem_type, display_level, split_idx, content FROM content_table")
+    copied = 0
+    while True:
+        rows = cur.fetchmany(BATCH_SIZE)
+        if len(rows) == 0:
+            break
+        rows = [r for r in rows if not (exact_only([r[1], r[2]]) or r[5] == "full")]
+        content_items = [(LANGUAGE_MODEL.embedding_cache_key(r[7]), r[7]) for r in rows]
+        cached = CACHE.get_embeddings(content_items)
+        missing = [i for i, embedding in enumerate(cached) if embedding is None]
+        instance_items = []
+        for i in missing:
+            instance_id, filename, elem_name, parent_name, elem_type, display_level, split_idx, content = rows[i]
+            instance_key = f"{TEXT_SEARCH.subsystem}_{instance_id}_{filename}_{parent_name}_{elem_name}_{elem_type}_{display_level}_{split_idx}"
+            instance_items.append((instance_key, content))
+        instance_embeddings = CACHE.get_embeddings(instance_items)
+        found = [(content_items[i][0], content_items[i][1], embedding) for i, embedding in zip(missing, instance_embeddings) if embedding is not None]
+        CACHE.set_embeddings(found)
+        copied += len(found)
+    db.close()
+    return copied
+
+
+def main(db_dir: str):
+    moved = move_prompt_cache_embeddings()
+    print(f"Moved {moved} embeddings out of the prompt cache")
+    # Partitions, and the shards of the text search store from before partitioning.
+    db_files = sorted(glob.glob(f"{db_dir}/partitions/*.db") + glob.glob(f"{db_dir}/text_search_*.db"))
+    for db_file in db_files:
+        copied = rekey_instance_embeddings(db_file)
+        print(f"Copied {copied} embeddings of {db_file} to their content keys")
+    CACHE.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move embeddings cached in old formats to the embedding cache, once.")
+    parser.add_argument("--db_dir", default=None, help="Text search directory. Defaults to the one of the configured LLM.")
+    args = parser.parse_args()
+    db_dir = args.db_dir if args.db_dir is not None else f"{LANGUAGE_MODEL.config['working_stage']}/text_search_{LANGUAGE_MODEL.llm.value}"
+    main(db_dir)